@@ -0,0 +1,186 @@
+"""Line by line annotation (blame) of files.
+
+`svn blame` reads through every revision of a file, which takes a long time
+on old, often changed files. Annotations are stored here per path@revision
+once computed, and that of a new revision is derived from the stored
+annotation of the file's previous revision and the diff between the two.
+Only the first annotation of a file, or one more than MAX_STEPS changes away
+from any stored one, pays for `svn blame`.
+
+An annotation is the (revision, author) of each line. It is stored as runs
+of lines sharing a revision, which is how consecutive lines mostly come.
+"""
+
+import json
+import logging
+import re
+import sqlite3
+import threading
+import zlib
+
+import svnbrowse
+
+# where the annotations are stored
+ANNOTATE_PATH = '/tmp/octopy-annotate.sqlite'
+
+# most revisions an annotation is carried forward through diffs, past that
+# a fresh `svn blame` is cheaper
+MAX_STEPS = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    repo TEXT NOT NULL,
+    path TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    runs BLOB NOT NULL,
+    PRIMARY KEY (repo, path, revision)
+);
+"""
+
+_HUNK = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@')
+
+def apply_diff(lines, diff, annotation):
+    """Returns the annotation of the new side of the unified diff of a file
+    given the annotation of its old side. Lines the diff adds get
+    `annotation`.
+    """
+    result = []
+    old = 0
+    hunks = False
+    for line in diff.split('\n'):
+        if line.startswith('@@'):
+            match = _HUNK.match(line)
+            start, count = int(match.group(1)), int(match.group(2) or 1)
+            # an empty old side starts after its line rather than at it
+            start = start - 1 if count else start
+            result.extend(lines[old:start])
+            old = start
+            hunks = True
+        elif line.startswith('Property changes on: '):
+            break
+        elif not hunks:
+            continue
+        elif line[:1] == ' ':
+            result.append(lines[old])
+            old += 1
+        elif line[:1] == '-':
+            old += 1
+        elif line[:1] == '+':
+            result.append(annotation)
+    if old > len(lines):
+        raise IndexError("diff doesn't apply to the annotation")
+    result.extend(lines[old:])
+    return result
+
+def _encode(lines):
+    runs = []
+    for line in lines:
+        if runs and runs[-1][0] == line[0] and runs[-1][1] == line[1]:
+            runs[-1][2] += 1
+        else:
+            runs.append([line[0], line[1], 1])
+    return sqlite3.Binary(zlib.compress(json.dumps(runs)))
+
+def _decode(data):
+    lines = []
+    for revision, author, count in json.loads(zlib.decompress(data)):
+        lines.extend([(revision, author)] * count)
+    return lines
+
+def _text(path):
+    """path as unicode, sqlite refuses byte strings that aren't ASCII"""
+    return path.decode('utf-8') if isinstance(path, str) else path
+
+class AnnotationStore(object):
+    """The stored annotations. Safe to share between threads, each thread
+    gets its own connection.
+    """
+    def __init__(self, path=None):
+        self.path = path or ANNOTATE_PATH
+        self._local = threading.local()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def get(self, repo, path, revision):
+        """Returns the stored annotation of path@revision, None if there is
+        none
+        """
+        path = _text(path)
+        row = self.db.execute('SELECT runs FROM annotations'
+            ' WHERE repo = ? AND path = ? AND revision = ?',
+            (repo, path, int(revision))).fetchone()
+        return _decode(row[0]) if row else None
+
+    def _put(self, repo, path, revision, lines):
+        with self.db as db:
+            db.execute('INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)',
+                (repo, path, int(revision), _encode(lines)))
+
+    def annotate(self, repo, url, path, revision, peg=None):
+        """Returns the annotation of the file at path (from the repository
+        root at url) as of revision, which must be the revision that last
+        changed it. path is looked up at peg, revision by default; a file
+        copied there since revision is annotated like the one it was copied
+        from. Blocks, run it on a worker.
+        """
+        revision = int(revision)
+        path = _text(path)
+        lines = self.get(repo, path, revision)
+        if lines is not None:
+            return lines
+        # the changes since the newest stored annotation, newest first
+        steps = []
+        copied = None
+        for rev, old_path, author in svnbrowse.file_history(url, path, revision,
+                limit=MAX_STEPS + 1, peg=peg):
+            if copied is None:
+                # the path the file had in revision
+                copied = old_path
+            lines = self.get(repo, old_path, rev) if steps or copied != path else None
+            if lines is not None:
+                break
+            steps.append((rev, old_path, author))
+        copied = copied or path
+        if lines is not None:
+            try:
+                lines = self._carry(repo, url, lines, rev, old_path, steps)
+            except IndexError:
+                logging.warning("annotation of %s%s@%d doesn't match its diff",
+                    repo, old_path, rev)
+                lines = None
+        if lines is None:
+            lines = svnbrowse.blame(url + copied, revision)
+            self._put(repo, copied, revision, lines)
+        if copied != path:
+            self._put(repo, path, revision, lines)
+        return lines
+
+    def _carry(self, repo, url, lines, rev, path, steps):
+        """Applies the diffs of steps, oldest last, to the annotation of
+        path@rev. None if one of the diffs is too large to apply.
+        """
+        for next_rev, next_path, author in reversed(steps):
+            diff = svnbrowse.list_diff(url, path.lstrip('/'), rev,
+                next_path.lstrip('/'), next_rev)
+            if diff is None:
+                return None
+            lines = apply_diff(lines, diff, (next_rev, author))
+            self._put(repo, next_path, next_rev, lines)
+            rev, path = next_rev, next_path
+        return lines
+
+_store = None
+
+def get_store():
+    """Returns the process wide annotation store, opening it on first use"""
+    global _store
+    if _store is None:
+        _store = AnnotationStore()
+    return _store
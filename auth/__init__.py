@@ -1,2 +1,2 @@
 from basic import require_basic_auth
-from ldapauth import auth_user_ldap
+from ldapauth import auth_user_ldap, auth_user_ldap_async
@@ -35,7 +35,6 @@ def require_basic_auth(realm, validate_callback):
         def wrap_execute(handler_execute):
             def require_basic_auth(handler, kwargs):
                 def create_auth_header():
-                    print("Creating auth header")
                     handler.set_status(401)
                     handler.set_header('WWW-Authenticate', 'Basic realm=%s' % realm)
                     handler._transforms = []
@@ -46,7 +45,7 @@ def require_basic_auth(realm, validate_callback):
                     create_auth_header()
                 else:
                     auth_decoded = base64.decodestring(auth_header[6:])
-                    basicauth_user, basicauth_pass = auth_decoded.split(':', 2)
+                    basicauth_user, basicauth_pass = auth_decoded.split(':', 1)
                     if validate_callback(basicauth_user, basicauth_pass):
                         return True
                     else:
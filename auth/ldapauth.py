@@ -1,10 +1,40 @@
 """
-See an example that uses basic auth with an LDAP 
+See an example that uses basic auth with an LDAP
 backend in examples/helloworld_basic_ldap.py
 
+Logins are checked by an Authenticator. It keeps up to POOL_SIZE
+connections to the directory open between logins and checks logins on as
+many threads of its own, so a slow directory holds up logins but not the
+IOLoop. Every directory operation, and every wait for a free connection or
+thread, gives up after TIMEOUT seconds and the login fails.
+
+What the directory says is remembered for CACHE_TTL seconds: the DN of each
+user, the members of each group and the logins that succeeded, as a keyed
+hash of the password rather than the password itself. A user logging in
+again, or an API client sending its basic auth credentials with every
+request, is let in without asking the directory at all. A changed password
+or group membership therefore takes up to CACHE_TTL seconds to count.
+
+Connections come from open_connection(). To test against a fake directory,
+give an Authenticator a connect function of your own returning objects with
+simple_bind_s(dn, pwd), search_st(base, scope, filterstr, attrlist,
+timeout=) and unbind_s().
+
 """
-import ldap
+import functools
+import hashlib
+import hmac
 import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from Queue import Queue
+
+import ldap
+import ldap.filter
+import tornado.ioloop
+from tornado import stack_context
 
 # where to start the search for users
 LDAP_SEARCH_BASE = 'ou=People,dc=yourdomain,dc=com'
@@ -15,6 +45,10 @@ LDAP_GROUP_BASE = 'ou=Groups,dc=yourdomain,dc=com'
 # the server to auth against
 LDAP_URL = 'ldap://ldap.yourdomain.com'
 
+# who to search the directory as, empty for anonymous
+LDAP_BIND_DN = ''
+LDAP_BIND_PASSWORD = ''
+
 # The attribute we try to match the username against.
 LDAP_UNAME_ATTR = 'uid'
 
@@ -30,48 +64,221 @@ DEFAULT_GROUP = None
 # Whether to use LDAPv3. Highly recommended.
 LDAP_VERSION_3 = True
 
-def auth_user_ldap(uname, pwd, ingroup=None):
-    """
-    Attempts to bind using the uname/pwd combo passed in.
-    If that works, returns true. Otherwise returns false.
+# number of connections kept open to the directory, and of threads using them
+POOL_SIZE = 4
 
-    """
+# seconds a directory operation, or the wait for a connection, may take
+TIMEOUT = 5
 
-    ingroup = ingroup or DEFAULT_GROUP
+# seconds user DNs, group members and successful logins are remembered
+CACHE_TTL = 300
 
-    if not uname or not pwd:
-        logging.error("Username or password not supplied")
-        return False
+class Unavailable(Exception):
+    """No connection to the directory could be had in time"""
 
+def open_connection():
+    """Returns a new connection to LDAP_URL, bound as LDAP_BIND_DN"""
     ld = ldap.initialize(LDAP_URL)
     if LDAP_VERSION_3:
-        ld.set_option(ldap.VERSION3, 1)
+        ld.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION3)
+    ld.set_option(ldap.OPT_NETWORK_TIMEOUT, TIMEOUT)
+    ld.set_option(ldap.OPT_TIMEOUT, TIMEOUT)
+    ld.set_option(ldap.OPT_REFERRALS, 0)
     #ld.start_tls_s()
-    udn = ld.search_s(LDAP_SEARCH_BASE, ldap.SCOPE_ONELEVEL,
-                           '(%s=%s)' % (LDAP_UNAME_ATTR,uname), [LDAP_BIND_ATTR])
-    if udn:
-        try:
-            bindres = ld.simple_bind_s(udn[0][0], pwd)
+    ld.simple_bind_s(LDAP_BIND_DN, LDAP_BIND_PASSWORD)
+    return ld
 
-            if ingroup:
-                mems = ld.search_s(LDAP_GROUP_BASE, ldap.SCOPE_ONELEVEL, '(%s=%s)' % ('cn', ingroup),
-                    [LDAP_GROUP_MEMBER_ATTR])
+class Authenticator(object):
+    """Checks logins against the directory. authenticate() may be called
+    from any thread, authenticate_async() from the IOLoop thread.
+    """
+    def __init__(self, connect=None, size=None, ttl=None, io_loop=None):
+        self.connect = connect or open_connection
+        self.size = size or POOL_SIZE
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._idle = []
+        self._open = 0
+        self._jobs = Queue()
+        self._threads = []
+        # what the directory said: uname -> dn, group -> members,
+        # (uname, group) -> digest of the password, each with its expiry
+        self._dns = {}
+        self._groups = {}
+        self._logins = {}
+        # hashes the passwords of successful logins, never leaves the process
+        self._key = os.urandom(32)
 
-                logging.debug("members are %s", mems)
+    def _recall(self, memo, key):
+        with self._lock:
+            value, expires = memo.get(key, (None, 0))
+            if expires > time.time():
+                return value
+            memo.pop(key, None)
+        return None
 
-                return uname in mems[0][1]['memberUid']
+    def _remember(self, memo, key, value):
+        with self._lock:
+            memo[key] = value, time.time() + self.ttl
 
-        except ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM:
-            logging.error("Invalid or incomplete credentials for %s", uname)
+    def _digest(self, pwd):
+        if isinstance(pwd, unicode):
+            pwd = pwd.encode('utf-8')
+        return hmac.new(self._key, pwd, hashlib.sha256).digest()
+
+    def cached(self, uname, pwd, ingroup=None):
+        """Returns whether uname logged in with pwd within the last ttl
+        seconds, without asking the directory
+        """
+        digest = self._recall(self._logins, (uname, ingroup or DEFAULT_GROUP))
+        return digest is not None and hmac.compare_digest(digest, self._digest(pwd))
+
+    @contextmanager
+    def _connection(self):
+        """Lends out an idle connection, or a new one if fewer than size are
+        open. A connection that fails is closed rather than lent again.
+        """
+        deadline = time.time() + TIMEOUT
+        with self._lock:
+            while not self._idle and self._open >= self.size:
+                if time.time() >= deadline:
+                    raise Unavailable("all %d connections busy" % self._open)
+                self._released.wait(deadline - time.time())
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._open += 1
+        try:
+            if conn is None:
+                conn = self.connect()
+            yield conn
+        except:
+            with self._lock:
+                self._open -= 1
+                self._released.notify()
+            if conn is not None:
+                try:
+                    conn.unbind_s()
+                except Exception:
+                    pass
+            raise
+        else:
+            with self._lock:
+                self._idle.append(conn)
+                self._released.notify()
+
+    def authenticate(self, uname, pwd, ingroup=None):
+        """
+        Returns whether uname can bind with pwd and is a member of ingroup
+        (DEFAULT_GROUP if not given). Blocks while asking the directory.
+
+        """
+        ingroup = ingroup or DEFAULT_GROUP
+
+        if not uname or not pwd:
+            logging.error("Username or password not supplied")
             return False
+
+        if self.cached(uname, pwd, ingroup):
+            return True
+
+        try:
+            with self._connection() as conn:
+                return self._check(conn, uname, pwd, ingroup)
         except Exception as out:
             logging.error("Auth attempt for %s had an unexpected error: %s",
                          uname, out)
             return False
-        else:
-            return True
-    else:
-        logging.error("No user by that name")
-        return False
 
+    def _check(self, conn, uname, pwd, ingroup):
+        dn = self._recall(self._dns, uname)
+        if dn is None:
+            udn = conn.search_st(LDAP_SEARCH_BASE, ldap.SCOPE_ONELEVEL,
+                '(%s=%s)' % (LDAP_UNAME_ATTR, ldap.filter.escape_filter_chars(uname)),
+                [LDAP_BIND_ATTR], timeout=TIMEOUT)
+            if not udn:
+                logging.error("No user by that name")
+                return False
+            dn = udn[0][0]
+            self._remember(self._dns, uname, dn)
+
+        # the password first, so that the group of a user is only looked at
+        # (and logged) for someone who could log in as them
+        try:
+            conn.simple_bind_s(dn, pwd)
+        except (ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM):
+            logging.error("Invalid or incomplete credentials for %s", uname)
+            return False
+        finally:
+            # back to searching as ourselves before the connection is reused
+            conn.simple_bind_s(LDAP_BIND_DN, LDAP_BIND_PASSWORD)
+
+        if ingroup and uname not in self._members(conn, ingroup):
+            logging.error("%s is not a member of %s", uname, ingroup)
+            return False
+        self._remember(self._logins, (uname, ingroup), self._digest(pwd))
+        return True
+
+    def _members(self, conn, group):
+        members = self._recall(self._groups, group)
+        if members is None:
+            mems = conn.search_st(LDAP_GROUP_BASE, ldap.SCOPE_ONELEVEL,
+                '(cn=%s)' % ldap.filter.escape_filter_chars(group),
+                [LDAP_GROUP_MEMBER_ATTR], timeout=TIMEOUT)
+            logging.debug("members are %s", mems)
+            members = frozenset(mems[0][1].get(LDAP_GROUP_MEMBER_ATTR, ())
+                if mems else ())
+            self._remember(self._groups, group, members)
+        return members
+
+    def authenticate_async(self, uname, pwd, callback, ingroup=None):
+        """Like authenticate, but passes the answer to callback on the
+        IOLoop instead of blocking. Cached logins are answered right away,
+        the rest on one of the authenticator's threads.
+        """
+        if uname and pwd and self.cached(uname, pwd, ingroup):
+            callback(True)
+            return
+        if not self._threads:
+            for i in xrange(self.size):
+                thread = threading.Thread(target=self._work, name="ldapauth-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._jobs.put((time.time() + TIMEOUT, uname, pwd, ingroup,
+            stack_context.wrap(callback)))
+
+    def _work(self):
+        while True:
+            deadline, uname, pwd, ingroup, callback = self._jobs.get()
+            if time.time() > deadline:
+                logging.error("Auth attempt for %s waited too long", uname)
+                result = False
+            else:
+                result = self.authenticate(uname, pwd, ingroup)
+            self.io_loop.add_callback(functools.partial(callback, result))
 
+_authenticator = None
+
+def get_authenticator():
+    """Returns the process wide authenticator, creating it on first use"""
+    global _authenticator
+    if _authenticator is None:
+        _authenticator = Authenticator()
+    return _authenticator
+
+def auth_user_ldap(uname, pwd, ingroup=None):
+    """
+    Attempts to bind using the uname/pwd combo passed in.
+    If that works, returns true. Otherwise returns false.
+
+    """
+    return get_authenticator().authenticate(uname, pwd, ingroup)
+
+def auth_user_ldap_async(uname, pwd, callback, ingroup=None):
+    """
+    Like auth_user_ldap, but passes the answer to callback on the IOLoop.
+
+    """
+    get_authenticator().authenticate_async(uname, pwd, callback, ingroup)
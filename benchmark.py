@@ -0,0 +1,444 @@
+#! env/bin/python
+"""Benchmarks octopy against fixture repositories of several sizes.
+
+    python benchmark.py --sizes small,medium --output today.json
+    python benchmark.py --compare today.json
+
+The fixtures are built once, with `svnadmin create` and `svnadmin load` of
+a generated dump, into --fixtures; a fixture is rebuilt only when its spec
+in SIZES or FIXTURE_VERSION changes. Their contents come from seeded random
+numbers and their commit dates are fixed, so every run measures the same
+repositories. Each one has a deep history, a directory with a great many
+entries, a big file, a large diff and a branch to diff against trunk.
+
+Every case runs in a process of its own, forked for it, so that its peak
+RSS is its own and its first, cold, run doesn't find anything cached. The
+svnbrowse cases call the functions directly; the handler cases start the
+application on a local port with the in-process cache and the indexes of the
+fixture and fetch pages from it with httplib, authenticated like a browser
+would be. A case reports its cold time, the percentiles of the times of the
+warm runs after it, its peak RSS and the svn processes it started, cold and
+per warm run.
+
+--compare prints each case next to the same case of an earlier report and
+exits with status 1 when the median of any got more than --threshold times
+slower, for catching regressions before they ship.
+"""
+
+import argparse
+import hashlib
+import httplib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import types
+import urllib
+import uuid
+
+import svnbrowse
+
+# bump to rebuild every fixture after changing how they are generated
+FIXTURE_VERSION = 2
+
+# the fixture of each size: the number of revisions, the number of entries
+# in trunk/huge, the bytes in trunk/big/big.py and the number of its lines
+# rewritten by the last revision
+SIZES = {
+    'small': {'revisions': 100, 'entries': 100, 'big_bytes': 64 * 1024,
+        'diff_lines': 500},
+    'medium': {'revisions': 2000, 'entries': 2000, 'big_bytes': 512 * 1024,
+        'diff_lines': 5000},
+    'large': {'revisions': 20000, 'entries': 20000, 'big_bytes': 1024 * 1024,
+        'diff_lines': 20000},
+}
+
+# number of files in trunk/src, the ones the history goes through
+MODULES = 10
+
+AUTHORS = ('alice', 'bob', 'carol')
+
+# date of the first revision, each one comes an hour after the last
+EPOCH = 1293840000
+
+parser = argparse.ArgumentParser(description="""Times the svnbrowse functions
+    and the handlers of octopy against generated fixture repositories""")
+parser.add_argument('--sizes', default='small,medium',
+    help="comma separated fixture sizes, of %s" % ', '.join(sorted(SIZES)))
+parser.add_argument('--fixtures', default='/tmp/octopy-fixtures',
+    help="directory the fixtures are kept in")
+parser.add_argument('--repeat', type=int, default=20,
+    help="number of warm runs of each case")
+parser.add_argument('--only', default=None,
+    help="run the cases whose name contains this only")
+parser.add_argument('--output', default=None,
+    help="file to write the report to, as json")
+parser.add_argument('--compare', default=None,
+    help="report of an earlier run to compare with")
+parser.add_argument('--threshold', type=float, default=1.2,
+    help="slowdown of a median counted as a regression")
+
+class Fixture(object):
+    """A fixture repository and the paths the cases use"""
+    def __init__(self, size, base):
+        self.size = size
+        self.spec = SIZES[size]
+        digest = hashlib.sha1(json.dumps([FIXTURE_VERSION, self.spec],
+            sort_keys=True)).hexdigest()[:8]
+        self.name = 'bench-%s' % size
+        self.path = os.path.join(base, '%s-%s' % (size, digest))
+        self.repository = os.path.join(self.path, self.name)
+        self.url = 'file://' + urllib.quote(self.repository)
+        revisions = self.spec['revisions']
+        # r1 lays out trunk, r2 branches and tags it, r3 onwards are the
+        # history and the last revision rewrites part of big.py
+        self.youngest = revisions + 3
+        self.module = 'trunk/src/module_0.py'
+        self.huge = 'trunk/huge'
+        self.big = 'trunk/big/big.py'
+        self.branch = 'branches/feature'
+        self.tag = 'tags/release'
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.exists(self.file('done'))
+
+    def build(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        subprocess.check_call(['svnadmin', 'create', self.repository])
+        load = subprocess.Popen(['svnadmin', 'load', '-q', self.repository],
+            stdin=subprocess.PIPE)
+        for chunk in _dump(self):
+            load.stdin.write(chunk)
+        load.stdin.close()
+        if load.wait():
+            raise RuntimeError("svnadmin load failed for %s" % self.name)
+        outcome = _isolated(_index, self)
+        if outcome and 'error' in outcome:
+            raise RuntimeError("indexing %s failed:\n%s" % (self.name, outcome['error']))
+        open(self.file('done'), 'w').close()
+
+def _props(props):
+    data = ''.join('K %d\n%s\nV %d\n%s\n' % (len(k), k, len(v), v) for k, v in props)
+    return data + 'PROPS-END\n'
+
+def _revision(number, author, message):
+    date = time.strftime('%Y-%m-%dT%H:%M:%S.000000Z',
+        time.gmtime(EPOCH + number * 3600))
+    props = [('svn:date', date)]
+    if number:
+        props = [('svn:author', author), ('svn:log', message)] + props
+    props = _props(props)
+    return ('Revision-number: %d\nProp-content-length: %d\nContent-length: %d\n\n%s\n'
+        % (number, len(props), len(props), props))
+
+def _dir(path, copyfrom=None):
+    node = 'Node-path: %s\nNode-kind: dir\nNode-action: add\n' % path
+    if copyfrom:
+        return node + 'Node-copyfrom-rev: %d\nNode-copyfrom-path: %s\n\n\n' % copyfrom
+    return node + 'Prop-content-length: 10\nContent-length: 10\n\nPROPS-END\n\n\n'
+
+def _file(path, text, action='add'):
+    node = 'Node-path: %s\nNode-kind: file\nNode-action: %s\n' % (path, action)
+    if action == 'add':
+        return node + ('Prop-content-length: 10\nText-content-length: %d\n'
+            'Content-length: %d\n\nPROPS-END\n%s\n\n' % (len(text), len(text) + 10, text))
+    return node + ('Text-content-length: %d\nContent-length: %d\n\n%s\n\n'
+        % (len(text), len(text), text))
+
+def _line(rng, number):
+    return 'value_%d = %d  # %s\n' % (number, rng.randint(0, 1 << 30),
+        rng.choice(AUTHORS) * rng.randint(1, 4))
+
+def _dump(fixture):
+    """Yields the dump of the fixture repository, a piece at a time"""
+    spec = fixture.spec
+    rng = random.Random(fixture.size)
+    yield 'SVN-fs-dump-format-version: 2\n\n'
+    yield 'UUID: %s\n\n' % uuid.UUID(hashlib.md5(fixture.name).hexdigest())
+    yield _revision(0, None, None)
+
+    yield _revision(1, AUTHORS[0], 'Lays out the repository')
+    for path in ('trunk', 'branches', 'tags', 'trunk/src', 'trunk/huge', 'trunk/big'):
+        yield _dir(path)
+    modules = []
+    for i in xrange(MODULES):
+        lines = [_line(rng, n) for n in xrange(200)]
+        modules.append(lines)
+        yield _file('trunk/src/module_%d.py' % i, ''.join(lines))
+    for i in xrange(spec['entries']):
+        yield _file('%s/entry_%05d.py' % (fixture.huge, i), _line(rng, i))
+    big = []
+    size = 0
+    while size < spec['big_bytes']:
+        big.append(_line(rng, len(big)))
+        size += len(big[-1])
+    yield _file(fixture.big, ''.join(big))
+
+    yield _revision(2, AUTHORS[1], 'Branches and tags trunk')
+    yield _dir(fixture.branch, (1, 'trunk'))
+    yield _dir(fixture.tag, (1, 'trunk'))
+    branch = [list(lines) for lines in modules]
+
+    for number in xrange(3, spec['revisions'] + 3):
+        yield _revision(number, AUTHORS[number % len(AUTHORS)],
+            'Change number %d\n\nTouches a few lines.' % number)
+        # every tenth change goes to the branch, so it differs from trunk
+        if number % 10 == 0:
+            root, files = fixture.branch, branch
+        else:
+            root, files = 'trunk', modules
+        i = rng.randrange(MODULES)
+        for n in rng.sample(xrange(len(files[i])), 3):
+            files[i][n] = _line(rng, n)
+        yield _file('%s/src/module_%d.py' % (root, i), ''.join(files[i]), 'change')
+
+    yield _revision(fixture.youngest, AUTHORS[0], 'Rewrites big.py')
+    for n in rng.sample(xrange(len(big)), min(spec['diff_lines'], len(big))):
+        big[n] = _line(rng, n)
+    yield _file(fixture.big, ''.join(big), 'change')
+
+def function_cases(fixture):
+    """The svnbrowse cases, as (name, function) pairs"""
+    url = fixture.url
+    last = fixture.youngest
+    return [
+        ('list_history', lambda: svnbrowse.list_history(url)),
+        ('list_history limit=50', lambda: svnbrowse.list_history(url, limit=50)),
+        ('list_repository2 huge', lambda: svnbrowse.list_repository2(url, fixture.huge)),
+        ('get_root_info', lambda: svnbrowse.get_root_info(url)),
+        ('highlight_file big', lambda: svnbrowse.highlight_file(url + '/' + fixture.big)),
+        ('highlight_file module', lambda: svnbrowse.highlight_file(
+            url + '/' + fixture.module)),
+        ('list_diff branch', lambda: svnbrowse.list_diff(url, 'trunk', last,
+            fixture.branch, last)),
+        ('list_diff big', lambda: svnbrowse.list_diff(url, fixture.big, last - 1,
+            fixture.big, last)),
+    ]
+
+def handler_cases(fixture):
+    """The handler cases, as (name, url) pairs"""
+    name = fixture.name
+    return [
+        ('GET /', '/'),
+        ('GET repository', '/%s' % name),
+        ('GET huge directory', '/%s/%s' % (name, fixture.huge)),
+        ('GET big file', '/%s/%s' % (name, fixture.big)),
+        ('GET history', '/history/%s' % name),
+        ('GET diff branch', '/diff/%s?fpath=trunk&tpath=%s' % (name, fixture.branch)),
+        ('GET changeset', '/changeset/%s/%d' % (name, fixture.youngest)),
+        ('GET annotate', '/annotate/%s/%s' % (name, fixture.module)),
+    ]
+
+def _percentile(times, p):
+    ordered = sorted(times)
+    return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]
+
+def _measure(run, repeat):
+    """Runs run() once cold and repeat times warm, returns the result of
+    the case
+    """
+    commands = svnbrowse.commands_total()
+    started = time.time()
+    run()
+    cold = time.time() - started
+    cold_commands = svnbrowse.commands_total() - commands
+    commands = svnbrowse.commands_total()
+    times = []
+    for i in xrange(repeat):
+        started = time.time()
+        run()
+        times.append(time.time() - started)
+    warm_commands = svnbrowse.commands_total() - commands
+    times = times or [cold]
+    ms = lambda t: round(t * 1000, 2)
+    return {
+        'cold_ms': ms(cold),
+        'p50_ms': ms(_percentile(times, 50)),
+        'p90_ms': ms(_percentile(times, 90)),
+        'p99_ms': ms(_percentile(times, 99)),
+        'max_ms': ms(max(times)),
+        # kilobytes on linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'svn_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'svn_cold': cold_commands,
+        'svn_warm': round(float(warm_commands) / max(repeat, 1), 2),
+    }
+
+def _isolated(func, *args):
+    """Runs func(*args) in a forked process, returns what it returns (which
+    has to be json serializable) or {'error': traceback} if it raises
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            data = json.dumps(func(*args))
+        except Exception:
+            data = json.dumps({'error': traceback.format_exc()})
+        with os.fdopen(write, 'w') as out:
+            out.write(data)
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as result:
+        data = result.read()
+    os.waitpid(pid, 0)
+    return json.loads(data) if data else {'error': 'the case died'}
+
+def _application(fixture):
+    """Imports the application set up to serve the fixture alone, with the
+    in-process cache and indexes kept with the fixture, whatever the
+    settings say
+    """
+    settings = types.ModuleType('settings')
+    settings.SECURE_COOKIE_KEY = 'benchmark'
+    settings.SITE_TITLE = 'Benchmark'
+    settings.repositories = {fixture.name: fixture.url}
+    settings.auth = lambda username, password: True
+    sys.modules['settings'] = settings
+    import annotate, cache, codesearch, revindex, sessions, treeindex
+    cache.SERVERS = []
+    sessions.SIGNED_TOKENS = True
+    revindex.INDEX_PATH = fixture.file('revindex.sqlite')
+    treeindex.TREE_PATH = fixture.file('tree.sqlite')
+    codesearch.SEARCH_PATH = fixture.file('search.sqlite')
+    annotate.ANNOTATE_PATH = fixture.file('annotate.sqlite')
+    import webservice
+    return webservice
+
+def _index(fixture):
+    """Brings the indexes of the fixture up to date, as the background jobs
+    of a server would have
+    """
+    webservice = _application(fixture)
+    webservice._update_indexes(webservice.settings.repositories)
+
+def _run_function(fixture, func, repeat):
+    return _measure(func, repeat)
+
+def _run_handler(fixture, path, repeat):
+    import tornado.httpserver
+    import tornado.ioloop
+    import tornado.netutil
+    import tornado.web
+    import watcher
+    webservice = _application(fixture)
+    # what the watcher of a running server knows
+    watcher.get_watcher().poll(webservice.settings.repositories)
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    tornado.httpserver.HTTPServer(webservice.application).add_sockets(sockets)
+    thread = threading.Thread(target=tornado.ioloop.IOLoop.instance().start)
+    thread.daemon = True
+    thread.start()
+    cookie = tornado.web.create_signed_value(webservice.settings.SECURE_COOKIE_KEY,
+        'octopy_session_id', 'benchmark|%d' % (time.time() + 3600))
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    def get():
+        connection.request('GET', path, headers={'Cookie': 'octopy_session_id=' + cookie})
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError('%s answered %d' % (path, response.status))
+    return _measure(get, repeat)
+
+def run(fixture, repeat, only=None):
+    """Returns the results of every case against the fixture"""
+    results = []
+    cases = [('function', name, _run_function, func)
+        for name, func in function_cases(fixture)]
+    cases.extend(('handler', name, _run_handler, path)
+        for name, path in handler_cases(fixture))
+    for kind, name, runner, target in cases:
+        if only and only not in name:
+            continue
+        result = _isolated(runner, fixture, target, repeat)
+        result.update({'case': '%s %s' % (fixture.size, name), 'kind': kind})
+        results.append(result)
+        _print(result)
+    return results
+
+def environment():
+    """What the results depend on besides octopy"""
+    def output(cmd):
+        try:
+            return subprocess.check_output(cmd, stderr=subprocess.STDOUT).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    version = output(['svn', '--version', '--quiet'])
+    return {
+        'commit': output(['git', 'rev-parse', '--short', 'HEAD']),
+        'python': platform.python_version(),
+        'svn': version,
+        'backend': svnbrowse.BACKEND,
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'fixture_version': FIXTURE_VERSION,
+    }
+
+_COLUMNS = ('cold_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'peak_rss_kb', 'svn_cold', 'svn_warm')
+
+def _print(result):
+    if 'error' in result:
+        print '%-40s failed\n%s' % (result['case'], result['error'])
+    else:
+        print '%-40s %s' % (result['case'],
+            ' '.join('%12s' % result[column] for column in _COLUMNS))
+    sys.stdout.flush()
+
+def compare(results, baseline, threshold):
+    """Prints the medians of results next to those of baseline, returns
+    the cases whose median regressed by more than threshold
+    """
+    before = dict((r['case'], r) for r in baseline['results'] if 'error' not in r)
+    regressed = []
+    print '\n%-40s %12s %12s %8s' % ('case', 'before', 'p50_ms', 'ratio')
+    for result in results:
+        old = before.get(result['case'])
+        if old is None or 'error' in result:
+            continue
+        ratio = result['p50_ms'] / max(old['p50_ms'], 0.01)
+        flag = ''
+        if ratio > threshold:
+            regressed.append(result['case'])
+            flag = '  REGRESSED'
+        print '%-40s %12s %12s %8.2f%s' % (result['case'], old['p50_ms'],
+            result['p50_ms'], ratio, flag)
+    return regressed
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    sizes = [size.strip() for size in args.sizes.split(',') if size.strip()]
+    for size in sizes:
+        if size not in SIZES:
+            parser.error("unknown size %s" % size)
+    print '%-40s %s' % ('case', ' '.join('%12s' % column for column in _COLUMNS))
+    results = []
+    for size in sizes:
+        fixture = Fixture(size, args.fixtures)
+        if not fixture.exists():
+            print 'building the %s fixture in %s' % (size, fixture.path)
+            fixture.build()
+        results.extend(run(fixture, args.repeat, args.only))
+    report = {'environment': environment(), 'repeat': args.repeat, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressed = compare(results, json.load(baseline), args.threshold)
+        if regressed:
+            sys.exit(1)
@@ -0,0 +1,146 @@
+"""The cache shared by every handler.
+
+get_cache() returns a single process wide client instead of each handler
+connecting to memcache on its own. It talks to the memcached servers listed
+in SERVERS; with no servers configured, or when python-memcached isn't
+installed, it falls back to an in-process cache so octopy still runs (with
+caches private to each process) without a memcached.
+
+Both backends implement the subset of the python-memcached API octopy uses:
+get, set, delete, get_multi, set_multi and get_stats. They count their hits
+and misses, and the memcache one its time, in the current metrics.Timing.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+# memcached servers, an empty list selects the in-process backend
+SERVERS = ['127.0.0.1:11211']
+
+# number of items the in-process backend holds before evicting the least
+# recently used ones
+LOCAL_MAX_ITEMS = 10000
+
+# the expiry argument of set() shadows the time module
+_time = time.time
+
+class MemcacheBackend(object):
+    """Memcached through python-memcached. Its Client keeps one connection
+    per server for each thread using it and reconnects lazily, so a single
+    instance shared by the IOLoop and the svnexec workers reuses the same few
+    connections for the lifetime of the process.
+    """
+    shared = True
+
+    def __init__(self, servers):
+        # the binary pickle protocol, much smaller and faster to load than
+        # the default text one for lists of records
+        self.client = memcache.Client(servers, debug=0, pickleProtocol=2)
+
+    def get(self, key):
+        with metrics.timed('cache'):
+            value = self.client.get(key)
+        metrics.count('miss' if value is None else 'hit')
+        return value
+
+    def set(self, key, value, time=0):
+        with metrics.timed('cache'):
+            return self.client.set(key, value, time=time)
+
+    def delete(self, key):
+        with metrics.timed('cache'):
+            return self.client.delete(key)
+
+    def get_multi(self, keys, key_prefix=''):
+        with metrics.timed('cache'):
+            found = self.client.get_multi(keys, key_prefix)
+        metrics.count('hit', len(found))
+        metrics.count('miss', len(keys) - len(found))
+        return found
+
+    def set_multi(self, mapping, time=0, key_prefix=''):
+        with metrics.timed('cache'):
+            return self.client.set_multi(mapping, time=time, key_prefix=key_prefix)
+
+    def get_stats(self):
+        return self.client.get_stats()
+
+class LocalBackend(object):
+    """An in-process LRU with memcache style expiry times (seconds from now,
+    0 for never). Values are kept as they are rather than pickled, so they
+    must not be modified once cached.
+    """
+    shared = False
+
+    def __init__(self, max_items=None):
+        self.max_items = max_items or LOCAL_MAX_ITEMS
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or (item[1] and item[1] < _time()):
+                self._misses += 1
+                metrics.count('miss')
+                return None
+            self._items[key] = item
+            self._hits += 1
+            metrics.count('hit')
+            return item[0]
+
+    def set(self, key, value, time=0):
+        expires = _time() + time if time else 0
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+        return True
+
+    def get_multi(self, keys, key_prefix=''):
+        found = {}
+        for key in keys:
+            value = self.get(key_prefix + key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set_multi(self, mapping, time=0, key_prefix=''):
+        for key, value in mapping.items():
+            self.set(key_prefix + key, value, time)
+        return []
+
+    def get_stats(self):
+        with self._lock:
+            return [('local', {'curr_items': len(self._items),
+                'get_hits': self._hits, 'get_misses': self._misses})]
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Returns the process wide cache, creating it on first use"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if SERVERS and memcache is not None:
+                    _cache = MemcacheBackend(SERVERS)
+                else:
+                    _cache = LocalBackend()
+    return _cache
@@ -0,0 +1,202 @@
+"""A trigram index of the HEAD contents of every repository.
+
+Each text file is stored (compressed) with the set of three character
+sequences found in it. A query is narrowed down to the files containing all
+of its trigrams with a single index lookup, and only those are scanned for
+matching lines, so searching never touches svn.
+
+update() catches a repository up from the revision it was last indexed at
+using the paths `svn diff --summarize` reports as changed in between.
+"""
+
+import logging
+import sqlite3
+import threading
+import urllib
+import zlib
+
+import svnbrowse
+
+# where the index is stored
+SEARCH_PATH = '/tmp/octopy-search.sqlite'
+
+# top level directories that are not indexed, they mostly hold copies of trunk
+EXCLUDED_DIRS = ('tags', 'branches')
+
+# files larger than this many bytes are not indexed
+MAX_FILE_SIZE = 512 * 1024
+
+# number of matching files returned by a search
+MAX_RESULTS = 50
+
+# number of matching lines shown per file
+MAX_LINES = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    repo TEXT NOT NULL,
+    path TEXT NOT NULL,
+    content BLOB NOT NULL,
+    UNIQUE (repo, path)
+);
+CREATE TABLE IF NOT EXISTS trigrams (
+    trigram TEXT NOT NULL,
+    file INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trigrams_trigram ON trigrams (trigram, file);
+CREATE INDEX IF NOT EXISTS trigrams_file ON trigrams (file);
+CREATE TABLE IF NOT EXISTS indexed (
+    repo TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL
+);
+"""
+
+def _trigrams(text):
+    return set(text[i:i + 3] for i in xrange(len(text) - 2)
+        if '\n' not in text[i:i + 3])
+
+def _excluded(path):
+    return path.strip('/').split('/')[0] in EXCLUDED_DIRS
+
+class SearchIndex(object):
+    """The search index. Safe to share between threads, each thread gets its
+    own connection.
+    """
+    def __init__(self, path=None):
+        self.path = path or SEARCH_PATH
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def revision(self, repo):
+        """Returns the revision repo was last indexed at, 0 if never"""
+        row = self.db.execute('SELECT revision FROM indexed WHERE repo = ?',
+            (repo,)).fetchone()
+        return row[0] if row else 0
+
+    def update(self, repo, url):
+        """Brings the index of repo up to its youngest revision"""
+        with self._lock:
+            last = self.revision(repo)
+            youngest = svnbrowse.youngest(url)
+            if last >= youngest:
+                return
+            if not last:
+                self._add_tree(repo, url, '', youngest)
+            else:
+                for change in svnbrowse.list_changesets(url, last, youngest):
+                    # the same form as the paths _add_tree gets from listings
+                    path = urllib.unquote(change['path'][len(url):]).strip('/')
+                    if _excluded(path):
+                        continue
+                    if change['item'] == 'deleted':
+                        self._remove(repo, path)
+                    elif change['kind'] == 'dir':
+                        if change['item'] == 'replaced':
+                            # nothing of the old directory is left
+                            self._remove(repo, path)
+                        if change['item'] in ('added', 'replaced'):
+                            self._add_tree(repo, url, path, youngest)
+                    elif change['item'] in ('added', 'modified', 'replaced'):
+                        self._add_file(repo, url, path, youngest)
+            with self.db as db:
+                db.execute('INSERT OR REPLACE INTO indexed VALUES (?, ?)',
+                    (repo, youngest))
+
+    def update_all(self, repositories):
+        """Updates every repository in the name -> url dict, logging failures"""
+        for name, url in sorted(repositories.items()):
+            try:
+                self.update(name, url)
+            except Exception:
+                logging.exception("failed to update the search index of %s", name)
+
+    def _add_tree(self, repo, url, path, rev):
+        if not path:
+            for entry in svnbrowse.list_repository(url, '', rev=rev):
+                if entry['kind'] == 'dir' and not _excluded(entry['name']):
+                    self._add_tree(repo, url, entry['name'], rev)
+                elif entry['kind'] == 'file':
+                    self._add_file(repo, url, entry['name'], rev, entry['size'])
+            return
+        for entry in svnbrowse.list_repository(url, path, rev=rev, recursive=True):
+            if entry['kind'] == 'file':
+                self._add_file(repo, url, path + '/' + entry['name'], rev, entry['size'])
+
+    def _add_file(self, repo, url, path, rev, size=None):
+        if size is not None and int(size) > MAX_FILE_SIZE:
+            return self._remove(repo, path)
+        content = svnbrowse.cat_file(url + '/' + path, rev)
+        if len(content) > MAX_FILE_SIZE or '\0' in content[:8192]:
+            return self._remove(repo, path)
+        trigrams = _trigrams(content.decode('utf-8', 'replace').lower())
+        with self.db as db:
+            self._delete(db, repo, path)
+            cursor = db.execute('INSERT INTO files (repo, path, content) VALUES (?, ?, ?)',
+                (repo, path, sqlite3.Binary(zlib.compress(content))))
+            db.executemany('INSERT INTO trigrams VALUES (?, ?)',
+                ((trigram, cursor.lastrowid) for trigram in trigrams))
+
+    def _remove(self, repo, path):
+        with self.db as db:
+            self._delete(db, repo, path)
+            # path may have been a directory
+            for (file_id,) in db.execute('SELECT id FROM files WHERE repo = ?'
+                    ' AND path >= ? AND path < ?', (repo, path + '/', path + '0')).fetchall():
+                db.execute('DELETE FROM trigrams WHERE file = ?', (file_id,))
+                db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def _delete(self, db, repo, path):
+        row = db.execute('SELECT id FROM files WHERE repo = ? AND path = ?',
+            (repo, path)).fetchone()
+        if row:
+            db.execute('DELETE FROM trigrams WHERE file = ?', row)
+            db.execute('DELETE FROM files WHERE id = ?', row)
+
+    def search(self, query, repos=None, limit=None):
+        """Returns the files containing query (case insensitively) as dicts
+        of repo, path and lines, a list of (line number, line) matches.
+        `repos` limits the search to those repository names.
+        """
+        needle = query.lower()
+        trigrams = list(_trigrams(needle))
+        if not trigrams:
+            return []
+        limit = limit or MAX_RESULTS
+        sql = ('SELECT repo, path, content FROM files WHERE id IN'
+            ' (SELECT file FROM trigrams WHERE trigram IN (%s)'
+            ' GROUP BY file HAVING COUNT(*) = ?)' % ','.join('?' * len(trigrams)))
+        args = trigrams + [len(trigrams)]
+        if repos:
+            sql += ' AND repo IN (%s)' % ','.join('?' * len(repos))
+            args.extend(repos)
+        sql += ' ORDER BY repo, path'
+        results = []
+        for repo, path, content in self.db.execute(sql, args):
+            text = zlib.decompress(content).decode('utf-8', 'replace')
+            lines = [(number, line) for number, line in enumerate(text.splitlines(), 1)
+                if needle in line.lower()]
+            if lines:
+                results.append({'repo': repo, 'path': path, 'lines': lines[:MAX_LINES],
+                    'matches': len(lines)})
+                if len(results) >= limit:
+                    break
+        return results
+
+_index = None
+
+def get_index():
+    """Returns the process wide search index, opening it on first use"""
+    global _index
+    if _index is None:
+        _index = SearchIndex()
+    return _index
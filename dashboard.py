@@ -0,0 +1,135 @@
+"""The data behind the front page repository list.
+
+Building it takes an `svn info` (and, for repositories the revision index
+doesn't know yet, an `svn log`) per repository, far too slow to do while a
+user waits on a server with hundreds of repositories. Instead each process
+keeps a snapshot of the last good info of every repository and refreshes it
+in the background, at most REFRESH_CONCURRENCY repositories at a time so the
+svnexec workers stay available for page requests.
+
+The snapshot is also written to the shared cache, which is where a freshly
+started process gets its first one from. Repositories that have never been
+refreshed show up with just their name until their info arrives.
+
+When several processes serve octopy only one of them refreshes the info;
+the others don't run any svn for it and reread the snapshot from the shared
+cache every FOLLOW_INTERVAL seconds instead.
+"""
+
+import logging
+import time
+from collections import deque
+
+import cache
+import revindex
+import svnbrowse
+import svnexec
+
+# seconds after which the info of a repository is refreshed even though no
+# commit to it was noticed
+REFRESH_INTERVAL = 3600
+
+# seconds the info of a repository is kept in the shared cache, 0 for as
+# long as it lasts since commits trigger a refresh (see watcher)
+TTL = 0
+
+# number of repositories refreshed at once
+REFRESH_CONCURRENCY = 4
+
+# seconds between rereads of the snapshot by processes not refreshing it
+FOLLOW_INTERVAL = 10
+
+class Dashboard(object):
+    """Must be used from the IOLoop thread. With refreshing off it only
+    follows the snapshot in the shared cache.
+    """
+    def __init__(self, concurrency=None, refreshing=True):
+        self.concurrency = concurrency or REFRESH_CONCURRENCY
+        self.refreshing = refreshing
+        self.repos = {}
+        self.refreshed = {}
+        self._queue = deque()
+        self._pending = set()
+        self._rerun = {}
+        self._running = 0
+        self._loaded = 0
+
+    def get_repos(self, repositories):
+        """Returns the info of every repository in the name -> url dict as
+        of the last refresh, queueing the refresh of those that are stale
+        """
+        now = time.time()
+        if not self._loaded or (not self.refreshing and
+                self._loaded < now - FOLLOW_INTERVAL):
+            # seed the snapshot from the shared cache, the age of those
+            # entries is unknown so they are refreshed right away
+            self._loaded = now
+            self.repos.update(cache.get_cache().get_multi(
+                [str(name) for name in repositories], 'repo_list_'))
+        if self.refreshing:
+            stale = dict((name, url) for name, url in repositories.items()
+                if self.refreshed.get(name, 0) < now - REFRESH_INTERVAL)
+            self.refresh(stale)
+        return [self.repos.get(name) or {'name': name, 'weburl': name + '/'}
+            for name in sorted(repositories)]
+
+    def refresh(self, repositories):
+        """Queues the refresh of the repositories in the name -> url dict"""
+        if not self.refreshing:
+            return
+        for name, url in sorted(repositories.items()):
+            if name in self._pending:
+                # it may have been read before whatever prompted this
+                self._rerun[name] = url
+            else:
+                self._pending.add(name)
+                self._queue.append((name, url))
+        self._start()
+
+    def update(self, name, info):
+        """Replaces the info of a repository, for when it was just fetched"""
+        self.repos[name] = info
+        self.refreshed[name] = time.time()
+        cache.get_cache().set('repo_list_%s' % str(name), info, time=TTL)
+
+    def _start(self):
+        while self._queue and self._running < self.concurrency:
+            name, url = self._queue.popleft()
+            self._running += 1
+            svnexec.get_pool().submit(name, _fetch, (name, url), timeout=0,
+                callback=lambda info, name=name: self._finished(name, info))
+
+    def _finished(self, name, info):
+        self._running -= 1
+        self._pending.discard(name)
+        if info is not None:
+            self.repos[name] = info
+            self.refreshed[name] = time.time()
+        else:
+            # try again in a minute
+            self.refreshed[name] = time.time() - REFRESH_INTERVAL + 60
+        if name in self._rerun:
+            self.refresh({name: self._rerun.pop(name)})
+        self._start()
+
+def _fetch(name, url):
+    """Runs on an svnexec worker. Returns None on failure so the previous
+    info stays in use.
+    """
+    index = revindex.get_index()
+    try:
+        info = svnbrowse.get_root_info(url, lambda rev: index.entry(name, rev))
+    except Exception:
+        logging.exception("failed to refresh the info of %s", name)
+        return None
+    cache.get_cache().set('repo_list_%s' % str(name), info, time=TTL)
+    return info
+
+_dashboard = None
+
+def get_dashboard():
+    """Returns the process wide dashboard, creating it on first use"""
+    global _dashboard
+    if _dashboard is None:
+        _dashboard = Dashboard()
+    return _dashboard
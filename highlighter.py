@@ -0,0 +1,126 @@
+"""Turns source into highlighted html.
+
+Highlighting is the one CPU heavy thing octopy does, and in the threads of
+the serving process it competes with the IOLoop for the interpreter. It runs
+in a pool of PROCESSES processes instead, started with the serving process,
+while the calling svnexec worker waits without holding anything up.
+
+Lexers are made once per lexer class, which the file name picks (so
+CMakeLists.txt and notes.txt don't share one), and formatters once per set
+of options, in each process. Sources with more than PLAIN_LINES lines or
+PLAIN_BYTES bytes aren't lexed at all: they get escaped as plain text in the
+same table as highlighted ones, which costs next to nothing. So does a
+source that takes longer than TIMEOUT seconds to come back from the pool.
+The pool is terminated then, rather than left busy with it, and highlight()
+starts a new one; sources still waiting for the old pool come back plain
+once their own TIMEOUT is up.
+"""
+
+import logging
+import multiprocessing
+import signal
+import threading
+from os.path import basename
+
+import pygments
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import find_lexer_class_for_filename, get_lexer_by_name, \
+    TextLexer
+from pygments.util import ClassNotFound
+
+import metrics
+
+# number of highlighting processes per serving process, 0 to highlight in
+# the calling thread
+PROCESSES = 2
+
+# sources longer than this are shown as plain text
+PLAIN_LINES = 20000
+PLAIN_BYTES = 512 * 1024
+
+# seconds to wait for the pool before showing a source as plain text
+TIMEOUT = 30
+
+_lexers = {}
+_formatters = {}
+
+def _lexer(filename, name):
+    """Returns the lexer named name, or the one for filename, a TextLexer if
+    there is none
+    """
+    if name:
+        lexer = _lexers.get(name)
+        if lexer is None:
+            try:
+                lexer = get_lexer_by_name(name)
+            except ClassNotFound:
+                lexer = TextLexer()
+            _lexers[name] = lexer
+        return lexer
+    cls = find_lexer_class_for_filename(basename(filename or '')) or TextLexer
+    lexer = _lexers.get(cls)
+    if lexer is None:
+        lexer = _lexers[cls] = cls()
+    return lexer
+
+def _formatter(linenos):
+    formatter = _formatters.get(linenos)
+    if formatter is None:
+        formatter = _formatters[linenos] = HtmlFormatter(linenos=linenos)
+    return formatter
+
+def plain(source, linenos=True):
+    """Returns source escaped, in the markup of a highlighted one"""
+    return pygments.highlight(source, TextLexer(), _formatter(linenos))
+
+def _render(source, filename, name, linenos):
+    if len(source) > PLAIN_BYTES or source.count('\n') > PLAIN_LINES:
+        return plain(source, linenos)
+    return pygments.highlight(source, _lexer(filename, name), _formatter(linenos))
+
+def _init_process():
+    # the serving process handles the signals for its pool, which goes away
+    # with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def start():
+    """Starts the pool of the serving process. Best called before it starts
+    any threads, forking the pool from one of them is asking for trouble;
+    highlight() starts it on first use otherwise.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None and PROCESSES:
+            _pool = multiprocessing.Pool(PROCESSES, _init_process)
+    return _pool
+
+def highlight(source, filename=None, name=None, linenos=True):
+    """Returns source as html, highlighted with the lexer named name or else
+    the one for filename. Blocks until it is done, call it from a worker.
+    """
+    pool = start()
+    with metrics.timed('highlight'):
+        if pool is None:
+            return _render(source, filename, name, linenos)
+        try:
+            return pool.apply_async(_render, (source, filename, name, linenos)).get(TIMEOUT)
+        except multiprocessing.TimeoutError:
+            logging.warning("highlighting %s took more than %ds, showing it plain",
+                filename or name, TIMEOUT)
+            _replace(pool)
+            return plain(source, linenos)
+
+def _replace(pool):
+    """Terminates pool, stuck on a source, unless it has been already. The
+    next highlight() starts another one.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not pool:
+            return
+        _pool = None
+    pool.terminate()
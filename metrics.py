@@ -0,0 +1,261 @@
+"""Where the time of each request goes.
+
+Each request gets a Timing, made current for everything that runs on its
+behalf: its own callbacks on the IOLoop (through a tornado StackContext) and
+the svnexec calls it makes, which collect a Timing of their own on the
+worker and add it to the request's when they finish. Code that is worth
+accounting for wraps itself in timed(part):
+
+    svn        waiting for svn to write its output or exit, or in the
+               Subversion bindings
+    parse      holding svn output, which is mostly parsing it
+    highlight  in Pygments
+    render     rendering templates
+    cache      talking to memcache
+
+A part is timed exclusive of the parts timed within it, so the svn time
+spent while parsing isn't counted twice. Calls running concurrently on the
+svnexec workers each add their own time, so the parts of a request can add
+up to more than its total. count('hit') and count('miss') keep the cache
+hits and misses.
+
+The parts are sent with every page as a Server-Timing header and kept in
+histograms per handler and repository for /metrics. Each worker process
+publishes its histograms to the shared cache every PUBLISH_INTERVAL seconds,
+so /metrics can report all of them whichever worker it hits.
+
+profile() samples the stacks of every thread of the process for a while,
+for when the parts say where the time goes but not why.
+"""
+
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# the parts of a request, in the order they are reported
+PARTS = ('svn', 'parse', 'highlight', 'render', 'cache')
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# seconds between publications of the histograms to the shared cache
+PUBLISH_INTERVAL = 10
+
+# addresses allowed to read /metrics and run the profiler
+METRICS_ADDRESSES = ('127.0.0.1', '::1')
+
+# whether /profile may be used at all
+PROFILING = False
+
+# seconds between stack samples while profiling
+PROFILE_INTERVAL = 0.005
+
+_local = threading.local()
+
+class Timing(object):
+    """The time a request, or a call made for it, spent in each part"""
+    def __init__(self):
+        self.started = time.time()
+        self.parts = {}
+        self.counts = {}
+
+    def add(self, other):
+        for part, seconds in other.parts.items():
+            self.parts[part] = self.parts.get(part, 0) + seconds
+        for name, count in other.counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def header(self):
+        """The value of the Server-Timing header"""
+        metrics = ['%s;dur=%.1f' % (part, self.parts[part] * 1000)
+            for part in PARTS if part in self.parts]
+        metrics.append('total;dur=%.1f' % ((time.time() - self.started) * 1000))
+        if self.counts:
+            metrics.append('cache;desc="%d hits, %d misses"' % (
+                self.counts.get('hit', 0), self.counts.get('miss', 0)))
+        return ', '.join(metrics)
+
+def current():
+    """Returns the Timing of the current thread, None if there is none"""
+    return getattr(_local, 'timing', None)
+
+@contextmanager
+def activate(timing):
+    """Makes timing the current one for the block"""
+    previous = current(), getattr(_local, 'stack', None)
+    _local.timing, _local.stack = timing, []
+    try:
+        yield
+    finally:
+        _local.timing, _local.stack = previous
+
+@contextmanager
+def timed(part):
+    """Adds the time spent in the block, less that of the parts timed
+    within it, to part of the current Timing
+    """
+    timing = current()
+    if timing is None:
+        yield
+        return
+    stack = _local.stack
+    # the time taken by the parts within, added up as they finish
+    inner = [0]
+    stack.append(inner)
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        if stack and stack[-1] is inner:
+            stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+        timing.parts[part] = timing.parts.get(part, 0) + elapsed - inner[0]
+
+def add(part, seconds):
+    """Adds seconds, measured by the caller, to part of the current Timing
+    as if they had been timed()
+    """
+    timing = current()
+    if timing is not None:
+        stack = _local.stack
+        if stack:
+            stack[-1][0] += seconds
+        timing.parts[part] = timing.parts.get(part, 0) + seconds
+
+def count(name, n=1):
+    """Adds n to counter name of the current Timing"""
+    timing = current()
+    if timing is not None:
+        timing.counts[name] = timing.counts.get(name, 0) + n
+
+class Histogram(object):
+    """Counts of observations falling under each of BUCKETS, the last count
+    being the total, and their sum
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.counts[-1] += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+class Registry(object):
+    """The histograms of the requests served by a process, per handler and
+    repository. Must be used from the IOLoop thread.
+    """
+    def __init__(self):
+        # (handler, repository) -> {'total' or part: Histogram}
+        self.histograms = {}
+        # (handler, repository) -> {'hit': n, 'miss': n}
+        self.counts = {}
+
+    def record(self, handler, repo, timing):
+        key = (handler, repo or '')
+        histograms = self.histograms.setdefault(key, {})
+        histograms.setdefault('total', Histogram()).observe(time.time() - timing.started)
+        for part, seconds in timing.parts.items():
+            histograms.setdefault(part, Histogram()).observe(seconds)
+        counts = self.counts.setdefault(key, {})
+        for name, n in timing.counts.items():
+            counts[name] = counts.get(name, 0) + n
+
+    def merge(self, other):
+        for key, histograms in other.histograms.items():
+            mine = self.histograms.setdefault(key, {})
+            for part, histogram in histograms.items():
+                mine.setdefault(part, Histogram()).merge(histogram)
+        for key, counts in other.counts.items():
+            mine = self.counts.setdefault(key, {})
+            for name, n in counts.items():
+                mine[name] = mine.get(name, 0) + n
+
+    def exposition(self):
+        """The histograms in the Prometheus text format"""
+        lines = ['# TYPE octopy_request_seconds histogram',
+            '# TYPE octopy_cache_requests_total counter']
+        for (handler, repo), histograms in sorted(self.histograms.items()):
+            for part, histogram in sorted(histograms.items()):
+                labels = 'handler="%s",repo="%s",part="%s"' % (handler,
+                    _escape(repo), part)
+                for bound, n in zip(BUCKETS, histogram.counts):
+                    lines.append('octopy_request_seconds_bucket{%s,le="%g"} %d'
+                        % (labels, bound, n))
+                lines.append('octopy_request_seconds_bucket{%s,le="+Inf"} %d'
+                    % (labels, histogram.counts[-1]))
+                lines.append('octopy_request_seconds_sum{%s} %f' % (labels, histogram.sum))
+                lines.append('octopy_request_seconds_count{%s} %d'
+                    % (labels, histogram.counts[-1]))
+        for (handler, repo), counts in sorted(self.counts.items()):
+            for name, n in sorted(counts.items()):
+                lines.append('octopy_cache_requests_total{handler="%s",repo="%s",result="%s"} %d'
+                    % (handler, _escape(repo), name, n))
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+_registry = None
+
+def get_registry():
+    """Returns the process wide registry, creating it on first use"""
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+def publish(mc, worker):
+    """Stores the registry of this process, that of worker number worker,
+    in the shared cache
+    """
+    mc.set('metrics_%d' % worker, get_registry(), time=PUBLISH_INTERVAL * 6)
+
+def collect(mc, workers, worker):
+    """Returns the registry of all the workers together: this one's as it
+    is and those of the others as last published
+    """
+    registry = Registry()
+    registry.merge(get_registry())
+    others = [str(i) for i in xrange(workers) if i != worker]
+    for published in mc.get_multi(others, 'metrics_').values():
+        registry.merge(published)
+    return registry
+
+def profile(seconds, interval=None):
+    """Samples the stacks of the threads of this process every interval
+    seconds for seconds seconds. Returns the samples in the collapsed
+    format flame graph tools read, one 'thread;outer;...;inner count' line
+    per distinct stack. Blocks, run it on a thread of its own.
+    """
+    interval = interval or PROFILE_INTERVAL
+    me = threading.current_thread().ident
+    samples = {}
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                    code.co_filename.rsplit('/', 1)[-1], frame.f_lineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+            key = ';'.join(stack)
+            samples[key] = samples.get(key, 0) + 1
+        time.sleep(interval)
+    return ''.join('%s %d\n' % item for item in
+        sorted(samples.items(), key=lambda item: -item[1]))
@@ -0,0 +1,73 @@
+"""Gathers the backend calls that go into a single page.
+
+A handler creates a PageData for the request and yields page.call(...)
+instead of svnexec.Call(...): the same call asked for twice while building
+the page (say the listing of a directory, needed both for the page and for
+its README) only runs once, and the calls yielded together in a list run
+concurrently as usual. log() then reports how many calls the page made and
+how many svn processes they started, which is what decides how fast the
+page is.
+"""
+
+import logging
+import time
+
+import svnexec
+
+class PageData(object):
+    """The backend calls made for one page of repository `repo`. Must be
+    used from the IOLoop thread.
+    """
+    def __init__(self, repo, page):
+        self.repo = repo
+        self.page = page
+        self.started = time.time()
+        # calls that ran, answered from the memo, and svn processes started
+        self.calls = 0
+        self.hits = 0
+        self.commands = 0
+        self._results = {}
+        self._waiting = {}
+
+    def call(self, func, *args, **kwargs):
+        """Yield point for func(*args, **kwargs) on the svnexec pool, run
+        at most once per page
+        """
+        return _Memoized(self, func, *args, **kwargs)
+
+    def _submit(self, call, callback):
+        try:
+            key = (call.func, call.args, tuple(sorted(call.kwargs.items())))
+            hash(key)
+        except TypeError:
+            # unhashable arguments, run it without remembering the result
+            key = object()
+        if key in self._results:
+            self.hits += 1
+            callback(self._results[key])
+        elif key in self._waiting:
+            self.hits += 1
+            self._waiting[key].append(callback)
+        else:
+            self.calls += 1
+            self._waiting[key] = [callback]
+            svnexec.get_pool().submit(self.repo, call.func, call.args, call.kwargs,
+                call.timeout, lambda result: self._finished(key, result), counter=self)
+
+    def _finished(self, key, result):
+        self._results[key] = result
+        for callback in self._waiting.pop(key):
+            callback(result)
+
+    def log(self):
+        logging.info("%s: %d svn calls (%d memoized), %d svn processes, %.1fms",
+            self.page, self.calls, self.hits, self.commands,
+            (time.time() - self.started) * 1000)
+
+class _Memoized(svnexec.Call):
+    def __init__(self, page, func, *args, **kwargs):
+        svnexec.Call.__init__(self, page.repo, func, *args, **kwargs)
+        self.page = page
+
+    def submit(self, callback):
+        self.page._submit(self, callback)
@@ -0,0 +1,128 @@
+"""Compact records for the entries of logs and listings.
+
+A log or the listing of a large directory is tens of thousands of entries,
+each kept in memory, pickled into the cache and handed to a template.
+Records keep their fields in __slots__ instead of a dict per entry, pickle
+as a plain tuple of their values, and format their dates only when a
+template asks for them. They can still be read like the dicts they replace,
+entry['name'] and entry.get('kind') work as before.
+"""
+
+from operator import itemgetter
+
+import svnbrowse
+
+class Record(object):
+    """Base of the records, subclasses list their fields in __slots__"""
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for field in self.__slots__[len(args):]:
+            setattr(self, field, kwargs.get(field))
+        for field, value in zip(self.__slots__, args):
+            setattr(self, field, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+            ', '.join('%s=%r' % (field, getattr(self, field)) for field in self.__slots__))
+
+class Dated(Record):
+    """A record with the svn date of a commit in orig_date"""
+    __slots__ = ()
+
+    @property
+    def date(self):
+        """orig_date formatted for display"""
+        return svnbrowse.format_date(self.orig_date)
+
+class ChangedPath(tuple):
+    """A path changed by a commit: a (path, kind, action) tuple, as there
+    are many of them, that can be read by key like the records
+    """
+    __slots__ = ()
+    _fields = ('path', 'kind', 'action')
+
+    def __new__(cls, path, kind, action):
+        return tuple.__new__(cls, (path, kind, action))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    path = property(itemgetter(0))
+    kind = property(itemgetter(1))
+    action = property(itemgetter(2))
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                key = self._fields.index(key)
+            except ValueError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+class LogEntry(Dated):
+    """An entry of the log, paths is a list of ChangedPath"""
+    __slots__ = ('revision', 'author', 'orig_date', 'message', 'paths')
+
+    def __getstate__(self):
+        return (self.revision, self.author, self.orig_date, self.message,
+            tuple(tuple(path) for path in self.paths or ()))
+
+    def __setstate__(self, state):
+        self.revision, self.author, self.orig_date, self.message, paths = state
+        self.paths = [ChangedPath(*path) for path in paths]
+
+class ListEntry(Dated):
+    """An entry of svnbrowse.list_repository"""
+    __slots__ = ('kind', 'name', 'revision', 'author', 'orig_date', 'size', 'webpath')
+
+class DirEntry(Dated):
+    """An entry of a directory listing. size and files (the number of files
+    below a directory) are only known when the listing comes from the tree
+    summary.
+    """
+    __slots__ = ('kind', 'name', 'fullpath', 'revision', 'orig_date', 'author',
+        'size', 'files', 'message', 'uuid')
+
+    def webpath(self, repo, revision=None):
+        """The path of the entry's page, pinned to revision if given"""
+        return '/' + repo + self.fullpath + ('@%d' % revision if revision else '')
+
+    def json(self, repo, revision=None):
+        """The entry as served to the listing script"""
+        return {'kind': self.kind, 'name': self.name,
+            'webpath': self.webpath(repo, revision),
+            'revision': self.revision, 'date': self.date, 'author': self.author,
+            'size': self.size, 'files': self.files, 'message': self.message}
@@ -0,0 +1,202 @@
+"""Caches highlighted file renders.
+
+The contents of a path at a given revision never change, so a render keyed
+on the repository uuid, the path and its last changed revision stays valid
+forever. Renders are kept in a size bounded in-process LRU and, behind it,
+in a shared store (the memcache behind cache.get_cache(), or a directory when
+DISK_PATH is set) that every process serving octopy can use.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+
+import cache
+import metrics
+
+# bytes of renders kept in each process
+MAX_LOCAL_BYTES = 64 * 1024 * 1024
+
+# directory to use as the shared store instead of memcache
+DISK_PATH = None
+
+# bytes of renders kept in DISK_PATH, the least recently used go first
+MAX_DISK_BYTES = 1024 * 1024 * 1024
+
+# memcache refuses items larger than this
+MAX_SHARED_ITEM = 1000000
+
+class LRUCache(object):
+    """A dict-like cache holding at most max_bytes worth of string values,
+    evicting the least recently used ones first
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+class MemcacheStore(object):
+    def __init__(self, client=None):
+        self.client = client or cache.get_cache()
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value):
+        if len(value) <= MAX_SHARED_ITEM:
+            self.client.set(key, value)
+
+class DiskStore(object):
+    """Renders in files of a directory, which several processes can share.
+    A file's mtime is when it was last used: reading it touches it, and
+    once the files add up to more than max_bytes the least recently used
+    are deleted until they take up no more than EVICT_TO of it.
+    """
+    EVICT_TO = 0.9
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes or MAX_DISK_BYTES
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        # what this process believes the directory holds, corrected by
+        # every eviction since other processes write to it too
+        self.size = sum(size for _, size, _ in self._files())
+
+    def _files(self):
+        """Yields (name, size, mtime) of the stored renders"""
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                # still being written
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                # evicted by another process
+                continue
+            yield name, st.st_size, st.st_mtime
+
+    def get(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            metrics.count('miss')
+            return None
+        metrics.count('hit')
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        # write then rename so readers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        os.rename(tmp, os.path.join(self.path, key))
+        with self._lock:
+            self.size += len(value)
+            if self.size <= self.max_bytes:
+                return
+            self._evict()
+
+    def _evict(self):
+        files = sorted(self._files(), key=lambda f: f[2])
+        size = sum(f[1] for f in files)
+        for name, file_size, _ in files:
+            if size <= self.max_bytes * self.EVICT_TO:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+            size -= file_size
+        self.size = size
+
+class RenderCache(object):
+    def __init__(self, shared=None, max_bytes=None):
+        self.local = LRUCache(max_bytes or MAX_LOCAL_BYTES)
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            metrics.count('hit')
+        elif self.shared is not None:
+            try:
+                stored = self.shared.get(key)
+            except Exception:
+                logging.exception("render cache lookup of %s failed", key)
+                stored = None
+            if stored is not None:
+                value = zlib.decompress(stored).decode('utf-8')
+                self.local.set(key, value)
+        else:
+            metrics.count('miss')
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            try:
+                self.shared.set(key, zlib.compress(value))
+            except Exception:
+                logging.exception("render cache store of %s failed", key)
+
+def key(uuid, path, revision, kind='file'):
+    """Returns the cache key of the `kind` render of path@revision"""
+    parts = [part.encode('utf-8') if isinstance(part, unicode) else str(part)
+        for part in (uuid, path, revision)]
+    return 'render_%s_%s' % (kind, hashlib.sha1('\0'.join(parts)).hexdigest())
+
+_cache = None
+
+def get_cache():
+    """Returns the process wide render cache, creating it on first use"""
+    global _cache
+    if _cache is None:
+        if DISK_PATH:
+            shared = DiskStore(DISK_PATH, MAX_DISK_BYTES)
+        elif cache.get_cache().shared:
+            shared = MemcacheStore()
+        else:
+            # the in-process fallback would only duplicate the local LRU
+            shared = None
+        _cache = RenderCache(shared)
+    return _cache
@@ -0,0 +1,252 @@
+"""A local SQLite index of the log of every repository.
+
+Revisions never change once committed (revprops aside), so the log only ever
+has to be read from svn once. update() runs `svn log --xml -v` from the last
+indexed revision onwards and stores the entries and their changed paths;
+history and message lookups are then answered from the index instead of
+rescanning the log through svn.
+
+The lines added and removed by each revision are stored the same way, the
+first time its changeset page asks for them.
+
+Histories from the index do not follow copies the way `svn log` does: the
+history of a branch starts at the revision it was created.
+"""
+
+import logging
+import sqlite3
+import threading
+
+import records
+import svnbrowse
+
+# where the index is stored
+INDEX_PATH = '/tmp/octopy-revindex.sqlite'
+
+# number of revisions fetched per `svn log` call while catching up
+CHUNK_SIZE = 1000
+
+# seconds between background runs of the indexer
+INDEX_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS revisions (
+    repo TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    author TEXT NOT NULL,
+    date TEXT NOT NULL,
+    message TEXT,
+    PRIMARY KEY (repo, revision)
+);
+CREATE INDEX IF NOT EXISTS revisions_author ON revisions (repo, author, revision);
+CREATE TABLE IF NOT EXISTS changed_paths (
+    repo TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    kind TEXT,
+    action TEXT
+);
+CREATE INDEX IF NOT EXISTS changed_paths_path ON changed_paths (repo, path, revision);
+CREATE INDEX IF NOT EXISTS changed_paths_revision ON changed_paths (repo, revision);
+CREATE TABLE IF NOT EXISTS diffstats (
+    repo TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    kind TEXT,
+    item TEXT,
+    props TEXT,
+    added INTEGER NOT NULL,
+    removed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS diffstats_revision ON diffstats (repo, revision);
+CREATE TABLE IF NOT EXISTS diffstat_revisions (
+    repo TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    PRIMARY KEY (repo, revision)
+);
+CREATE TABLE IF NOT EXISTS indexed (
+    repo TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL
+);
+"""
+
+class RevisionIndex(object):
+    """The log index. Safe to share between threads, each thread gets its
+    own connection.
+    """
+    def __init__(self, path=None):
+        self.path = path or INDEX_PATH
+        self._local = threading.local()
+        self._updating = set()
+        self._lock = threading.Lock()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def revision(self, repo):
+        """Returns the last revision indexed for repo, 0 if none"""
+        row = self.db.execute('SELECT revision FROM indexed WHERE repo = ?',
+            (repo,)).fetchone()
+        return row[0] if row else 0
+
+    def update(self, repo, url):
+        """Indexes the revisions of repo committed since the last update.
+        Returns the number of revisions added.
+        """
+        with self._lock:
+            if repo in self._updating:
+                return 0
+            self._updating.add(repo)
+        try:
+            added = 0
+            last = self.revision(repo)
+            youngest = svnbrowse.youngest(url)
+            while last < youngest:
+                upto = min(last + CHUNK_SIZE, youngest)
+                entries = svnbrowse.iter_history(url, '%d:%d' % (last + 1, upto))
+                added += self._store(repo, entries, upto)
+                last = upto
+            return added
+        finally:
+            with self._lock:
+                self._updating.discard(repo)
+
+    def _store(self, repo, entries, upto):
+        count = 0
+        with self.db as db:
+            for entry in entries:
+                revision = int(entry['revision'])
+                db.execute('INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?)',
+                    (repo, revision, entry['author'] or '', entry['orig_date'],
+                    entry['message']))
+                db.execute('DELETE FROM changed_paths WHERE repo = ? AND revision = ?',
+                    (repo, revision))
+                db.executemany('INSERT INTO changed_paths VALUES (?, ?, ?, ?, ?)',
+                    [(repo, revision, p['path'], p['kind'], p['action'])
+                        for p in entry['paths']])
+                count += 1
+            db.execute('INSERT OR REPLACE INTO indexed VALUES (?, ?)', (repo, upto))
+        return count
+
+    def update_all(self, repositories):
+        """Updates every repository in the name -> url dict, logging failures"""
+        for name, url in sorted(repositories.items()):
+            try:
+                added = self.update(name, url)
+                if added:
+                    logging.info("indexed %d revisions of %s", added, name)
+            except Exception:
+                logging.exception("failed to index %s", name)
+
+    def history(self, repo, path='/', start=None, limit=None, author=None):
+        """Returns the log entries touching path, newest first, in the same
+        form as svnbrowse.list_history. `start` is the newest revision to
+        include.
+        """
+        query, args = self._history_query(repo, path, author)
+        if start is not None:
+            query += ' AND r.revision <= ?'
+            args.append(int(start))
+        query += ' ORDER BY r.revision DESC'
+        if limit:
+            query += ' LIMIT ?'
+            args.append(int(limit))
+        return self._entries(repo, self.db.execute(query, args).fetchall())
+
+    def newer(self, repo, path, start, limit, author=None):
+        """Returns up to `limit` entries touching path that are newer than
+        `start`, oldest first
+        """
+        query, args = self._history_query(repo, path, author)
+        query += ' AND r.revision > ? ORDER BY r.revision ASC LIMIT ?'
+        args.extend([int(start), int(limit)])
+        return self._entries(repo, self.db.execute(query, args).fetchall())
+
+    def _history_query(self, repo, path, author):
+        path = '/' + path.strip('/')
+        query = 'SELECT r.revision, r.author, r.date, r.message FROM revisions r WHERE r.repo = ?'
+        args = [repo]
+        if path != '/':
+            # the path itself or anything below it, as a range so it can use
+            # the index ('0' sorts right after '/')
+            query += (' AND r.revision IN (SELECT revision FROM changed_paths'
+                ' WHERE repo = ? AND (path = ? OR (path >= ? AND path < ?)))')
+            args.extend([repo, path, path + '/', path + '0'])
+        if author:
+            query += ' AND r.author = ?'
+            args.append(author)
+        return query, args
+
+    def entry(self, repo, revision):
+        """Returns the log entry of a single revision, None if not indexed"""
+        rows = self.db.execute('SELECT revision, author, date, message FROM revisions'
+            ' WHERE repo = ? AND revision = ?', (repo, int(revision))).fetchall()
+        entries = self._entries(repo, rows)
+        return entries[0] if entries else None
+
+    def messages(self, repo, revisions):
+        """Returns a dict of revision -> message for the indexed revisions"""
+        messages = {}
+        revisions = [int(r) for r in revisions]
+        for i in xrange(0, len(revisions), 500):
+            chunk = revisions[i:i + 500]
+            rows = self.db.execute('SELECT revision, message FROM revisions'
+                ' WHERE repo = ? AND revision IN (%s)' % ','.join('?' * len(chunk)),
+                [repo] + chunk)
+            messages.update((str(rev), message) for rev, message in rows)
+        return messages
+
+    def diffstat(self, repo, url, revision):
+        """Returns the paths changed in a revision with their added and
+        removed line counts (see svnbrowse.get_diffstat), running svn for
+        them the first time only. Blocks, run it on a worker.
+        """
+        revision = int(revision)
+        if self.db.execute('SELECT 1 FROM diffstat_revisions WHERE repo = ? AND revision = ?',
+                (repo, revision)).fetchone() is None:
+            changes = sorted(svnbrowse.get_diffstat(url, revision),
+                key=lambda change: change['path'])
+            with self.db as db:
+                db.execute('DELETE FROM diffstats WHERE repo = ? AND revision = ?',
+                    (repo, revision))
+                db.executemany('INSERT INTO diffstats VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(repo, revision, c['path'], c['kind'], c['item'], c['props'],
+                        c['added'], c['removed']) for c in changes])
+                db.execute('INSERT OR REPLACE INTO diffstat_revisions VALUES (?, ?)',
+                    (repo, revision))
+            return changes
+        return [{'path': path, 'kind': kind, 'item': item, 'props': props,
+            'added': added, 'removed': removed}
+            for path, kind, item, props, added, removed in self.db.execute(
+                'SELECT path, kind, item, props, added, removed FROM diffstats'
+                ' WHERE repo = ? AND revision = ? ORDER BY path', (repo, revision))]
+
+    def _entries(self, repo, rows):
+        if not rows:
+            return []
+        paths = dict((row[0], []) for row in rows)
+        revisions = paths.keys()
+        for i in xrange(0, len(revisions), 500):
+            chunk = revisions[i:i + 500]
+            for revision, path, kind, action in self.db.execute(
+                    'SELECT revision, path, kind, action FROM changed_paths'
+                    ' WHERE repo = ? AND revision IN (%s)' % ','.join('?' * len(chunk)),
+                    [repo] + chunk):
+                paths[revision].append(records.ChangedPath(path, kind, action))
+        return [records.LogEntry(str(revision), author, date, message, paths[revision])
+            for revision, author, date, message in rows]
+
+_index = None
+
+def get_index():
+    """Returns the process wide index, opening it on first use"""
+    global _index
+    if _index is None:
+        _index = RevisionIndex()
+    return _index
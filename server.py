@@ -0,0 +1,236 @@
+"""Serves octopy from several processes.
+
+A tornado process only ever uses one core. serve() forks PROCESSES worker
+processes instead, one per core by default, each with its own IOLoop and
+svnexec pool and its own listening socket bound with SO_REUSEPORT, so the
+kernel spreads new connections between them. What the workers have to agree
+on already lives outside of them: renders, listings, sessions and the
+dashboard in the memcache behind cache.get_cache(), the indexes in sqlite.
+
+The parent process does nothing but look after the workers:
+
+    SIGHUP           graceful restart: the parent executes itself again,
+                     picking up new code and settings, starts a new set of
+                     workers and, once they are listening, stops the old
+                     ones. Both sets accept connections in between.
+    SIGTERM, SIGINT  graceful stop: the workers stop accepting connections
+                     and exit when the requests they are serving are done,
+                     or after GRACE_PERIOD seconds.
+
+A worker that dies is replaced by a new one with the same number.
+"""
+
+import errno
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import time
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.process
+from tornado.platform.auto import set_close_exec
+
+# number of worker processes, 0 for one per core
+PROCESSES = 0
+
+# seconds a stopping worker gets to finish the requests it is serving
+GRACE_PERIOD = 30
+
+# seconds a restart waits for the new workers to listen before stopping the
+# old ones anyway
+START_TIMEOUT = 30
+
+# number of workers serve() started, for the code running in them
+workers = 1
+
+# the old workers a restarted parent has to stop, passed across the exec
+_RETIRING = 'OCTOPY_RETIRING_WORKERS'
+
+def bind_sockets(port, address=None, backlog=128):
+    """Like tornado.netutil.bind_sockets, but each process calling it gets
+    a socket of its own on the same port
+    """
+    sockets = []
+    for af, socktype, proto, _, sockaddr in socket.getaddrinfo(address or None,
+            port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+            socket.AI_PASSIVE | getattr(socket, 'AI_ADDRCONFIG', 0)):
+        sock = socket.socket(af, socktype, proto)
+        set_close_exec(sock.fileno())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6 and hasattr(socket, 'IPPROTO_IPV6'):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+class _Tracker(object):
+    """Passes requests on to the application, counting those in progress"""
+    def __init__(self, application):
+        self.application = application
+        self.active = 0
+
+    def __call__(self, request):
+        self.active += 1
+        finish = request.finish
+        def finished():
+            self.active -= 1
+            finish()
+        request.finish = finished
+        return self.application(request)
+
+def run_worker(application, port, address='', worker=0, start=None, ready=None):
+    """Serves application until the process is told to stop. start(worker),
+    if given, starts the periodic jobs of the process and returns them so
+    they can be stopped with it. ready is a file descriptor to write to once
+    the process is listening.
+    """
+    io_loop = tornado.ioloop.IOLoop.instance()
+    tracker = _Tracker(application)
+    server = tornado.httpserver.HTTPServer(tracker)
+    # started before listening, processes they fork (the highlighting pool)
+    # mustn't inherit the socket
+    jobs = start(worker) if start else []
+    server.add_sockets(bind_sockets(port, address))
+    if ready is not None:
+        try:
+            os.write(ready, '.')
+        except OSError:
+            # nobody is waiting for a replacement worker
+            pass
+        os.close(ready)
+    stopping = []
+
+    def stop():
+        if stopping:
+            return
+        stopping.append(True)
+        logging.info("worker %d (pid %d) stopping", worker, os.getpid())
+        server.stop()
+        for job in jobs:
+            job.stop()
+        deadline = time.time() + GRACE_PERIOD
+        def check():
+            if tracker.active and time.time() < deadline:
+                io_loop.add_timeout(time.time() + 0.5, check)
+            else:
+                io_loop.stop()
+        check()
+
+    def on_signal(signum, frame):
+        io_loop.add_callback(stop)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    io_loop.start()
+
+def worker_count(processes=None):
+    """Returns the number of workers serve(processes=processes) starts"""
+    processes = PROCESSES if processes is None else processes
+    if processes <= 0:
+        processes = tornado.process.cpu_count()
+    return processes
+
+def serve(application, port, address='', processes=None, start=None):
+    """Serves application from processes worker processes (PROCESSES by
+    default) and looks after them until they have all stopped. Worker
+    number 0 is the one to run background jobs in.
+    """
+    global workers
+    processes = worker_count(processes)
+    workers = processes
+    if tornado.ioloop.IOLoop.initialized():
+        raise RuntimeError("the IOLoop must not be used before the workers are forked")
+    children = {}
+
+    def spawn(worker):
+        ready, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            # session ids come from random, each worker needs its own sequence
+            random.seed()
+            try:
+                run_worker(application, port, address, worker, start, ready_w)
+            except Exception:
+                logging.exception("worker %d failed", worker)
+                os._exit(1)
+            os._exit(0)
+        os.close(ready_w)
+        children[pid] = worker
+        return ready
+
+    retiring = [int(pid) for pid in os.environ.pop(_RETIRING, '').split(',') if pid]
+    logging.info("starting %d workers on port %d", processes, port)
+    pending = [spawn(worker) for worker in xrange(processes)]
+    deadline = time.time() + START_TIMEOUT
+    while pending and time.time() < deadline:
+        try:
+            readable = select.select(pending, [], [], deadline - time.time())[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in readable:
+            # a worker that failed to start closes it without a word
+            os.read(fd, 1)
+            os.close(fd)
+            pending.remove(fd)
+    for fd in pending:
+        os.close(fd)
+    for pid in retiring:
+        _kill(pid)
+
+    received = []
+    def on_signal(signum, frame):
+        received.append(signum)
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, on_signal)
+    stopping = False
+    while children:
+        while received:
+            signum = received.pop(0)
+            if signum == signal.SIGHUP and not stopping:
+                logging.info("restarting")
+                os.environ[_RETIRING] = ','.join(str(pid) for pid in children)
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+            elif not stopping:
+                logging.info("stopping %d workers", len(children))
+                stopping = True
+                for pid in children:
+                    _kill(pid)
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            # a worker of the previous generation
+            continue
+        worker = children.pop(pid)
+        if stopping:
+            continue
+        if os.WIFSIGNALED(status):
+            logging.warning("worker %d (pid %d) killed by signal %d, restarting",
+                worker, pid, os.WTERMSIG(status))
+        else:
+            logging.warning("worker %d (pid %d) exited with status %d, restarting",
+                worker, pid, os.WEXITSTATUS(status))
+        # don't spin if it dies right away
+        time.sleep(1)
+        os.close(spawn(worker))
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
@@ -0,0 +1,86 @@
+"""Login sessions.
+
+A session is the data stored at login ({'username': ...}) under a random id
+kept in the octopy_session_id secure cookie. The sessions live in the shared
+cache for SESSION_TTL seconds; each process also keeps the ones it has seen
+in a small LRU for LOCAL_TTL seconds, so an authenticated request usually
+doesn't have to ask memcache who it belongs to.
+
+With SIGNED_TOKENS the cookie holds the session itself, the username and the
+time it expires, and is trusted on the strength of the secure cookie
+signature, so no lookup is needed at all. Such sessions can't be revoked
+before they expire: logging out only clears the cookie.
+"""
+
+import random
+import string
+import time
+
+import cache
+
+# seconds a session stays valid after login
+SESSION_TTL = 32400
+
+# seconds a process trusts its own copy of a session before checking the
+# shared cache again; a logout in another process takes up to this long to
+# be noticed here
+LOCAL_TTL = 30
+
+# number of sessions each process keeps a copy of
+LOCAL_MAX_ITEMS = 10000
+
+# put the session in the (signed) cookie instead of the shared cache
+SIGNED_TOKENS = False
+
+class SessionStore(object):
+    def __init__(self, shared=None, signed_tokens=None):
+        self.shared = shared or cache.get_cache()
+        self.signed_tokens = SIGNED_TOKENS if signed_tokens is None else signed_tokens
+        self.local = cache.LocalBackend(LOCAL_MAX_ITEMS)
+
+    def create(self, username):
+        """Starts a session for username and returns the value to store in
+        the cookie, None if no unique session id could be generated
+        """
+        if self.signed_tokens:
+            return '%s|%d' % (username, int(time.time()) + SESSION_TTL)
+        sessid = ''.join(random.choice(string.letters) for i in xrange(32))
+        if self.shared.get(sessid) is not None:
+            return None
+        self.shared.set(sessid, {'username': username}, time=SESSION_TTL)
+        return sessid
+
+    def get(self, sessid):
+        """Returns the session data for the cookie value, None if there is no
+        such session or it has expired
+        """
+        if not sessid:
+            return None
+        if '|' in sessid:
+            if not self.signed_tokens:
+                return None
+            username, expires = sessid.rsplit('|', 1)
+            if not expires.isdigit() or int(expires) < time.time():
+                return None
+            return {'username': username}
+        session = self.local.get(sessid)
+        if session is None:
+            session = self.shared.get(sessid)
+            if session is not None:
+                self.local.set(sessid, session, time=LOCAL_TTL)
+        return session
+
+    def delete(self, sessid):
+        """Ends the session"""
+        if sessid and '|' not in sessid:
+            self.local.delete(sessid)
+            self.shared.delete(sessid)
+
+_store = None
+
+def get_store():
+    """Returns the process wide session store, creating it on first use"""
+    global _store
+    if _store is None:
+        _store = SessionStore()
+    return _store
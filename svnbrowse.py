@@ -1,79 +1,279 @@
 
-import re
+import os
+import threading
+import time
+import urllib
+from contextlib import contextmanager
 from datetime import datetime
-from os.path import basename, dirname, getsize
-from subprocess import call, check_call, CalledProcessError
-from tempfile import TemporaryFile, NamedTemporaryFile
-from xml.etree.ElementTree import ElementTree
+from os.path import basename
+from subprocess import Popen, PIPE, CalledProcessError
+try:
+    from xml.etree.cElementTree import iterparse, ParseError
+except ImportError:
+    from xml.etree.ElementTree import iterparse, ParseError
+# datetime.strptime imports this lazily, which isn't safe when the first
+# calls come from several svnexec workers at once
+import _strptime
 
-from pygments import highlight
-from pygments.lexers import guess_lexer, get_lexer_for_filename, TextLexer, DiffLexer
-from pygments.formatters import HtmlFormatter
-from pygments.util import ClassNotFound
+import highlighter
+import metrics
+import records
 
 DEFAULT_DATE_FMT = "%x %I:%M:%S %p"
 
+# seconds an svn command may run before it is killed, unless the caller has
+# set a tighter deadline with set_deadline()
+SVN_TIMEOUT = 120
+
+# files larger than this many bytes are offered for download instead of
+# being highlighted
+HIGHLIGHT_MAX_BYTES = 1024 * 1024
+
+# diffs larger than this many bytes aren't returned by list_diff, the diff
+# page streams them file by file through iter_diff instead
+DIFF_MAX_BYTES = 5 * 1024 * 1024
+
+# 'native' reads file:// repositories through the svn python bindings (see
+# svnnative) when they are installed, 'cli' always runs the svn command line
+BACKEND = 'native'
+
+_context = threading.local()
+
+# svn processes started by every thread together
+_total_commands = 0
+_total_lock = threading.Lock()
+
 class NoTagDirectoryInRepo(Exception):
     pass
 
+class NoBranchDirectoryInRepo(Exception):
+    pass
+
+class SvnTimeout(CalledProcessError):
+    def __str__(self):
+        return "Command '%s' timed out" % ' '.join(self.cmd)
+
+def set_deadline(deadline):
+    """Sets the time (as returned by time.time) by which every svn command
+    started from the current thread has to finish. None removes the deadline.
+    """
+    _context.deadline = deadline
+
+def _timeout():
+    deadline = getattr(_context, 'deadline', None)
+    if deadline is None:
+        return SVN_TIMEOUT
+    return max(deadline - time.time(), 0.01)
+
+def commands_started():
+    """Returns the number of svn processes started from the current thread"""
+    return getattr(_context, 'commands', 0)
+
+def commands_total():
+    """Returns the number of svn processes started by the whole process"""
+    return _total_commands
+
+def _spawn(cmd, **kwargs):
+    global _total_commands
+    _context.commands = commands_started() + 1
+    with _total_lock:
+        _total_commands += 1
+    return Popen(cmd, **kwargs)
+
+def _native(repourl):
+    """Returns the svnnative module when it should serve repourl"""
+    if BACKEND != 'native' or not repourl.startswith('file://'):
+        return None
+    import svnnative
+    return svnnative if svnnative.available else None
+
+def format_date(svndate):
+    """Formats a date as svn writes it in xml output for display"""
+    return datetime.strptime(svndate[0:19], 
+        "%Y-%m-%dT%H:%M:%S").strftime(DEFAULT_DATE_FMT)
+
+def _kill(proc):
+    try:
+        proc.kill()
+    except OSError:
+        pass
+
+def _watch(proc):
+    """Kills proc once it runs past the current timeout. Returns the timer
+    and a list that gets an item appended when the timer fired.
+    """
+    expired = []
+    def kill():
+        expired.append(True)
+        _kill(proc)
+    timer = threading.Timer(_timeout(), kill)
+    timer.daemon = True
+    timer.start()
+    return timer, expired
+
+def _run(cmd, stdout=None, stderr=None, check=True):
+    """Runs cmd like subprocess.check_call (or subprocess.call when check is
+    False), killing it once it runs past the current timeout
+    """
+    proc = _spawn(cmd, stdout=stdout, stderr=stderr)
+    timer, expired = _watch(proc)
+    try:
+        with metrics.timed('svn'):
+            retcode = proc.wait()
+    finally:
+        timer.cancel()
+    if expired:
+        raise SvnTimeout(retcode, cmd)
+    if check and retcode:
+        raise CalledProcessError(retcode, cmd)
+    return retcode
+
+class _Output(object):
+    """The stdout of an svn command. The time spent waiting for svn to write
+    it goes to the svn part of the current metrics.Timing when it is closed.
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.waited = 0
+
+    def _wait(self, read, *args):
+        started = time.time()
+        try:
+            return read(*args)
+        finally:
+            self.waited += time.time() - started
+
+    def read(self, *args):
+        return self._wait(self.stdout.read, *args)
+
+    def readline(self, *args):
+        return self._wait(self.stdout.readline, *args)
+
+    def readlines(self):
+        return self._wait(self.stdout.readlines)
+
+    def __iter__(self):
+        # lines are split here from whatever svn has written so far, rather
+        # than timing every line
+        pending = ''
+        fd = self.stdout.fileno()
+        while True:
+            chunk = self._wait(os.read, fd, 65536)
+            if not chunk:
+                break
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+    def close(self):
+        self.stdout.close()
+        metrics.add('svn', self.waited)
+        self.waited = 0
+
+@contextmanager
+def _pipe(cmd, check=True):
+    """Runs cmd and gives its stdout to be read while it is still running.
+
+    Leaving the block before reading everything kills the command, which is
+    how streaming consumers stop svn early. Otherwise behaves like _run.
+    The time spent in the block goes to the parse part of the current
+    metrics.Timing, less the time spent waiting for svn.
+    """
+    with metrics.timed('parse'):
+        with _open_pipe(cmd, check) as out:
+            yield out
+
+@contextmanager
+def _open_pipe(cmd, check):
+    proc = _spawn(cmd, stdout=PIPE)
+    timer, expired = _watch(proc)
+    out = _Output(proc.stdout)
+    try:
+        yield out
+        # the caller may have stopped reading before svn finished writing
+        stopped_early = bool(out.read(1))
+    except ParseError:
+        # truncated or empty xml, most likely because svn failed; report that
+        out.close()
+        retcode = proc.wait()
+        timer.cancel()
+        if expired:
+            raise SvnTimeout(retcode, cmd)
+        if check and retcode:
+            raise CalledProcessError(retcode, cmd)
+        raise
+    except:
+        _kill(proc)
+        out.close()
+        proc.wait()
+        timer.cancel()
+        if expired:
+            raise SvnTimeout(proc.returncode, cmd)
+        raise
+    if stopped_early:
+        _kill(proc)
+    out.close()
+    retcode = proc.wait()
+    timer.cancel()
+    if expired:
+        raise SvnTimeout(retcode, cmd)
+    if check and retcode and not stopped_early:
+        raise CalledProcessError(retcode, cmd)
+
+def _iterentries(source, tag):
+    """Incrementally parses the xml in source, yielding each `tag` element
+    once it is complete. Elements are dropped from the tree after use so
+    memory stays flat however long the output is.
+    """
+    parents = []
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == tag:
+            yield elem
+            if parents:
+                parents[-1].remove(elem)
+
 class LogParser(object):
     def __init__(self, logoutput):
         self.log = logoutput
     def __iter__(self):
-        tree = ElementTree()
-        tree.parse(self.log)
-        iterator = getattr(tree, 'iter', getattr(tree, 'getiterator'))
-        for entry in iterator('logentry'):
-            data = {}
-            data['revision'] = entry.attrib['revision']
-            try:
-                data['author'] = entry.find('author').text
-            except AttributeError:
-                data['author'] = ''
-            data['date'] = datetime.strptime(entry.find('date').text[0:19], 
-                "%Y-%m-%dT%H:%M:%S").strftime(DEFAULT_DATE_FMT)
-            data['orig_date'] = entry.find('date').text
-            data['message'] = entry.find('msg').text
-            data['paths'] = []
-            for path in entry.find('paths').findall('path'):
-                data['paths'].append({'path': path.text,
-                    'kind': path.attrib['kind'],
-                    'action': path.attrib['action']})
-            yield data
+        for entry in _iterentries(self.log, 'logentry'):
+            author = date = message = None
+            paths = []
+            for child in entry:
+                if child.tag == 'author':
+                    author = child.text
+                elif child.tag == 'date':
+                    date = child.text
+                elif child.tag == 'msg':
+                    message = child.text
+                elif child.tag == 'paths':
+                    paths = [records.ChangedPath(path.text, path.get('kind'),
+                        path.get('action')) for path in child]
+            yield records.LogEntry(entry.get('revision'), author or '', date,
+                message, paths)
 
 class ListParser(object):
     def __init__(self, logoutput):
         self.log = logoutput
     def __iter__(self):
-        tree = ElementTree()
-        tree.parse(self.log)
-        iterator = getattr(tree, 'iter', getattr(tree, 'getiterator'))
-        for entry in iterator('entry'):
-            root = entry.find('repository').find('root').text
-            data = { 'kind': entry.attrib['kind'],
-                'name': entry.attrib['path'], 
-                'fullpath': entry.find('url').text.replace(root, '') }
+        for entry in _iterentries(self.log, 'entry'):
+            repository = entry.find('repository')
+            root = repository.find('root').text
             commit = entry.find('commit')
-            data['revision'] = commit.attrib['revision']
-            data['orig_date'] = commit.find('date').text[0:19]
-            data['date'] = datetime.strptime(data['orig_date'], 
-                    "%Y-%m-%dT%H:%M:%S").strftime(DEFAULT_DATE_FMT)            
-            try:
-                data['author'] = commit.find('author').text
-            except AttributeError:
-                data['author'] = ''
-            yield data
-        
-        #logex = re.compile('\s*(\d+)\s(\w+)\s*(\d+)?\s*(\w+\s\d+\s\d+:\d+)\s(.*)')
-        #for line in self.log:
-        #    rev, author, size, date, path = logex.match(line).groups()
-        #    data = { 'kind': 'dir' if path[-1] == '/' else 'file',
-        #        'size': size, 'name': '.' if path == './' else basename(path) , 
-        #        'revision': rev, 'author': author or '', 
-        #        'date': datetime.strptime(date, 
-        #            "%b %d %H:%M").strftime(DEFAULT_DATE_FMT),
-        #        'orig_date': date, 'webpath': ''}
-        #    yield data
+            yield records.DirEntry(kind=entry.get('kind'),
+                name=entry.get('path'),
+                fullpath=entry.find('url').text.replace(root, ''),
+                uuid=repository.find('uuid').text,
+                revision=commit.get('revision'),
+                orig_date=commit.find('date').text[0:19],
+                author=getattr(commit.find('author'), 'text', None) or '')
 
 def list_repositories(repos):
     """Returns a list of all the available repositories as a label and path
@@ -82,22 +282,27 @@ def list_repositories(repos):
     for repourl in repos:
         yield get_root_info(repo)
 
-def get_root_info(repourl):
+def get_root_info(repourl, lookup=None):
     """Returns a list of all the available repositories as a label and path
     expects repos to be an iterable of svn urls 
+
+    `lookup` may be a function returning the log entry of a revision, or None
+    when it doesn't know it, to use instead of asking svn for the most recent
+    change
     """
     repo = {}
-    with TemporaryFile() as tmp:
-        call(['svn', 'info', repourl], stdout=tmp)
-
-        tmp.seek(0)
-        for line in tmp:
-            line = line.strip()
-            if not line: 
-                continue
-            key = line.split(':')[0].replace(' ', '_').lower()
-            value = ':'.join(line.split(':')[1:]).strip()
-            repo[key] = value
+    native = _native(repourl)
+    if native:
+        repo = native.info(repourl)
+    else:
+        with _pipe(['svn', 'info', repourl], check=False) as out:
+            for line in out:
+                line = line.strip()
+                if not line: 
+                    continue
+                key = line.split(':')[0].replace(' ', '_').lower()
+                value = ':'.join(line.split(':')[1:]).strip()
+                repo[key] = value
 
     repo['name'] = basename(repo['url'])
     repo['weburl'] = repo['name'] + '/' + repo['url'].replace(repo['repository_root'], '')
@@ -105,6 +310,11 @@ def get_root_info(repourl):
     repo['last_changed_date'] = datetime.strptime(
         repo['last_changed_date'][:19], "%Y-%m-%d %H:%M:%S").strftime(DEFAULT_DATE_FMT)
     
+    if lookup is not None:
+        repo['most_recent_change'] = lookup(repo['last_changed_rev'])
+        if repo['most_recent_change'] is not None:
+            return repo
+
     try:
         repo['most_recent_change'] = list_history(repo['url'], repo['last_changed_rev'])[0]
     except IndexError:
@@ -112,50 +322,60 @@ def get_root_info(repourl):
 
     return repo
 
+def youngest(repourl):
+    """Returns the youngest revision of the repository"""
+    if _native(repourl):
+        return _native(repourl).youngest(repourl)
+    revision = None
+    with _pipe(['svn', 'info', '--xml', '-r', 'HEAD', repourl]) as out:
+        for entry in _iterentries(out, 'entry'):
+            revision = int(entry.attrib['revision'])
+    return revision
+
 def list_repository(repourl, path, rev=None, recursive=False):
     """Returns a listing of the repository, every folder and file"""
+    if _native(repourl):
+        for data in _native(repourl).list_repository(repourl, path, rev, recursive):
+            yield data
+        return
 
     name = basename(repourl.strip("/"))
     url = repourl + "/" + path
+    if rev:
+        # look the path up at rev, it may not exist anymore at HEAD
+        url += '@%s' % rev
     cmd = ['svn', 'list', '--xml', url]
     if rev:
         cmd.extend(['-r', str(rev)])
     if recursive:
         cmd.extend(['-R'])
 
-    with TemporaryFile() as tmp:
-        call(cmd, stdout=tmp)
-        tmp.seek(0)
-        tree = ElementTree()
-        tree.parse(tmp)
-
-    for entry in getattr(tree, 'iter', getattr(tree, 'getiterator'))('entry'):
-        commit = entry.find('commit')
-        webpath = "/" + name
-        if path != "":
-            webpath += "/" + path
-        webpath += "/" + entry.find('name').text
-        data = { 'kind': entry.attrib['kind'],
-            'name': entry.find('name').text,
-            'revision': commit.attrib['revision'],
-            'author': getattr(commit.find('author'), 'text', ''),
-            'date': datetime.strptime(commit.find('date').text[:19], 
-                "%Y-%m-%dT%H:%M:%S").strftime(DEFAULT_DATE_FMT),
-            'orig_date': commit.find('date').text,
-            'webpath': webpath}
-        try:
-            data['size'] = entry.find('size').text
-        except AttributeError:
-            data['size'] = None
-
-        yield data
+    with _pipe(cmd, check=False) as out:
+        for entry in _iterentries(out, 'entry'):
+            commit = entry.find('commit')
+            webpath = "/" + name
+            if path != "":
+                webpath += "/" + path
+            webpath += "/" + entry.find('name').text
+            yield records.ListEntry(kind=entry.get('kind'),
+                name=entry.find('name').text,
+                revision=commit.get('revision'),
+                author=getattr(commit.find('author'), 'text', ''),
+                orig_date=commit.find('date').text,
+                size=getattr(entry.find('size'), 'text', None),
+                webpath=webpath)
     
     
 def list_repository2(repourl, path, rev=None, recursive=False):
     """Returns a listing of the repository, every folder and file"""
+    if _native(repourl):
+        return _native(repourl).list_repository2(repourl, path, rev, recursive)
 
     name = basename(repourl.strip("/"))
     url = repourl + "/" + path
+    if rev:
+        # look the path up at rev, it may not exist anymore at HEAD
+        url += '@%s' % rev
     #cmd = ['svn', 'list', '-v', url]
     cmd = ['svn', 'info', '--xml', '--depth', 'immediates', url]
     if rev:
@@ -163,22 +383,48 @@ def list_repository2(repourl, path, rev=None, recursive=False):
     if recursive:
         cmd.extend(['-R'])
 
-    with TemporaryFile() as tmp:
-        call(cmd, stdout=tmp)
-        tmp.seek(0)
-        parser = ListParser(tmp)
-        return list(parser)
+    with _pipe(cmd, check=False) as out:
+        return list(ListParser(out))
 
-def list_history(repourl, revision=None):
-    """returns the parsed history of the repository"""
+def iter_history(repourl, revision=None, limit=None):
+    """Yields the log entries of the repository as svn writes them
+
+    `revision` is a single revision or a range such as "HEAD:100" (newest
+    first) and `limit` caps the number of entries svn has to produce.
+    Closing the generator early stops svn.
+    """
+    if _native(repourl):
+        for entry in _native(repourl).iter_history(repourl, revision, limit):
+            yield entry
+        return
     cmd = ['svn', 'log', '--xml', '-v', repourl]
-    if revision is not None and int(revision):
-        cmd.extend(['-r', revision])
-    with TemporaryFile() as tmp:
-        check_call(cmd, stdout=tmp)
-        tmp.seek(0)
-        parser = LogParser(tmp)
-        return list(parser) 
+    if revision is not None and str(revision) not in ('', '0'):
+        cmd.extend(['-r', str(revision)])
+    if limit:
+        cmd.extend(['--limit', str(int(limit))])
+    with _pipe(cmd) as out:
+        for entry in LogParser(out):
+            yield entry
+
+def list_history(repourl, revision=None, limit=None):
+    """returns the parsed history of the repository, see iter_history"""
+    return list(iter_history(repourl, revision, limit))
+
+def list_messages(repourl, revisions):
+    """returns a dict of revision -> commit message for the given revisions"""
+    if _native(repourl):
+        return _native(repourl).list_messages(repourl, revisions)
+    revisions = sorted(set(int(r) for r in revisions))
+    messages = {}
+    # keep the command line a sane length on directories with many entries
+    for i in xrange(0, len(revisions), 200):
+        cmd = ['svn', 'log', '--xml', repourl]
+        for rev in revisions[i:i + 200]:
+            cmd.extend(['-r', str(rev)])
+        with _pipe(cmd) as out:
+            for entry in LogParser(out):
+                messages[entry['revision']] = entry['message']
+    return messages
 
 def list_changesets(repourl, revfrom, revto):
     """Returns the parsed changeset"""
@@ -187,65 +433,222 @@ def list_changesets(repourl, revfrom, revto):
 
     cmd = ['svn', 'diff', '--xml', '--summarize', 
         '-r', '%d:%d' % (revfrom, revto), repourl]
-    with TemporaryFile() as tmp:
-        check_call(cmd, stdout=tmp)
-        tmp.seek(0)
-        tree = ElementTree()
-        tree.parse(tmp)
-
-    for path in getattr(tree, 'iter', getattr(tree, 'getiterator'))('path'):
-        data = { 'props': path.attrib['props'],
-            'kind': path.attrib['kind'],
-            'item': path.attrib['item'],
-            'path': path.text}
-        yield data
-
-def list_diff(repourl, from_path, from_rev, to_path, to_rev):
+    with _pipe(cmd) as out:
+        for path in _iterentries(out, 'path'):
+            data = { 'props': path.attrib['props'],
+                'kind': path.attrib['kind'],
+                'item': path.attrib['item'],
+                'path': path.text}
+            yield data
 
-    cmd = ['svn', 'diff',
+def diff_command(repourl, from_path, from_rev, to_path, to_rev):
+    return ['svn', 'diff',
             '%s/%s@%s' % (repourl, from_path, from_rev),
             '%s/%s@%s' % (repourl, to_path, to_rev) ]
 
-    with NamedTemporaryFile() as tmp:
-        check_call(cmd, stdout=tmp)
-        tmp.seek(0)
-        if getsize(tmp.name) > 5242880L:
-            return tmp.read(5242880) + "\n\n... Diff too large to show, terminating ...\n"
-        return tmp.read(5242880)
-
-def highlight_file(repourl):
-    with TemporaryFile() as tmp:
-        check_call(['svn', 'cat', repourl], stdout=tmp)
-        tmp.seek(0)
-        try:
-            return highlight(tmp.read(), 
-                get_lexer_for_filename(basename(repourl)),
-                HtmlFormatter(linenos=True)) 
-        except ClassNotFound, e:
-            tmp.seek(0)
-            return highlight(tmp.read(), 
-                TextLexer(), HtmlFormatter(linenos=True)) 
+def list_diff(repourl, from_path, from_rev, to_path, to_rev):
+    """Returns the diff, None if it is larger than DIFF_MAX_BYTES"""
+    with _pipe(diff_command(repourl, from_path, from_rev, to_path, to_rev)) as out:
+        diff = out.read(DIFF_MAX_BYTES + 1)
+    return diff if len(diff) <= DIFF_MAX_BYTES else None
+
+def iter_diff(repourl, from_path, from_rev, to_path, to_rev, max_bytes=None):
+    """Yields the diff one file at a time, as (path, diff, size) tuples, while
+    svn is still producing it. The diff of a file larger than max_bytes is
+    not kept and comes out as None, only its size is given.
+    """
+    return _split_diff(diff_command(repourl, from_path, from_rev, to_path, to_rev),
+        max_bytes)
+
+def change_command(repourl, path, rev, peg=None):
+    """The command for the changes made to path in revision rev. A path
+    deleted in rev has to be looked up at an earlier peg revision.
+    """
+    url = repourl + '/' + path if path else repourl
+    return ['svn', 'diff', '-c', str(rev), '%s@%s' % (url, peg or rev)]
+
+def iter_change(repourl, path, rev, peg=None, max_bytes=None):
+    """Like iter_diff, for the changes made to path in revision rev"""
+    return _split_diff(change_command(repourl, path, rev, peg), max_bytes)
+
+def _split_diff(cmd, max_bytes):
+    with _pipe(cmd) as out:
+        path, lines, size = None, [], 0
+        for line in out:
+            if line.startswith('Index: '):
+                if path is not None or lines:
+                    yield path, _section(lines, size, max_bytes), size
+                path, lines, size = line[7:].rstrip('\r\n'), [], 0
+            size += len(line)
+            if max_bytes is None or size <= max_bytes:
+                lines.append(line)
+        if path is not None or lines:
+            yield path, _section(lines, size, max_bytes), size
+
+def _section(lines, size, max_bytes):
+    if max_bytes is not None and size > max_bytes:
+        return None
+    return ''.join(lines)
+
+def count_lines(repourl, rev):
+    """Returns a dict of path -> [added, removed] lines in revision rev,
+    paths relative to repourl. Counted off the diff as it streams by, so
+    large revisions don't have to fit in memory.
+    """
+    counts = {}
+    with _pipe(change_command(repourl, '', rev)) as out:
+        current = count = None
+        for line in out:
+            if line.startswith('Index: '):
+                current = counts[line[7:].rstrip('\r\n')] = [0, 0]
+                # the ---/+++ header lines come before the first hunk
+                count = None
+            elif line.startswith('@@'):
+                count = current
+            elif line.startswith('Property changes on: '):
+                count = None
+            elif count is not None and line[:1] == '+':
+                count[0] += 1
+            elif count is not None and line[:1] == '-':
+                count[1] += 1
+    return counts
+
+def get_diffstat(repourl, rev):
+    """Returns the paths changed in revision rev with the lines added and
+    removed in each, as in list_changesets plus 'added' and 'removed', paths
+    relative to repourl
+    """
+    rev = int(rev)
+    counts = count_lines(repourl, rev)
+    changes = []
+    for change in list_changesets(repourl, rev - 1, rev):
+        path = urllib.unquote(change['path'][len(repourl):]).strip('/')
+        added, removed = counts.get(path, (0, 0))
+        changes.append(dict(change, path=path, added=added, removed=removed))
+    return changes
+
+def blame(repourl, rev=None):
+    """Returns the (revision, author) that last changed each line of the file
+    at repourl
+    """
+    url = repourl if rev is None else '%s@%s' % (repourl, rev)
+    lines = []
+    with _pipe(['svn', 'blame', '--xml', url]) as out:
+        for entry in _iterentries(out, 'entry'):
+            commit = entry.find('commit')
+            if commit is None:
+                lines.append((None, ''))
+            else:
+                lines.append((int(commit.get('revision')),
+                    getattr(commit.find('author'), 'text', None) or ''))
+    return lines
+
+def file_history(repourl, path, rev, limit=None, peg=None):
+    """Returns (revision, path, author) for each revision up to rev that
+    changed the file at path@peg (rev by default), newest first, with the
+    path (from the repository root at repourl) the file had in that
+    revision. Follows copies.
+    """
+    peg = peg or rev
+    cmd = ['svn', 'log', '--xml', '-v', '-q', '-r', '%s:1' % peg,
+        '%s%s@%s' % (repourl, path, peg)]
+    if limit and str(peg) == str(rev):
+        cmd.extend(['--limit', str(int(limit))])
+    history = []
+    with _pipe(cmd) as out:
+        for entry in _iterentries(out, 'logentry'):
+            if limit and len(history) >= int(limit):
+                break
+            revision = int(entry.get('revision'))
+            # the revisions after rev only copied the file, see where from
+            if revision <= int(rev):
+                history.append((revision, path,
+                    getattr(entry.find('author'), 'text', None) or ''))
+            for changed in getattr(entry.find('paths'), 'findall', lambda tag: [])('path'):
+                copied = changed.get('copyfrom-path')
+                if copied and (path == changed.text or path.startswith(changed.text + '/')):
+                    # copied here in this revision, older ones have it elsewhere
+                    path = copied + path[len(changed.text):]
+                    break
+    return history
+
+def _target(repourl, rev, peg):
+    """Returns the svn arguments naming repourl as of revision rev, looked up
+    at revision peg (rev itself by default). A file copied without changes
+    keeps the revision it last changed in from before the copy, so a page
+    pegs its files at the revision it shows and follows them back to that.
+    """
+    peg = peg or rev
+    args = ['%s@%s' % (repourl, peg) if peg else repourl]
+    if rev and str(rev) != str(peg):
+        args.extend(['-r', str(rev)])
+    return args
+
+def get_size(repourl, rev=None, peg=None):
+    """Returns the size in bytes of the file at repourl, None for a directory"""
+    if _native(repourl):
+        return _native(repourl).get_size(repourl, rev, peg)
+    size = None
+    with _pipe(['svn', 'list', '--xml'] + _target(repourl, rev, peg)) as out:
+        for entry in _iterentries(out, 'entry'):
+            if entry.attrib['kind'] == 'file' and entry.find('size') is not None:
+                size = int(entry.find('size').text)
+    return size
+
+def get_properties(repourl, rev=None, peg=None):
+    """Returns the versioned properties of repourl as a dict"""
+    if _native(repourl):
+        return _native(repourl).get_properties(repourl, rev, peg)
+    cmd = ['svn', 'proplist', '--xml', '-v'] + _target(repourl, rev, peg)
+    with _pipe(cmd) as out:
+        return dict((prop.attrib['name'], prop.text or '')
+            for prop in _iterentries(out, 'property'))
+
+def is_binary(mime_type):
+    """Whether svn treats a file with the given svn:mime-type as binary"""
+    return bool(mime_type) and not mime_type.startswith('text/') \
+        and mime_type not in ('image/x-xbitmap', 'image/x-xpixmap')
+
+def cat_command(repourl, rev=None, peg=None):
+    """Returns the command writing the contents of repourl to stdout"""
+    return ['svn', 'cat'] + _target(repourl, rev, peg)
+
+def cat_file(repourl, rev=None, peg=None):
+    """Returns the contents of the file at repourl"""
+    if _native(repourl):
+        return _native(repourl).cat_file(repourl, rev, peg)
+    with _pipe(cat_command(repourl, rev, peg)) as out:
+        return out.read()
+
+def highlight_file(repourl, rev=None, peg=None):
+    """Returns the highlighted html of the file at repourl, or None when its
+    content looks binary
+    """
+    source = cat_file(repourl, rev, peg)
+    if '\0' in source[:8192]:
+        return None
+    return highlighter.highlight(source, basename(repourl))
     
 def highlight_diff(diff):
-    return highlight(diff, DiffLexer(), HtmlFormatter())
+    return highlighter.highlight(diff, name='diff', linenos=False)
 
 def get_tags(repourl):
     cmd = ['svn', 'list', '%s/tags' % repourl]
     try:
-        with TemporaryFile() as tmp:
-            check_call(cmd, stdout=tmp)
-            tmp.seek(0)
-            return [i.strip().strip("/") for i in tmp.readlines()]
+        if _native(repourl):
+            return _native(repourl).list_dir('%s/tags' % repourl)
+        with _pipe(cmd) as out:
+            return [i.strip().strip("/") for i in out.readlines()]
     except CalledProcessError:
         raise NoTagDirectoryInRepo("The repository %s does not have a 'tags' directory" % repourl)
 
 def get_branches(repourl):
     cmd = ['svn', 'list', '%s/branches' % repourl]
     try:
-        with TemporaryFile() as tmp:
-            check_call(cmd, stdout=tmp)
-            tmp.seek(0)
-            return [i.strip().strip("/") for i in tmp.readlines()]
+        if _native(repourl):
+            return _native(repourl).list_dir('%s/branches' % repourl)
+        with _pipe(cmd) as out:
+            return [i.strip().strip("/") for i in out.readlines()]
     except CalledProcessError:
         raise NoBranchDirectoryInRepo("The repository %s does not have a 'branches' directory" % repourl)
 
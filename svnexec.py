@@ -0,0 +1,297 @@
+"""Runs the blocking svnbrowse calls off the IOLoop.
+
+Calls are handed to a bounded pool of worker threads and their results are
+delivered back on the IOLoop, so a handler wrapped in tornado.gen.engine can
+simply yield them:
+
+    files = yield svnexec.Call(name, svnbrowse.list_repository2, url, path)
+
+Exceptions raised by the call are re-raised at the yield. Every call gets a
+deadline (see svnbrowse.set_deadline) after which its svn process is killed,
+and each repository has at most REPO_CONCURRENCY calls running at once; the
+rest wait in a per-repository queue so one slow repository can't take every
+worker.
+
+PipeStream streams the output of an svn command to the client as it arrives,
+without going through a worker or holding the whole output in memory.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from Queue import Queue
+from subprocess import Popen, PIPE
+
+import tornado.ioloop
+from tornado import gen, stack_context
+
+import metrics
+import svnbrowse
+
+# number of worker threads running svn commands
+MAX_WORKERS = 8
+
+# number of calls allowed to run at once against a single repository
+REPO_CONCURRENCY = 2
+
+# seconds a call may take before its svn process is killed
+DEFAULT_TIMEOUT = 60
+
+# seconds an Iteration waits for the handler to take an item before giving up
+RESUME_TIMEOUT = 300
+
+class Stalled(Exception):
+    """The handler of an Iteration didn't take an item in time"""
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class _Job(object):
+    def __init__(self, repo, func, args, kwargs, timeout, callback, counter):
+        self.repo = repo
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.callback = callback
+        self.counter = counter
+        self.result = None
+        self.commands = 0
+        # the timing of the request the call is made for, and its own
+        self.request_timing = metrics.current()
+        self.timing = metrics.Timing()
+
+class Pool(object):
+    """A fixed set of worker threads with a per-repository concurrency limit.
+
+    submit() must be called from the IOLoop thread; callbacks are run there too.
+    """
+    def __init__(self, workers=None, repo_concurrency=None, io_loop=None):
+        self.workers = workers or MAX_WORKERS
+        self.repo_concurrency = repo_concurrency or REPO_CONCURRENCY
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._queue = Queue()
+        self._running = {}
+        self._waiting = {}
+        self._threads = []
+
+    def submit(self, repo, func, args=(), kwargs=None, timeout=None, callback=None,
+            counter=None):
+        """Runs func(*args, **kwargs) against repo and passes the result to
+        callback. `counter`, if given, gets the number of svn processes the
+        call started added to its `commands` attribute.
+        """
+        job = _Job(repo, func, args, kwargs or {},
+            DEFAULT_TIMEOUT if timeout is None else timeout,
+            stack_context.wrap(callback), counter)
+        if self._running.get(repo, 0) < self.repo_concurrency:
+            self._start(job)
+        else:
+            self._waiting.setdefault(repo, deque()).append(job)
+
+    def _start(self, job):
+        if not self._threads:
+            for i in xrange(self.workers):
+                thread = threading.Thread(target=self._work, name="svnexec-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._running[job.repo] = self._running.get(job.repo, 0) + 1
+        self._queue.put(job)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            svnbrowse.set_deadline(time.time() + job.timeout if job.timeout else None)
+            started = svnbrowse.commands_started()
+            try:
+                with metrics.activate(job.timing):
+                    job.result = job.func(*job.args, **job.kwargs)
+            except Exception:
+                logging.debug("svn call %s%r failed", job.func.__name__, job.args,
+                    exc_info=True)
+                job.result = _Failure(sys.exc_info())
+            finally:
+                svnbrowse.set_deadline(None)
+                job.commands = svnbrowse.commands_started() - started
+            self.io_loop.add_callback(lambda job=job: self._finished(job))
+
+    def _finished(self, job):
+        self._running[job.repo] -= 1
+        waiting = self._waiting.get(job.repo)
+        if waiting:
+            self._start(waiting.popleft())
+        else:
+            if not self._running[job.repo]:
+                del self._running[job.repo]
+            self._waiting.pop(job.repo, None)
+        if job.counter is not None:
+            job.counter.commands += job.commands
+        if job.request_timing is not None:
+            job.request_timing.add(job.timing)
+        job.callback(job.result)
+
+_pool = None
+
+def get_pool():
+    """Returns the process wide pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        _pool = Pool()
+    return _pool
+
+class Call(gen.YieldPoint):
+    """Yield point running func(*args, **kwargs) on the pool against `repo`.
+
+    Pass timeout=seconds to override DEFAULT_TIMEOUT for this call, 0 for no
+    deadline on the call as a whole. Each svn command it runs is still killed
+    after svnbrowse.SVN_TIMEOUT seconds.
+    """
+    def __init__(self, repo, func, *args, **kwargs):
+        self.repo = repo
+        self.func = func
+        self.args = args
+        self.timeout = kwargs.pop('timeout', None)
+        self.kwargs = kwargs
+
+    def start(self, runner):
+        self.runner = runner
+        self.key = object()
+        runner.register_callback(self.key)
+        self.submit(runner.result_callback(self.key))
+
+    def submit(self, callback):
+        get_pool().submit(self.repo, self.func, self.args, self.kwargs,
+            self.timeout, callback)
+
+    def is_ready(self):
+        return self.runner.is_ready(self.key)
+
+    def get_result(self):
+        result = self.runner.pop_result(self.key)
+        if isinstance(result, _Failure):
+            raise result.exc_info[0], result.exc_info[1], result.exc_info[2]
+        return result
+
+# bytes read from the svn pipe and written to the client at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class PipeStream(object):
+    """Writes the stdout of cmd to an asynchronous RequestHandler chunk by
+    chunk and finishes the request at the end. The next chunk is only read
+    once the previous one has been flushed to the client, and svn is killed
+    if the client goes away. Responds 404 if svn fails before producing any
+    output.
+
+    Call from the IOLoop thread once the headers have been set.
+    """
+    def __init__(self, handler, cmd, io_loop=None, chunk_size=None):
+        self.handler = handler
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.chunk_size = chunk_size or STREAM_CHUNK_SIZE
+        self.written = 0
+        self.proc = Popen(cmd, stdout=PIPE, stderr=open(os.devnull, 'w'),
+            close_fds=True)
+        self.fd = self.proc.stdout.fileno()
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._resume()
+
+    def _resume(self):
+        if self.proc is not None:
+            self.io_loop.add_handler(self.fd, self._on_readable, self.io_loop.READ)
+
+    def _on_readable(self, fd, events):
+        try:
+            chunk = os.read(self.fd, self.chunk_size)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        self.io_loop.remove_handler(self.fd)
+        if not chunk:
+            return self._finish()
+        self.written += len(chunk)
+        self.handler.write(chunk)
+        self.handler.flush(callback=stack_context.wrap(self._resume))
+
+    def _finish(self):
+        proc, self.proc = self.proc, None
+        proc.stdout.close()
+        if proc.wait() and not self.written:
+            self.handler.send_error(404)
+        else:
+            self.handler.finish()
+
+    def close(self):
+        """Stops streaming and kills svn, for when the client has gone away"""
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            self.io_loop.remove_handler(self.fd)
+        except (KeyError, ValueError):
+            pass
+        svnbrowse._kill(proc)
+        proc.stdout.close()
+        proc.wait()
+
+class Iteration(object):
+    """Runs the generator func(*args, **kwargs) on the pool against `repo`
+    and passes each item it yields to on_item(item, resume) on the IOLoop.
+    The worker waits for resume() before producing the next item, so a slow
+    client holds svn back instead of the items piling up in memory.
+
+    callback(exc_info) is called at the end, with None if the generator
+    finished (or was cancelled) without raising. cancel() stops the
+    generator at the next item, e.g. when the client has gone away. An item
+    not taken within RESUME_TIMEOUT seconds, or by the deadline of the call,
+    stops it with Stalled.
+    """
+    def __init__(self, repo, func, args=(), kwargs=None, on_item=None,
+            callback=None, timeout=None, io_loop=None):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.on_item = stack_context.wrap(on_item)
+        self.callback = stack_context.wrap(callback)
+        self.cancelled = False
+        self._resumed = threading.Event()
+        timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+        self._deadline = time.time() + timeout if timeout else None
+        get_pool().submit(repo, self._run, (func, args, kwargs or {}),
+            timeout=timeout, callback=self._finished)
+
+    def _run(self, func, args, kwargs):
+        items = func(*args, **kwargs)
+        try:
+            for item in items:
+                if self.cancelled:
+                    break
+                self._resumed.clear()
+                self.io_loop.add_callback(lambda item=item: self._item(item))
+                wait = RESUME_TIMEOUT
+                if self._deadline is not None:
+                    wait = min(wait, max(self._deadline - time.time(), 0))
+                if not self._resumed.wait(wait):
+                    self.cancelled = True
+                    raise Stalled("no item taken in %.0fs" % wait)
+        finally:
+            items.close()
+
+    def _item(self, item):
+        if self.cancelled:
+            self._resumed.set()
+        else:
+            self.on_item(item, self._resumed.set)
+
+    def cancel(self):
+        self.cancelled = True
+        self._resumed.set()
+
+    def _finished(self, result):
+        self.callback(result.exc_info if isinstance(result, _Failure) else None)
@@ -0,0 +1,301 @@
+"""Reads local (file://) repositories through the Subversion python bindings.
+
+Most pages make a handful of small svn calls, and for those the cost of
+forking `svn`, having it write XML and parsing that back dominates. The
+functions here answer the same questions from inside the process and return
+the same data as their svnbrowse counterparts, which call them when
+svnbrowse.BACKEND allows it and the bindings are installed; everything else,
+and every non-local repository, still goes through the svn command line.
+
+Unlike the command line, paths are looked up at the revision asked for
+rather than traced from HEAD, which only matters for paths that have since
+been moved. The svn calls of a thread run in a pool of their own that is
+freed when the call returns, and each thread keeps its own handle on every
+repository it has opened.
+"""
+
+import posixpath
+import threading
+import urllib
+import urlparse
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import basename
+from subprocess import CalledProcessError
+
+try:
+    from svn import core, fs, repos
+    available = True
+except ImportError:
+    available = False
+
+import metrics
+import records
+
+_local = threading.local()
+
+_ACTIONS = {}
+if available:
+    _ACTIONS = {fs.path_change_modify: 'M', fs.path_change_add: 'A',
+        fs.path_change_delete: 'D', fs.path_change_replace: 'R'}
+
+@contextmanager
+def _pool():
+    pool = core.Pool()
+    try:
+        with metrics.timed('svn'):
+            yield pool
+    except core.SubversionException, e:
+        raise CalledProcessError(1, 'svn', str(e))
+    finally:
+        pool.destroy()
+
+def _open(repourl):
+    """Returns the fs of the repository holding repourl, the path within it
+    and the url of the repository root
+    """
+    local = posixpath.normpath(urllib.unquote(urlparse.urlparse(repourl).path))
+    opened = getattr(_local, 'repos', None)
+    if opened is None:
+        opened = _local.repos = {}
+    for root in opened:
+        if local == root or local.startswith(root + '/'):
+            break
+    else:
+        root = repos.find_root_path(local)
+        if root is None:
+            raise CalledProcessError(1, 'svn', "%s is not in a repository" % repourl)
+        opened[root] = repos.fs(repos.open(root))
+    return opened[root], local[len(root):] or '/', 'file://' + urllib.quote(root)
+
+def _revision(fsobj, rev, pool):
+    if rev in (None, '', 'HEAD'):
+        return fs.youngest_rev(fsobj, pool)
+    return int(rev)
+
+def _root(fsobj, rev, pool):
+    return fs.revision_root(fsobj, _revision(fsobj, rev, pool), pool)
+
+def _located(fsobj, path, rev, peg, pool):
+    """Returns the root of revision rev and the path there of the node at
+    path in revision peg (rev by default), following copies
+    """
+    peg = _revision(fsobj, peg or rev, pool)
+    rev = _revision(fsobj, rev, pool) if rev else peg
+    if peg != rev:
+        root = _root(fsobj, peg, pool)
+        _kind(root, path, pool)
+        history = fs.node_history(root, path, pool)
+        while True:
+            history = fs.history_prev(history, True, pool)
+            if history is None:
+                raise CalledProcessError(1, 'svn',
+                    "path %s@%d not found in r%d" % (path, peg, rev))
+            location, changed = fs.history_location(history, pool)
+            if changed <= rev:
+                path = location
+                break
+    return _root(fsobj, rev, pool), path
+
+def _kind(root, path, pool):
+    kind = fs.check_path(root, path, pool)
+    if kind == core.svn_node_dir:
+        return 'dir'
+    elif kind == core.svn_node_file:
+        return 'file'
+    raise CalledProcessError(1, 'svn', "path %s not found" % path)
+
+def _commit(fsobj, rev, pool):
+    """Returns the author, date and message of a revision"""
+    props = fs.revision_proplist(fsobj, rev, pool)
+    return (props.get(core.SVN_PROP_REVISION_AUTHOR) or '',
+        props.get(core.SVN_PROP_REVISION_DATE) or '',
+        props.get(core.SVN_PROP_REVISION_LOG) or None)
+
+def youngest(repourl):
+    with _pool() as pool:
+        fsobj, path, rooturl = _open(repourl)
+        return fs.youngest_rev(fsobj, pool)
+
+def info(repourl):
+    """Returns what `svn info repourl` says, keyed the way get_root_info
+    reads it
+    """
+    with _pool() as pool:
+        fsobj, path, rooturl = _open(repourl)
+        rev = fs.youngest_rev(fsobj, pool)
+        root = fs.revision_root(fsobj, rev, pool)
+        kind = _kind(root, path, pool)
+        changed = fs.node_created_rev(root, path, pool)
+        author, date, message = _commit(fsobj, changed, pool)
+        return {'path': basename(path.rstrip('/')) or basename(rooturl),
+            'url': repourl.rstrip('/'),
+            'repository_root': rooturl,
+            'repository_uuid': fs.get_uuid(fsobj, pool),
+            'revision': str(rev),
+            'node_kind': 'directory' if kind == 'dir' else 'file',
+            'last_changed_author': author,
+            'last_changed_rev': str(changed),
+            'last_changed_date': datetime.strptime(date[:19], "%Y-%m-%dT%H:%M:%S")
+                .strftime("%Y-%m-%d %H:%M:%S +0000 (%a, %d %b %Y)")}
+
+def list_repository(repourl, path, rev=None, recursive=False):
+    """See svnbrowse.list_repository"""
+    name = basename(repourl.strip("/"))
+    with _pool() as pool:
+        fsobj, base, rooturl = _open(repourl + "/" + path)
+        root = _root(fsobj, rev, pool)
+        commits = {}
+        if _kind(root, base, pool) == 'file':
+            children = [(basename(base), base, 'file')]
+        else:
+            children = _walk(root, base, '', recursive, pool)
+        for relpath, fullpath, kind in children:
+            changed = fs.node_created_rev(root, fullpath, pool)
+            if changed not in commits:
+                commits[changed] = _commit(fsobj, changed, pool)
+            author, date, message = commits[changed]
+            webpath = "/" + name
+            if path != "":
+                webpath += "/" + path
+            yield records.ListEntry(kind=kind,
+                name=relpath,
+                revision=str(changed),
+                author=author,
+                orig_date=date,
+                webpath=webpath + "/" + relpath,
+                size=str(fs.file_length(root, fullpath, pool))
+                    if kind == 'file' else None)
+
+def _walk(root, path, prefix, recursive, pool):
+    entries = fs.dir_entries(root, path, pool)
+    for name in sorted(entries):
+        fullpath = path.rstrip('/') + '/' + name
+        kind = 'dir' if entries[name].kind == core.svn_node_dir else 'file'
+        yield prefix + name, fullpath, kind
+        if recursive and kind == 'dir':
+            for child in _walk(root, fullpath, prefix + name + '/', True, pool):
+                yield child
+
+def list_repository2(repourl, path, rev=None, recursive=False):
+    """See svnbrowse.list_repository2"""
+    with _pool() as pool:
+        fsobj, base, rooturl = _open(repourl + "/" + path)
+        root = _root(fsobj, rev, pool)
+        uuid = fs.get_uuid(fsobj, pool)
+        try:
+            kind = _kind(root, base, pool)
+        except CalledProcessError:
+            return []
+        paths = [(base, kind)]
+        if kind == 'dir':
+            paths.extend((fullpath, kind) for relpath, fullpath, kind
+                in _walk(root, base, '', recursive, pool))
+        entries = []
+        for fullpath, kind in paths:
+            changed = fs.node_created_rev(root, fullpath, pool)
+            author, date, message = _commit(fsobj, changed, pool)
+            entries.append(records.DirEntry(kind=kind,
+                name=basename(fullpath.rstrip('/')) or basename(rooturl),
+                fullpath=urllib.quote(fullpath) if fullpath != '/' else '',
+                uuid=uuid,
+                revision=str(changed),
+                orig_date=date[:19],
+                author=author))
+        return entries
+
+def _range(fsobj, revision, pool):
+    """Returns the revisions (first, last) selected by a -r argument"""
+    if revision is None or str(revision) in ('', '0'):
+        revision = 'HEAD:1'
+    first, _, last = str(revision).partition(':')
+    first = _revision(fsobj, first, pool)
+    last = _revision(fsobj, last, pool) if last else first
+    return first, last
+
+def iter_history(repourl, revision=None, limit=None):
+    """See svnbrowse.iter_history"""
+    with _pool() as pool:
+        fsobj, path, rooturl = _open(repourl)
+        first, last = _range(fsobj, revision, pool)
+        newest, oldest = max(first, last), min(first, last)
+        if newest > fs.youngest_rev(fsobj, pool):
+            raise CalledProcessError(1, 'svn', "No such revision %d" % newest)
+        revisions = _history(fsobj, path, newest, oldest, pool)
+        if first < last:
+            revisions = reversed(list(revisions))
+        for count, rev in enumerate(revisions):
+            if limit and count >= int(limit):
+                break
+            yield _entry(fsobj, rev, pool)
+
+def _history(fsobj, path, newest, oldest, pool):
+    """Yields the revisions from newest down to oldest that changed path or
+    anything below it, following copies
+    """
+    root = fs.revision_root(fsobj, newest, pool)
+    history = fs.node_history(root, path, pool)
+    previous = None
+    while True:
+        history = fs.history_prev(history, True, pool)
+        if history is None:
+            break
+        location, rev = fs.history_location(history, pool)
+        if rev < oldest:
+            break
+        if rev != previous:
+            previous = rev
+            yield rev
+
+def _entry(fsobj, rev, pool):
+    author, date, message = _commit(fsobj, rev, pool)
+    root = fs.revision_root(fsobj, rev, pool)
+    paths = []
+    for path, change in sorted(fs.paths_changed2(root, pool).items()):
+        paths.append(records.ChangedPath(path,
+            {core.svn_node_dir: 'dir', core.svn_node_file: 'file'}.get(
+                change.node_kind, ''),
+            _ACTIONS.get(change.change_kind, 'M')))
+    return records.LogEntry(str(rev), author, date, message, paths)
+
+def list_messages(repourl, revisions):
+    """See svnbrowse.list_messages"""
+    with _pool() as pool:
+        fsobj, path, rooturl = _open(repourl)
+        return dict((str(rev), _commit(fsobj, int(rev), pool)[2])
+            for rev in set(int(r) for r in revisions))
+
+def get_size(repourl, rev=None, peg=None):
+    """See svnbrowse.get_size"""
+    with _pool() as pool:
+        fsobj, path, rooturl = _open(repourl)
+        root, path = _located(fsobj, path, rev, peg, pool)
+        if _kind(root, path, pool) != 'file':
+            return None
+        return fs.file_length(root, path, pool)
+
+def get_properties(repourl, rev=None, peg=None):
+    """See svnbrowse.get_properties"""
+    with _pool() as pool:
+        fsobj, path, rooturl = _open(repourl)
+        root, path = _located(fsobj, path, rev, peg, pool)
+        _kind(root, path, pool)
+        return dict(fs.node_proplist(root, path, pool))
+
+def cat_file(repourl, rev=None, peg=None):
+    """See svnbrowse.cat_file"""
+    with _pool() as pool:
+        fsobj, path, rooturl = _open(repourl)
+        root, path = _located(fsobj, path, rev, peg, pool)
+        if _kind(root, path, pool) != 'file':
+            raise CalledProcessError(1, 'svn', "%s is not a file" % path)
+        return core.Stream(fs.file_contents(root, path, pool)).read()
+
+def list_dir(repourl):
+    """Returns the sorted names of the entries of the directory at HEAD"""
+    with _pool() as pool:
+        fsobj, path, rooturl = _open(repourl)
+        root = _root(fsobj, None, pool)
+        if _kind(root, path, pool) != 'dir':
+            raise CalledProcessError(1, 'svn', "%s is not a directory" % path)
+        return sorted(fs.dir_entries(root, path, pool).keys())
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+import annotate
+import svnbrowse
+
+OLD = [(1, 'alice'), (1, 'alice'), (2, 'bob'), (1, 'alice')]
+
+class ApplyDiffTest(unittest.TestCase):
+    def test_changed_lines(self):
+        diff = ('Index: a.py\n===\n--- a.py\t(revision 2)\n+++ a.py\t(revision 3)\n'
+            '@@ -2,2 +2,2 @@\n one\n-two\n+deux\n')
+        self.assertEqual(annotate.apply_diff(OLD, diff, (3, 'carol')),
+            [(1, 'alice'), (1, 'alice'), (3, 'carol'), (1, 'alice')])
+
+    def test_hunks(self):
+        # a line added at the top, and the last one removed
+        diff = '@@ -0,0 +1 @@\n+zero\n@@ -4 +4,0 @@\n-four\n'
+        self.assertEqual(annotate.apply_diff(OLD, diff, (3, 'carol')),
+            [(3, 'carol'), (1, 'alice'), (1, 'alice'), (2, 'bob')])
+
+    def test_property_changes(self):
+        diff = ('@@ -1 +1 @@\n-one\n+un\n\nProperty changes on: a.py\n___\n'
+            'Added: svn:eol-style\n+ native\n')
+        self.assertEqual(annotate.apply_diff(OLD, diff, (3, 'carol')),
+            [(3, 'carol')] + OLD[1:])
+
+    def test_no_changes(self):
+        self.assertEqual(annotate.apply_diff(OLD, '', (3, 'carol')), OLD)
+
+    def test_diff_of_another_file(self):
+        with self.assertRaises(IndexError):
+            annotate.apply_diff(OLD, '@@ -5,2 +5,2 @@\n five\n six\n', (3, 'carol'))
+
+class EncodeTest(unittest.TestCase):
+    def test_round_trip(self):
+        for lines in (OLD, [], [(None, '')] * 3):
+            self.assertEqual([tuple(line) for line in
+                annotate._decode(annotate._encode(lines))], lines)
+
+    def test_runs(self):
+        runs = json.loads(zlib.decompress(str(annotate._encode(OLD))))
+        self.assertEqual(runs, [[1, 'alice', 2], [2, 'bob', 1], [1, 'alice', 1]])
+
+class AnnotationStoreTest(unittest.TestCase):
+    """Annotates from a made up history instead of asking svn"""
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.store = annotate.AnnotationStore(os.path.join(self.base, 'a.sqlite'))
+        self.history = []
+        self.diffs = {}
+        self.blamed = []
+        self.saved = (svnbrowse.file_history, svnbrowse.blame, svnbrowse.list_diff)
+        # the revisions and authors that changed the file, newest first
+        svnbrowse.file_history = lambda url, path, rev, limit=None, peg=None: \
+            [(step, path, author) for step, author in self.history if step <= rev]
+        svnbrowse.blame = self._blame
+        svnbrowse.list_diff = lambda url, from_path, from_rev, to_path, to_rev: \
+            self.diffs[from_rev, to_rev]
+
+    def tearDown(self):
+        svnbrowse.file_history, svnbrowse.blame, svnbrowse.list_diff = self.saved
+        shutil.rmtree(self.base)
+
+    def _blame(self, url, rev):
+        self.blamed.append((url, rev))
+        return [(rev, 'alice')] * 2
+
+    def test_non_ascii_path(self):
+        # as the annotate page passes it, unquoted from the listing
+        path = u'/trunk/résumé.txt'.encode('utf-8')
+        self.history = [(3, 'alice')]
+        self.assertEqual(self.store.annotate('demo', 'file:///demo', path, 3),
+            [(3, 'alice')] * 2)
+        self.assertEqual(self.store.get('demo', path, 3), [(3, 'alice')] * 2)
+        self.assertEqual(self.store.get('demo', path.decode('utf-8'), 3),
+            [(3, 'alice')] * 2)
+
+    def test_carried_through_diff(self):
+        path = u'/trunk/résumé.txt'
+        self.history = [(5, 'bob'), (3, 'alice')]
+        self.store.annotate('demo', 'file:///demo', path, 3)
+        self.diffs[3, 5] = '@@ -1,2 +1,3 @@\n one\n+new\n two\n'
+        self.assertEqual(self.store.annotate('demo', 'file:///demo',
+            path.encode('utf-8'), 5), [(3, 'alice'), (5, 'bob'), (3, 'alice')])
+        self.assertEqual(self.blamed, [(u'file:///demo' + path, 3)])
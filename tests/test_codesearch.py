@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import codesearch
+import svnbrowse
+
+FILES = {
+    'file:///demo/trunk/a.py': 'def Parse(line):\n    return line.split()\n',
+    # every trigram of "parse" without the word itself
+    'file:///demo/trunk/b.txt': 'par ars rse\n',
+    'file:///demo/trunk/lib/c.py': 'import a\na.parse("x")\n',
+    'file:///demo/trunk/data.bin': 'parse\0\1\2',
+    'file:///other/trunk/d.py': 'PARSE = 1\n',
+}
+
+class SearchIndexTest(unittest.TestCase):
+    """Indexes FILES instead of asking svn for them"""
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.index = codesearch.SearchIndex(os.path.join(self.base, 's.sqlite'))
+        self.cat_file = svnbrowse.cat_file
+        svnbrowse.cat_file = lambda url, rev=None, peg=None: FILES[url]
+        for url in sorted(FILES):
+            repo, path = url[len('file:///'):].split('/', 1)
+            self.index._add_file(repo, 'file:///' + repo, path, 1)
+
+    def tearDown(self):
+        svnbrowse.cat_file = self.cat_file
+        shutil.rmtree(self.base)
+
+    def _found(self, query, repos=None):
+        return [(r['repo'], r['path']) for r in self.index.search(query, repos)]
+
+    def test_matches_all_trigrams_and_the_text(self):
+        self.assertEqual(self._found('parse'), [('demo', 'trunk/a.py'),
+            ('demo', 'trunk/lib/c.py'), ('other', 'trunk/d.py')])
+
+    def test_matching_lines(self):
+        result = self.index.search('PARSE(', ['demo'])
+        self.assertEqual([(r['path'], r['lines']) for r in result],
+            [('trunk/a.py', [(1, u'def Parse(line):')]),
+            ('trunk/lib/c.py', [(2, u'a.parse("x")')])])
+
+    def test_repos(self):
+        self.assertEqual(self._found('parse', ['other']), [('other', 'trunk/d.py')])
+
+    def test_too_short(self):
+        self.assertEqual(self._found('pa'), [])
+
+    def test_removed_directory(self):
+        self.index._remove('demo', 'trunk/lib')
+        self.assertEqual(self._found('parse', ['demo']), [('demo', 'trunk/a.py')])
+        self.assertEqual(self.index.db.execute('SELECT COUNT(*) FROM trigrams'
+            ' WHERE file NOT IN (SELECT id FROM files)').fetchone()[0], 0)
@@ -0,0 +1,100 @@
+import unittest
+
+try:
+    import ldap
+except ImportError:
+    ldap = None
+else:
+    from auth import ldapauth
+
+USERS = {'alice': 'secret', 'bob': 'hunter2'}
+GROUPS = {'Svnusers': ['alice']}
+
+class FakeDirectory(object):
+    """A connection to a directory of USERS and GROUPS, noting what it is
+    asked in calls
+    """
+    def __init__(self):
+        self.calls = []
+
+    def simple_bind_s(self, dn, pwd):
+        self.calls.append(('bind', dn))
+        if dn and USERS.get(dn.split(',')[0][len('uid='):]) != pwd:
+            raise ldap.INVALID_CREDENTIALS()
+
+    def search_st(self, base, scope, filterstr, attrlist, timeout=None):
+        self.calls.append(('search', base))
+        attr, value = filterstr.strip('()').split('=', 1)
+        if base == ldapauth.LDAP_SEARCH_BASE:
+            return [('uid=%s,%s' % (value, base), {})] if value in USERS else []
+        if value in GROUPS:
+            return [('cn=%s,%s' % (value, base), {ldapauth.LDAP_GROUP_MEMBER_ATTR:
+                GROUPS[value]})]
+        return []
+
+    def unbind_s(self):
+        self.calls.append(('unbind',))
+
+@unittest.skipUnless(ldap, "python-ldap isn't installed")
+class AuthenticatorTest(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+        self.timeout = ldapauth.TIMEOUT
+        ldapauth.TIMEOUT = 0.1
+        self.authenticator = ldapauth.Authenticator(self._connect, size=1)
+
+    def tearDown(self):
+        ldapauth.TIMEOUT = self.timeout
+
+    def _connect(self):
+        self.connections.append(FakeDirectory())
+        return self.connections[-1]
+
+    def _binds(self):
+        return [call for conn in self.connections for call in conn.calls
+            if call[0] == 'bind']
+
+    def test_cached_login_does_not_bind(self):
+        self.assertTrue(self.authenticator.authenticate('alice', 'secret', 'Svnusers'))
+        binds = len(self._binds())
+        self.assertTrue(self.authenticator.authenticate('alice', 'secret', 'Svnusers'))
+        self.assertEqual(len(self._binds()), binds)
+        # a different password is not let in from the cache
+        self.assertFalse(self.authenticator.authenticate('alice', 'guess', 'Svnusers'))
+        self.assertTrue(len(self._binds()) > binds)
+
+    def test_bad_password_is_rejected_before_the_group(self):
+        self.assertFalse(self.authenticator.authenticate('alice', 'guess', 'Svnusers'))
+        searched = [call[1] for call in self.connections[0].calls
+            if call[0] == 'search']
+        self.assertEqual(searched, [ldapauth.LDAP_SEARCH_BASE])
+        self.assertFalse(self.authenticator.cached('alice', 'guess', 'Svnusers'))
+
+    def test_user_not_in_group(self):
+        self.assertFalse(self.authenticator.authenticate('bob', 'hunter2', 'Svnusers'))
+        self.assertFalse(self.authenticator.cached('bob', 'hunter2', 'Svnusers'))
+
+    def test_unknown_user(self):
+        self.assertFalse(self.authenticator.authenticate('carol', 'secret', 'Svnusers'))
+
+    def test_pool_exhausted(self):
+        with self.authenticator._connection():
+            with self.assertRaises(ldapauth.Unavailable):
+                with self.authenticator._connection():
+                    pass
+            self.assertFalse(self.authenticator.authenticate('alice', 'secret',
+                'Svnusers'))
+        # the connection is lent again once it is back
+        self.assertTrue(self.authenticator.authenticate('alice', 'secret', 'Svnusers'))
+        self.assertEqual(len(self.connections), 1)
+
+    def test_failed_connection_is_not_reused(self):
+        def broken(*args, **kwargs):
+            raise ldap.SERVER_DOWN()
+        conn = self._connect()
+        conn.search_st = broken
+        self.authenticator._idle.append(conn)
+        self.authenticator._open = 1
+        self.assertFalse(self.authenticator.authenticate('alice', 'secret', 'Svnusers'))
+        self.assertIn(('unbind',), conn.calls)
+        self.assertTrue(self.authenticator.authenticate('alice', 'secret', 'Svnusers'))
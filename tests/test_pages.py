@@ -0,0 +1,54 @@
+import shutil
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+
+import benchmark
+import svnbrowse
+
+@unittest.skipUnless(find_executable('svnadmin'), "svnadmin is needed to build the fixture")
+class ColdPageTest(unittest.TestCase):
+    """Counts the svn processes pages of the small benchmark fixture start
+    when nothing is cached yet
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.base = tempfile.mkdtemp()
+        cls.fixture = benchmark.Fixture('small', cls.base)
+        cls.fixture.build()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.base)
+
+    def setUp(self):
+        # the svn bindings would serve the fixture without any processes
+        self.backend = svnbrowse.BACKEND
+        svnbrowse.BACKEND = 'cli'
+
+    def tearDown(self):
+        svnbrowse.BACKEND = self.backend
+
+    def _commands(self, path):
+        result = benchmark._isolated(benchmark._run_handler, self.fixture, path, 0)
+        self.assertNotIn('error', result, result.get('error'))
+        return result['svn_cold']
+
+    def test_file_page(self):
+        # the file and its size come from the tree summary, leaving its
+        # properties and its contents
+        self.assertEqual(self._commands('/%s/%s' % (self.fixture.name,
+            self.fixture.module)), 2)
+
+    def test_unchanged_file_of_a_tag(self):
+        # last changed in r1, before the tag was copied from trunk in r2
+        path = '/%s/%s/src/module_0.py' % (self.fixture.name, self.fixture.tag)
+        for page in (path, path + '@%d' % self.fixture.youngest, '/annotate' + path,
+                '/raw%s?rev=1' % path):
+            self._commands(page)
+
+    def test_unchanged_file_of_a_tag_natively(self):
+        svnbrowse.BACKEND = 'native'
+        if not svnbrowse._native(self.fixture.url):
+            self.skipTest("the svn python bindings aren't installed")
+        self.test_unchanged_file_of_a_tag()
@@ -0,0 +1,51 @@
+import cPickle
+import pickle
+import unittest
+
+import records
+
+class RecordTest(unittest.TestCase):
+    def _entry(self):
+        return records.LogEntry('12', 'alice', '2011-10-02T10:00:00.000000Z', 'fix',
+            [records.ChangedPath('/trunk/a.py', 'file', 'M')])
+
+    def test_read_like_a_dict(self):
+        entry = records.DirEntry(kind='file', name='a.py', size=None)
+        self.assertEqual(entry['name'], 'a.py')
+        self.assertEqual(entry.get('kind'), 'file')
+        self.assertEqual(entry.get('size', 0), 0)
+        self.assertFalse('size' in entry)
+        self.assertTrue('name' in entry)
+        with self.assertRaises(KeyError):
+            entry['nonsense']
+        entry['size'] = 10
+        self.assertEqual(entry.size, 10)
+
+    def test_slots(self):
+        entry = records.ListEntry('file', 'a.py')
+        self.assertFalse(hasattr(entry, '__dict__'))
+        self.assertEqual(entry.revision, None)
+        with self.assertRaises(AttributeError):
+            entry.nonsense = 1
+        self.assertEqual(sorted(entry.as_dict()), sorted(records.ListEntry.__slots__))
+        self.assertEqual(entry.as_dict()['name'], 'a.py')
+
+    def test_pickle(self):
+        entry = self._entry()
+        for module in (pickle, cPickle):
+            for protocol in (0, pickle.HIGHEST_PROTOCOL):
+                copy = module.loads(module.dumps(entry, protocol))
+                self.assertEqual(type(copy), records.LogEntry)
+                self.assertEqual(copy.as_dict(), entry.as_dict())
+                self.assertEqual(copy['paths'][0]['action'], 'M')
+                self.assertEqual(type(copy.paths[0]), records.ChangedPath)
+
+    def test_changed_path(self):
+        path = records.ChangedPath('/trunk/a.py', 'file', 'M')
+        self.assertEqual(path['path'], path.path)
+        self.assertEqual(path[2], 'M')
+        self.assertEqual(path.get('copyfrom'), None)
+
+    def test_date(self):
+        entry = self._entry()
+        self.assertEqual(entry.date, records.svnbrowse.format_date(entry.orig_date))
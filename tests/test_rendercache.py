@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import rendercache
+
+class DiskStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _age(self, key, seconds):
+        then = time.time() - seconds
+        os.utime(os.path.join(self.path, key), (then, then))
+
+    def test_round_trip(self):
+        store = rendercache.DiskStore(self.path, 1000)
+        store.set('render_a', 'x' * 10)
+        self.assertEqual(store.get('render_a'), 'x' * 10)
+        self.assertEqual(store.get('render_b'), None)
+
+    def test_evicts_least_recently_used(self):
+        store = rendercache.DiskStore(self.path, 1000)
+        for i, key in enumerate(['render_a', 'render_b', 'render_c']):
+            store.set(key, 'x' * 300)
+            self._age(key, 100 - i)
+        # reading a makes b the least recently used
+        store.get('render_a')
+        store.set('render_d', 'x' * 300)
+        self.assertEqual(store.get('render_b'), None)
+        for key in ['render_a', 'render_c', 'render_d']:
+            self.assertEqual(store.get(key), 'x' * 300)
+        self.assertTrue(store.size <= 1000)
+
+    def test_counts_what_is_there_already(self):
+        rendercache.DiskStore(self.path, 1000).set('render_a', 'x' * 600)
+        self._age('render_a', 10)
+        store = rendercache.DiskStore(self.path, 1000)
+        self.assertEqual(store.size, 600)
+        store.set('render_b', 'x' * 600)
+        self.assertEqual(store.get('render_a'), None)
+        self.assertEqual(store.get('render_b'), 'x' * 600)
+
+    def test_skips_values_over_the_budget(self):
+        store = rendercache.DiskStore(self.path, 100)
+        store.set('render_a', 'x' * 101)
+        self.assertEqual(os.listdir(self.path), [])
+
+if __name__ == '__main__':
+    unittest.main()
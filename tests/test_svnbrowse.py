@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import svnbrowse
+
+LOG = """<?xml version="1.0" encoding="UTF-8"?>
+<log>
+<logentry revision="2">
+<author>alice</author>
+<date>2011-10-02T10:00:00.000000Z</date>
+<paths>
+<path kind="file" action="M">/trunk/a.py</path>
+<path kind="dir" action="A">/trunk/d</path>
+</paths>
+<msg>two</msg>
+</logentry>
+<logentry revision="1">
+<date>2011-10-01T10:00:00.000000Z</date>
+<msg>one</msg>
+</logentry>
+</log>
+"""
+
+DIFF = """Index: trunk/a.py
+===================================================================
+--- trunk/a.py\t(revision 1)
++++ trunk/a.py\t(revision 2)
+@@ -1,2 +1,3 @@
+ x
+-y
++z
++w
+Index: trunk/big.txt
+===================================================================
+--- trunk/big.txt\t(revision 1)
++++ trunk/big.txt\t(revision 2)
+@@ -0,0 +1,2 @@
++%s
++%s
+
+Property changes on: trunk/big.txt
+___________________________________________________________________
+Added: svn:eol-style
++ native
+""" % ('a' * 200, 'b' * 200)
+
+class LogParserTest(unittest.TestCase):
+    def test_entries(self):
+        entries = list(svnbrowse.LogParser(StringIO(LOG)))
+        self.assertEqual([e['revision'] for e in entries], ['2', '1'])
+        self.assertEqual(entries[0]['author'], 'alice')
+        self.assertEqual([(p['path'], p['kind'], p['action']) for p in entries[0]['paths']],
+            [('/trunk/a.py', 'file', 'M'), ('/trunk/d', 'dir', 'A')])
+        self.assertEqual(entries[0]['message'], 'two')
+        # svn leaves out the author of an anonymous commit
+        self.assertEqual(entries[1]['author'], '')
+        self.assertEqual(entries[1]['paths'], [])
+
+class DiffTest(unittest.TestCase):
+    """Reads the diffs from a file instead of running svn"""
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, DIFF)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_split_diff(self):
+        sections = list(svnbrowse._split_diff(['cat', self.path], None))
+        self.assertEqual([path for path, diff, size in sections],
+            ['trunk/a.py', 'trunk/big.txt'])
+        self.assertEqual(''.join(diff for path, diff, size in sections), DIFF)
+        self.assertEqual([size for path, diff, size in sections],
+            [len(diff) for path, diff, size in sections])
+
+    def test_split_diff_leaves_out_large_files(self):
+        (a, a_diff, a_size), (big, big_diff, big_size) = \
+            svnbrowse._split_diff(['cat', self.path], 300)
+        self.assertTrue(a_diff.endswith('+w\n'))
+        self.assertEqual(big_diff, None)
+        self.assertEqual(a_size + big_size, len(DIFF))
+
+    def test_count_lines(self):
+        command = svnbrowse.change_command
+        svnbrowse.change_command = lambda repourl, path, rev: ['cat', self.path]
+        try:
+            counts = svnbrowse.count_lines('file:///demo', 2)
+        finally:
+            svnbrowse.change_command = command
+        # neither the ---/+++ headers nor the property changes count
+        self.assertEqual(counts, {'trunk/a.py': [2, 1], 'trunk/big.txt': [2, 0]})
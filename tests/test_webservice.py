@@ -0,0 +1,38 @@
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+
+ETAG = '"0123abcd"'
+
+HEADERS = [
+    ('', False),
+    (ETAG, True),
+    ('W/' + ETAG, True),
+    ('"other"', False),
+    ('"other", ' + ETAG, True),
+    ('"other",\t W/' + ETAG + ' ', True),
+    ('"other", W/"other2"', False),
+    ('*', True),
+    ('"0123abc"', False),
+]
+
+def _matches(fixture):
+    # webservice needs settings, which the benchmark makes up for the fixture
+    webservice = benchmark._application(fixture)
+    return [webservice._etag_matches(header, ETAG) for header, expected in HEADERS]
+
+class EtagTest(unittest.TestCase):
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_if_none_match(self):
+        # the fixture is never built, only its paths are used
+        matches = benchmark._isolated(_matches, benchmark.Fixture('small', self.base))
+        self.assertNotIn('error', matches, matches)
+        self.assertEqual(zip([header for header, expected in HEADERS], matches),
+            [(header, expected) for header, expected in HEADERS])
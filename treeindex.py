@@ -0,0 +1,328 @@
+"""A summary of the HEAD tree of every repository.
+
+Each file and directory is stored with the revision that last changed it,
+that revision's author, date and message, and its size and number of files,
+counted recursively for directories. Listing a directory is then a lookup of
+the children of its node, however many there are, and the listing can show
+sizes and messages that would otherwise take more svn calls.
+
+update() lists the whole tree once. After that each new revision is applied
+from the paths its log entry reports as changed: deleted subtrees are
+dropped, added and modified paths are listed at that revision, and the
+sizes and last changes of their ancestors are adjusted to match.
+
+The top level directories in EXCLUDED_DIRS are summarized as themselves
+only, without their contents or sizes: they mostly hold copies of trunk,
+each as large as trunk itself. Listings in them come from svn.
+"""
+
+import logging
+import posixpath
+import sqlite3
+import threading
+import urllib
+
+import records
+import revindex
+import svnbrowse
+
+# where the summary is stored
+TREE_PATH = '/tmp/octopy-tree.sqlite'
+
+# number of revisions fetched per `svn log` call while catching up
+CHUNK_SIZE = 1000
+
+# top level directories whose contents are not summarized, they mostly hold
+# copies of trunk
+EXCLUDED_DIRS = ('tags', 'branches')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    repo TEXT NOT NULL,
+    path TEXT NOT NULL,
+    parent TEXT,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    author TEXT NOT NULL,
+    date TEXT NOT NULL,
+    message TEXT,
+    size INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    PRIMARY KEY (repo, path)
+);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (repo, parent, name);
+CREATE TABLE IF NOT EXISTS indexed (
+    repo TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL,
+    uuid TEXT NOT NULL
+);
+"""
+
+def _ancestors(path, base='/'):
+    """Yields the directories above path, up to and including base"""
+    while path != base and path != '/':
+        path = posixpath.dirname(path)
+        yield path
+
+def _excluded(path):
+    """Whether path is one of EXCLUDED_DIRS or below one"""
+    return path.strip('/').split('/')[0] in EXCLUDED_DIRS
+
+def _below(path):
+    """The where clause matching path and everything below it, as a range
+    so it can use the index ('0' sorts right after '/')
+    """
+    if path == '/':
+        return 'path >= ?', ['/']
+    return '(path = ? OR (path >= ? AND path < ?))', [path, path + '/', path + '0']
+
+class TreeIndex(object):
+    """The tree summary. Safe to share between threads, each thread gets its
+    own connection.
+    """
+    def __init__(self, path=None):
+        self.path = path or TREE_PATH
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def revision(self, repo):
+        """Returns the revision the summary of repo is at, 0 if none"""
+        row = self.db.execute('SELECT revision FROM indexed WHERE repo = ?',
+            (repo,)).fetchone()
+        return row[0] if row else 0
+
+    def update(self, repo, url):
+        """Brings the summary of repo up to its youngest revision. Returns
+        the number of revisions applied.
+        """
+        with self._lock:
+            last = self.revision(repo)
+            youngest = svnbrowse.youngest(url)
+            if last >= youngest:
+                return 0
+            if not last:
+                self._build(repo, url, youngest)
+                return youngest
+            applied = 0
+            while last < youngest:
+                upto = min(last + CHUNK_SIZE, youngest)
+                for entry in svnbrowse.iter_history(url, '%d:%d' % (last + 1, upto)):
+                    with self.db as db:
+                        self._apply(db, repo, url, entry)
+                        db.execute('UPDATE indexed SET revision = ? WHERE repo = ?',
+                            (int(entry['revision']), repo))
+                    applied += 1
+                with self.db as db:
+                    db.execute('UPDATE indexed SET revision = ? WHERE repo = ?',
+                        (upto, repo))
+                last = upto
+            return applied
+
+    def update_all(self, repositories):
+        """Updates every repository in the name -> url dict, logging failures"""
+        for name, url in sorted(repositories.items()):
+            try:
+                applied = self.update(name, url)
+                if applied:
+                    logging.info("applied %d revisions to the tree of %s", applied, name)
+            except Exception:
+                logging.exception("failed to update the tree summary of %s", name)
+
+    def _build(self, repo, url, youngest):
+        head = svnbrowse.list_history(url, youngest)[0]
+        uuid = svnbrowse.list_repository2(url, '', youngest)[0]['uuid']
+        entries = []
+        for top in svnbrowse.list_repository(url, '', rev=youngest):
+            entries.append(top)
+            if top['kind'] == 'dir' and not _excluded(top['name']):
+                for e in svnbrowse.list_repository(url, top['name'], rev=youngest,
+                        recursive=True):
+                    e['name'] = posixpath.join(top['name'], e['name'])
+                    entries.append(e)
+        messages = self._messages(repo, url, [e['revision'] for e in entries])
+        with self.db as db:
+            db.execute('DELETE FROM nodes WHERE repo = ?', (repo,))
+            self._insert(db, repo, '/', head, entries, messages)
+            db.execute('INSERT OR REPLACE INTO indexed VALUES (?, ?, ?)',
+                (repo, youngest, uuid))
+
+    def _apply(self, db, repo, url, entry):
+        """Applies the changes of the log entry of one revision"""
+        rev = int(entry['revision'])
+        listed = []
+        touched = set()
+        for change in sorted(entry['paths'], key=lambda p: p['path']):
+            path = '/' + change['path'].strip('/')
+            touched.update(_ancestors(path))
+            if any(path == l or path.startswith(l + '/') for l in listed):
+                # already listed as part of a directory added in rev
+                continue
+            if _excluded(posixpath.dirname(path)):
+                # not summarized, see EXCLUDED_DIRS
+                continue
+            action = change['action']
+            kind = change.get('kind') or self._kind(db, repo, url, path, rev, action)
+            if action == 'M' and kind == 'dir':
+                # a property change
+                touched.add(path)
+                continue
+            if action in ('D', 'R', 'M'):
+                self._adjust(db, repo, path, *self._remove(db, repo, path))
+            if action == 'D':
+                continue
+            if kind == 'dir' and _excluded(path):
+                # the directory itself, without its contents
+                entries = []
+            else:
+                entries = list(svnbrowse.list_repository(url, path.lstrip('/'), rev,
+                    recursive=kind == 'dir'))
+            messages = self._messages(repo, url, [e['revision'] for e in entries])
+            if kind == 'dir':
+                listed.append(path)
+                totals = self._insert(db, repo, path, entry, entries, messages)
+            else:
+                totals = self._insert_file(db, repo, path, entries[0], messages)
+            self._adjust(db, repo, path, *totals)
+        # whatever holds a changed path was last changed in rev
+        touched = [p for p in touched
+            if not any(p == l or p.startswith(l + '/') for l in listed)]
+        for i in xrange(0, len(touched), 500):
+            chunk = touched[i:i + 500]
+            db.execute('UPDATE nodes SET revision = ?, author = ?, date = ?, message = ?'
+                ' WHERE repo = ? AND path IN (%s)' % ','.join('?' * len(chunk)),
+                [rev, entry['author'] or '', entry['orig_date'], entry['message'], repo]
+                    + chunk)
+
+    def _kind(self, db, repo, url, path, rev, action):
+        """The kind of a changed path, for logs that don't say"""
+        if action != 'A':
+            row = db.execute('SELECT kind FROM nodes WHERE repo = ? AND path = ?',
+                (repo, path)).fetchone()
+            if row or action == 'D':
+                return row and row[0]
+        return 'dir' if svnbrowse.get_size(url + path, rev) is None else 'file'
+
+    def _insert(self, db, repo, base, commit, entries, messages):
+        """Stores the directory base, last changed in the log entry commit,
+        and the list_repository entries below it. Returns the size and file
+        count of base.
+        """
+        rows = {base: ['dir', int(commit['revision']), commit['author'] or '',
+            commit['orig_date'], commit['message'], 0, 0]}
+        for e in entries:
+            if e['name'] in ('', '.'):
+                continue
+            path = posixpath.join(base, e['name'])
+            size = int(e['size'] or 0) if e['kind'] == 'file' else 0
+            rows[path] = [e['kind'], int(e['revision']), e['author'] or '',
+                e['orig_date'], messages.get(e['revision']), size, 0]
+        for path, row in rows.items():
+            if row[0] == 'file':
+                row[6] = 1
+                for parent in _ancestors(path, base):
+                    rows[parent][5] += row[5]
+                    rows[parent][6] += 1
+        db.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(repo, path, posixpath.dirname(path) if path != '/' else None,
+                posixpath.basename(path)) + tuple(row) for path, row in rows.items()])
+        return rows[base][5], rows[base][6]
+
+    def _insert_file(self, db, repo, path, e, messages):
+        size = int(e['size'] or 0)
+        db.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (repo, path, posixpath.dirname(path), posixpath.basename(path), 'file',
+                int(e['revision']), e['author'] or '', e['orig_date'],
+                messages.get(e['revision']), size, 1))
+        return size, 1
+
+    def _remove(self, db, repo, path):
+        """Drops path and everything below it, returns minus its size and
+        file count
+        """
+        row = db.execute('SELECT size, files FROM nodes WHERE repo = ? AND path = ?',
+            (repo, path)).fetchone()
+        if row is None:
+            return 0, 0
+        where, args = _below(path)
+        db.execute('DELETE FROM nodes WHERE repo = ? AND ' + where, [repo] + args)
+        return -row[0], -row[1]
+
+    def _adjust(self, db, repo, path, size, files):
+        """Adds size and files to the totals of the directories above path"""
+        parents = list(_ancestors(path))
+        if parents and (size or files):
+            db.execute('UPDATE nodes SET size = size + ?, files = files + ?'
+                ' WHERE repo = ? AND path IN (%s)' % ','.join('?' * len(parents)),
+                [size, files, repo] + parents)
+
+    def _messages(self, repo, url, revisions):
+        revisions = set(revisions)
+        messages = revindex.get_index().messages(repo, revisions)
+        missing = revisions - set(messages.keys())
+        if missing:
+            messages.update(svnbrowse.list_messages(url, sorted(missing)))
+        return messages
+
+    def listing(self, repo, path, youngest=None, sort='name', descending=False,
+            offset=0, limit=None):
+        """Returns (node, entries, total): the records.DirEntry of the
+        directory at path, those of the entries from offset on (up to limit
+        of them) in the order given by sort, one of SORT_KEYS, and the
+        number of entries. A file has no entries. None if path isn't in the
+        summary, is in EXCLUDED_DIRS, or the summary is older than youngest.
+        """
+        row = self.db.execute('SELECT revision, uuid FROM indexed WHERE repo = ?',
+            (repo,)).fetchone()
+        if row is None or (youngest and row[0] < int(youngest)):
+            return None
+        uuid = row[1]
+        path = '/' + path.strip('/')
+        if _excluded(path):
+            return None
+        node = self.db.execute('SELECT ' + _COLUMNS + ' FROM nodes'
+            ' WHERE repo = ? AND path = ?', (repo, path)).fetchone()
+        if node is None:
+            return None
+        if node[0] != 'dir':
+            return _record(node, uuid), [], 0
+        total = self.db.execute('SELECT COUNT(*) FROM nodes WHERE repo = ? AND parent = ?',
+            (repo, path)).fetchone()[0]
+        order = ' DESC' if descending else ''
+        rows = self.db.execute('SELECT ' + _COLUMNS + ' FROM nodes'
+            ' WHERE repo = ? AND parent = ? ORDER BY %s%s, name%s LIMIT ? OFFSET ?'
+            % (SORT_KEYS[sort], order, order),
+            (repo, path, limit if limit is not None else -1, offset))
+        return _record(node, uuid), [_record(r, uuid) for r in rows], total
+
+_COLUMNS = 'kind, name, path, revision, author, date, message, size, files'
+
+# the columns listings can be sorted by
+SORT_KEYS = {'name': 'name', 'size': 'size', 'date': 'date', 'author': 'author'}
+
+def _record(row, uuid):
+    kind, name, path, revision, author, date, message, size, files = row
+    if path != '/' and _excluded(path):
+        # the size of what isn't summarized is unknown
+        size = files = None
+    return records.DirEntry(kind, name,
+        urllib.quote(path.encode('utf-8')) if path != '/' else '',
+        str(revision), date[:19], author, size, files, message, uuid)
+
+_index = None
+
+def get_index():
+    """Returns the process wide tree summary, opening it on first use"""
+    global _index
+    if _index is None:
+        _index = TreeIndex()
+    return _index
@@ -0,0 +1,79 @@
+"""Notices new commits so cached data can be brought up to date as soon as
+they happen rather than when a TTL runs out.
+
+Commits are reported either by the post-commit hook in hooks/post-commit,
+which posts to /hooks/post-commit, or found by polling the youngest revision
+of every repository each POLL_INTERVAL seconds. For local FSFS repositories
+that is a read of db/current, so polling hundreds of them costs next to
+nothing.
+"""
+
+import logging
+import os
+import threading
+import urllib
+import urlparse
+
+import svnbrowse
+
+# seconds between polls of the youngest revisions, 0 to rely on the hook
+# only, which a server of more than one process refuses
+POLL_INTERVAL = 10
+
+# addresses allowed to post to /hooks/post-commit
+HOOK_ADDRESSES = ('127.0.0.1', '::1')
+
+def youngest(url):
+    """Returns the youngest revision of the repository at url, without
+    running svn if it is a local FSFS repository
+    """
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == 'file':
+        try:
+            with open(os.path.join(urllib.unquote(parsed.path), 'db', 'current')) as f:
+                return int(f.read().split()[0])
+        except (IOError, ValueError, IndexError):
+            pass
+    return svnbrowse.youngest(url)
+
+class Watcher(object):
+    """Remembers the youngest revision seen of each repository"""
+    def __init__(self):
+        self.known = {}
+        self._lock = threading.Lock()
+
+    def seen(self, name, revision):
+        """Records revision as the youngest of name, returns whether that is
+        news. A revision older than the youngest known, from a late poll or
+        an out of order hook, is ignored.
+        """
+        with self._lock:
+            if revision <= self.known.get(name, 0):
+                return False
+            self.known[name] = revision
+            return True
+
+    def poll(self, repositories):
+        """Returns the names of the repositories in the name -> url dict that
+        have been committed to since the last poll; all of them the first
+        time. Blocks, run it on a worker.
+        """
+        changed = []
+        for name, url in sorted(repositories.items()):
+            try:
+                revision = youngest(url)
+            except Exception:
+                logging.exception("failed to get the youngest revision of %s", name)
+                continue
+            if self.seen(name, revision):
+                changed.append(name)
+        return changed
+
+_watcher = None
+
+def get_watcher():
+    """Returns the process wide watcher, creating it on first use"""
+    global _watcher
+    if _watcher is None:
+        _watcher = Watcher()
+    return _watcher
@@ -1,29 +1,181 @@
 #! env/bin/python
 
 import argparse
+import copy
+import functools
+import glob
+import hashlib
+import logging
 import os
-import random
-import string
+import re
+import threading
+import urllib
 from pprint import pprint
 
+import annotate
+import cache
+import codesearch
+import dashboard
+import highlighter
+import metrics
+import pagedata
+import rendercache
+import revindex
+import server
+import sessions
 import svnbrowse
+import svnexec
 import svnmanage
+import treeindex
+import watcher
+import tornado.autoreload
+import tornado.escape
 import tornado.ioloop
 import tornado.web
-import memcache
+from tornado import gen, stack_context
 
 import settings
 
 parser = argparse.ArgumentParser(description="""Starts up a webserver on port 5000
     serving all the local svn repositories""")
+parser.add_argument('--port', type=int, default=5000,
+    help="port to listen on")
+parser.add_argument('--address', default='',
+    help="address to listen on, all of them by default")
+parser.add_argument('--processes', type=int, default=None,
+    help="number of worker processes, 0 for one per core (server.PROCESSES)")
+parser.add_argument('--debug', action='store_true',
+    help="serve from a single process that reloads itself when a module changes")
+
+# number of log entries on each page of /history
+HISTORY_PAGE_SIZE = 50
+
+# number of recent changes shown in the sidebar of the repository pages
+RECENT_CHANGES = 10
+
+# number of entries on each page of a directory listing
+DIR_PAGE_SIZE = 200
+
+# the diff of a file larger than this many bytes is only loaded on request
+DIFF_COLLAPSE_BYTES = 256 * 1024
+
+DIFF_PLACEHOLDER = '<!-- diff -->'
+
+# seconds clients may keep a page pinned to a revision without asking again
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def _page_version():
+    """A digest of the code, templates and settings making the pages, so
+    that pages kept by clients don't outlive a change to them
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(root, '*.py')) +
+            glob.glob(os.path.join(root, 'templates', '*.html'))):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+_PAGE_VERSION = _page_version()
+
+_PINNED = re.compile(r'^(.*)@(\d+)$')
+
+def _pinned(path):
+    """Splits path@revision into the path and the revision, None if path
+    isn't pinned to one
+    """
+    match = _PINNED.match(path)
+    if match is None:
+        return path, None
+    return match.group(1), int(match.group(2))
 
 class RequestHandler(tornado.web.RequestHandler):
     def get_current_user(self):
-        mc = memcache.Client(['127.0.0.1:11211'], debug=0)
+        return sessions.get_store().get(self.get_secure_cookie('octopy_session_id'))
+
+    def __init__(self, application, request, **kwargs):
+        super(RequestHandler, self).__init__(application, request, **kwargs)
+        self.timing = metrics.Timing()
+        self.repo = None
+
+    def _execute(self, transforms, *args, **kwargs):
+        # whatever runs for the request, in its callbacks or the svn calls
+        # it makes, is timed against it
+        if args and args[0] and args[0].split('/')[0] in settings.repositories:
+            self.repo = args[0].split('/')[0]
+        with stack_context.StackContext(functools.partial(metrics.activate, self.timing)):
+            super(RequestHandler, self)._execute(transforms, *args, **kwargs)
+
+    def render_string(self, template_name, **kwargs):
+        with metrics.timed('render'):
+            return super(RequestHandler, self).render_string(template_name, **kwargs)
+
+    def flush(self, include_footers=False, callback=None):
+        if not self._headers_written:
+            # a page streamed in parts only reports what its first part took
+            self.set_header('Server-Timing', self.timing.header())
+        return super(RequestHandler, self).flush(include_footers, callback)
+
+    def finish(self, chunk=None):
+        super(RequestHandler, self).finish(chunk)
+        metrics.get_registry().record(type(self).__name__, self.repo, self.timing)
+
+    def not_modified(self, repo, pinned=None):
+        """Sets the validators of a page about repo and answers 304 when the
+        client has the page already. Call it before doing any work.
+
+        A page pinned to a revision never changes and may be kept for good.
+        Any other is as new as the youngest revision of repo the watcher has
+        seen, and the index of it; until the watcher has seen one, tornado
+        validates the page by its body.
+        """
+        if pinned is None:
+            youngest = watcher.get_watcher().known.get(repo)
+            if not youngest:
+                return False
+            version = '%d:%d' % (youngest, revindex.get_index().revision(repo))
+            freshness = 'no-cache'
+        else:
+            version = str(pinned)
+            freshness = 'max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        etag = self._etag(version)
+        self.set_header('Etag', etag)
+        self._cache_control(freshness)
+        if _etag_matches(self.request.headers.get('If-None-Match', ''), etag):
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
+    def _etag(self, version):
+        """The ETag of this page as of version"""
+        return '"%s"' % hashlib.sha1('\0'.join((_PAGE_VERSION, self.request.uri,
+            version))).hexdigest()
+
+    def _cache_control(self, freshness):
+        self.set_header('Cache-Control', '%s, %s' % ('public'
+            if getattr(settings, 'HTTP_CACHE_PUBLIC', False) else 'private', freshness))
+
+    def _number(self, name, default):
+        """Returns the integer argument name, default if it is missing,
+        answering 400 if it isn't an integer
+        """
+        value = self.get_argument(name, None)
+        if not value:
+            return default
         try:
-            return mc.get(self.get_secure_cookie('octopy_session_id'))
-        except mc.MemcachedKeyNoneError:
-            return None
+            return int(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+def _etag_matches(header, etag):
+    """Whether the If-None-Match header lists etag, or is *. Tags compare
+    weakly, a W/ in front of either doesn't matter.
+    """
+    def weak(tag):
+        return tag[2:] if tag.startswith('W/') else tag
+    tags = set(weak(tag.strip()) for tag in header.split(','))
+    return '*' in tags or weak(etag) in tags
 
 class OtherHandler(RequestHandler):
     def get(self):
@@ -31,22 +183,67 @@ class OtherHandler(RequestHandler):
 
 class RepoHistoryHandler(RequestHandler):
     @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self, path):
         reponame = path.split("/")[0]
-        url = settings.repositories[reponame] + "/" + "/".join(path.split("/")[1:])
-        # TODO enable caching (again)
-        #mc = memcache.Client(['127.0.0.1:11211'], debug=0)
-        #logs = mc.get('%s_history' % reponame.encode('ISO-8859-1'))
-        #if not logs:
-        #    logs = svnbrowse.list_history(url)
-        #    mc.set('%s_history' % reponame.encode('ISO-8859-1'), logs, time=300)
+        subpath = "/".join(path.split("/")[1:])
+        url = settings.repositories[reponame] + "/" + subpath
         revision = self.get_argument('rev', None)
+        if self.not_modified(reponame,
+                int(revision) if revision and revision.isdigit() else None):
+            return
+        # `start` is the newest revision shown on the page, HEAD if missing
+        start = self._number('start', None)
+        if start is not None and start < 0:
+            raise tornado.web.HTTPError(400)
+        index = revindex.get_index()
+        indexed = index.revision(reponame)
+        newer = older = None
         if revision:
-            logs = svnbrowse.list_history(url, revision)
+            logs = yield svnexec.Call(reponame, svnbrowse.list_history, url, revision)
+        elif indexed and (start is None or start <= indexed):
+            logs = index.history(reponame, subpath, start, limit=HISTORY_PAGE_SIZE + 1)
+            if start is not None:
+                newer = self._cursor(index.newer(reponame, subpath, start,
+                    HISTORY_PAGE_SIZE))
+        elif start is not None:
+            logs, newer = yield [
+                svnexec.Call(reponame, svnbrowse.list_history, url,
+                    '%d:1' % start, limit=HISTORY_PAGE_SIZE + 1),
+                gen.Task(self._newer_page, reponame, url, start)]
         else:
-            logs = svnbrowse.list_history(url)
+            logs = yield svnexec.Call(reponame, svnbrowse.list_history, url,
+                'HEAD:1', limit=HISTORY_PAGE_SIZE + 1)
+        if not revision and len(logs) > HISTORY_PAGE_SIZE:
+            older = logs[HISTORY_PAGE_SIZE]['revision']
+            logs = logs[:HISTORY_PAGE_SIZE]
         self.render("templates/repohist.html", logs=logs, repo={"name": reponame},
-            breadcrumbs=[reponame], activecrumb='log', svnurl=url)
+            breadcrumbs=[reponame], activecrumb='log', svnurl=url,
+            newer=newer, older=older, histpath=path)
+
+    @gen.engine
+    def _newer_page(self, reponame, url, start, callback):
+        """Finds the cursor of the page before the one starting at `start`"""
+        try:
+            logs = yield svnexec.Call(reponame, svnbrowse.list_history, url,
+                '%d:HEAD' % (start + 1), limit=HISTORY_PAGE_SIZE)
+        except svnbrowse.SvnTimeout:
+            raise
+        except svnbrowse.CalledProcessError:
+            # start + 1 is past the youngest revision
+            logs = []
+        callback(self._cursor(logs))
+
+    def _cursor(self, newer_logs):
+        """Turns the entries following a page (oldest first) into the cursor
+        of the previous page: None when there are none, "" for the first page
+        """
+        if not newer_logs:
+            return None
+        elif len(newer_logs) < HISTORY_PAGE_SIZE:
+            return ""
+        return newer_logs[-1]['revision']
 
 class CreateRepoHandler(RequestHandler):
     @tornado.web.authenticated
@@ -56,17 +253,22 @@ class CreateRepoHandler(RequestHandler):
             breadcrumbs=[], activecrumb='newrepo', messages=[],
             site_title=settings.SITE_TITLE)
     @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         reponame = str(self.get_argument('reponame'))
         try:
-            svnmanage.create_repo(reponame, str(self.get_current_user()['username']))
-            mc = memcache.Client(['127.0.0.1:11211'], debug=0)
+            yield svnexec.Call(reponame, svnmanage.create_repo, reponame,
+                str(self.get_current_user()['username']))
+            mc = cache.get_cache()
             reload(settings)
             url = settings.repositories[reponame]
-            mc.set('repo_list_%s' % reponame,
-                svnbrowse.get_root_info(url), time=36000)
-            mc.set('repo_log_%s' % reponame,
-                list(reversed(svnbrowse.list_history(url))), time=36000)
+            info, logs = yield [
+                svnexec.Call(reponame, svnbrowse.get_root_info, url),
+                svnexec.Call(reponame, svnbrowse.list_history, url,
+                    'HEAD:1', limit=RECENT_CHANGES)]
+            dashboard.get_dashboard().update(reponame, info)
+            mc.set('repo_recent_%s' % reponame, logs[:RECENT_CHANGES])
             self.redirect("/%s" % reponame)
         except Exception, e:
             self.get([str(e)])
@@ -80,11 +282,14 @@ class CreateBranchHandler(RequestHandler):
             activecrumb='newbranch %s' % reponame)
         
     @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self, reponame):
         url = settings.repositories[reponame]
         branchname = self.get_argument('branchname')
         try:
-            svnmanage.create_branch(url, branchname, str(self.get_current_user()['username']))
+            yield svnexec.Call(reponame, svnmanage.create_branch, url, branchname,
+                str(self.get_current_user()['username']))
             self.redirect("/%s/branches" % reponame)
         except svnmanage.Error, e:
             self.render("templates/newbranch.html", errors=[str(e)],
@@ -93,21 +298,26 @@ class CreateBranchHandler(RequestHandler):
 
 class CreateTagHandler(RequestHandler):
     @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self, reponame):
         url = settings.repositories[reponame]
-        self._render_page(reponame, [], 
-            svnbrowse.get_tags(url))
+        tags = yield svnexec.Call(reponame, svnbrowse.get_tags, url)
+        self._render_page(reponame, [], tags)
        
     @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self, reponame):
         url = settings.repositories[reponame]
         tagname = self.get_argument('tagname')
         try:
-            svnmanage.create_tag(url, tagname, self.get_current_user()['username'])
+            yield svnexec.Call(reponame, svnmanage.create_tag, url, tagname,
+                self.get_current_user()['username'])
             self.redirect("/%s/tags" % reponame)
         except svnmanage.Error, e:
-            self._render_page(reponame, [str(e)], 
-                svnbrowse.get_tags(url))
+            tags = yield svnexec.Call(reponame, svnbrowse.get_tags, url)
+            self._render_page(reponame, [str(e)], tags)
 
     def _render_page(self, reponame, errors, tags):
         tags = list(reversed(sorted(tags)))
@@ -128,97 +338,533 @@ class CreateTagHandler(RequestHandler):
 
 class RepoHandler(RequestHandler):
     @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self, name, path=""):
+        # path@revision shows the path as of revision
+        path, pinned = _pinned(path)
+        if self.not_modified(name, pinned):
+            return
         parts = [name]
         parts.extend(path.strip("/").split("/"))
         parts = filter(lambda s: s.strip(), parts)
+        pin = '@%d' % pinned if pinned else ''
         url = settings.repositories[name]
-        files = svnbrowse.list_repository2(url, path)
         
-        mc = memcache.Client(['127.0.0.1:11211'], debug=0)
-        logs = mc.get('repo_log_%s' % str(name))
+        mc = cache.get_cache()
+        page = pagedata.PageData(name, self.request.path)
+        index = revindex.get_index()
+        recent_key = 'repo_recent_%s' % str(name)
+        if pinned:
+            recent_key += '_%d' % pinned
+        if index.revision(name) >= (pinned or 1):
+            logs = index.history(name, start=pinned, limit=RECENT_CHANGES)
+        else:
+            logs = mc.get(recent_key)
+        sort, descending, offset = self._order()
+        listing = gen.Task(self._listing, page, mc, name, url, path, sort,
+            descending, offset, DIR_PAGE_SIZE, pinned)
         if logs is None:
-            logs = list(reversed(svnbrowse.list_history(url)))
-            mc.set('repo_log_%s' % str(name), logs, time=36000)
-        for f in files: 
-            f['webpath'] = "/" + name + f['fullpath']
-        if len(files) == 1 and files[0]['kind'] == 'file':
-            # TODO fetch file size
-            #if int(files[0]['size']) > 1048576:
-            #    source = "File too large to display"
-            #else:
-            #    source = svnbrowse.highlight_file(url + "/" + path)
-            source = svnbrowse.highlight_file(url + "/" + path)
+            (node, files, total), logs = yield [listing,
+                page.call(svnbrowse.list_history, url, '%s:1' % (pinned or 'HEAD'),
+                    limit=RECENT_CHANGES)]
+            mc.set(recent_key, logs)
+        else:
+            node, files, total = yield listing
+        peg = self._peg(name, pinned)
+        if node is not None and node['kind'] == 'file':
+            entry = copy.copy(node)
+            # a cached render makes the size and type checks unnecessary,
+            # binary files are cached as an empty one
+            source = rendercache.get_cache().get(self._render_key(entry)) or None
+            mime_type = None
+            if source is None:
+                entry['size'], mime_type = yield gen.Task(self._details, page, mc,
+                    url, entry, peg)
+                if self._highlightable(entry, mime_type):
+                    source = yield gen.Task(self._highlighted, page, url, entry, peg)
             self.render("templates/repofile.html",
-                file=files[0], source=source, repo={"name": name},
-                breadcrumbs=parts[:-1], activecrumb=parts[-1], logs=logs,
-                svnurl=url + "/" + path, currentpath=name + "/" + path)
+                file=entry, source=source, mime_type=mime_type, repo={"name": name},
+                breadcrumbs=parts[:-1], activecrumb=parts[-1] + pin, logs=logs,
+                svnurl=url + "/" + path + pin, currentpath=name + "/" + path,
+                pin=pin, peg=peg)
         else:
             readmes = [s for s in files if 'readme' in s['name'].lower()]
             readme = ""
             if len(readmes) > 0:
-                readme = svnbrowse.highlight_file(url + "/" + path + "/" + readmes[0]['name'])
+                readme, messages = yield [
+                    gen.Task(self._highlighted, page, url, readmes[0], peg),
+                    gen.Task(self._messages, page, mc, name, url, files)]
+            else:
+                messages = yield gen.Task(self._messages, page, mc, name, url, files)
             self.render("templates/repodir.html",
-                repo={"name": name}, files=[f for f in files if f['fullpath'] not in ("/" + path, '')],
-                breadcrumbs=parts[:-1], activecrumb=parts[-1], logs=logs,
-                svnurl=url + "/" + path, readme=readme, currentpath=name + "/" + path)
+                repo={"name": name}, files=files, messages=messages, total=total,
+                offset=offset, sort=sort, descending=descending,
+                page_size=DIR_PAGE_SIZE,
+                breadcrumbs=parts[:-1], activecrumb=parts[-1] + pin, logs=logs,
+                svnurl=url + "/" + path + pin, readme=readme,
+                currentpath=name + "/" + path, pinned=pinned, pin=pin)
+        page.log()
+
+    def _peg(self, name, pinned):
+        """The revision the page shows its files as of, which svn looks them
+        up at: the one it is pinned to, else the youngest the watcher has
+        seen. The last changed revision of an entry won't do, a file copied
+        without changes didn't exist at its copy's path back then.
+        """
+        return pinned or watcher.get_watcher().known.get(name) or 'HEAD'
+
+    def _order(self):
+        """Returns the sort key, direction and offset asked for"""
+        sort = self.get_argument('sort', 'name')
+        if sort not in treeindex.SORT_KEYS:
+            sort = 'name'
+        return (sort, self.get_argument('order', 'asc') == 'desc',
+            max(self._number('offset', 0), 0))
+
+    @gen.engine
+    def _listing(self, page, mc, name, url, path, sort, descending, offset, limit,
+            revision=None, callback=None):
+        """Returns (node, entries, total) for path like treeindex.listing, as
+        of revision if given. Listings of the youngest revision come from
+        the tree summary when it is up to date. Listings from svn are cached
+        against their revision, the youngest the watcher has seen by
+        default, so a new commit makes them miss.
+        """
+        if revision is None:
+            revision = watcher.get_watcher().known.get(name)
+            listing = treeindex.get_index().listing(name, path, revision, sort,
+                descending, offset, limit)
+            if listing is not None:
+                callback(listing)
+                return
+        key = None
+        entries = None
+        if revision:
+            key = 'repo_dir_%s_%d_%s' % (str(name), revision,
+                hashlib.sha1(path.encode('utf-8')).hexdigest())
+            entries = mc.get(key)
+        if entries is None:
+            entries = yield page.call(svnbrowse.list_repository2, url, path, revision)
+            if key and entries:
+                mc.set(key, entries)
+        callback(_page(entries, sort, descending, offset, limit))
+
+    @gen.engine
+    def _details(self, page, mc, url, entry, peg, callback):
+        """Returns the size and mime-type of the file described by the
+        listing entry of a page shown as of peg. Like renders, they never
+        change and are cached for good. Listings from the tree summary come
+        with the size, so only the properties are asked for then.
+        """
+        details_key = rendercache.key(entry['uuid'], entry['fullpath'],
+            entry['revision'], 'details')
+        details = mc.get(details_key)
+        if details is None:
+            path = url + entry['fullpath']
+            if entry['size'] is None:
+                size, properties = yield [
+                    page.call(svnbrowse.get_size, path, entry['revision'], peg),
+                    page.call(svnbrowse.get_properties, path, entry['revision'],
+                        peg)]
+            else:
+                size = entry['size']
+                properties = yield page.call(svnbrowse.get_properties, path,
+                    entry['revision'], peg)
+            details = (size, properties.get('svn:mime-type'))
+            mc.set(details_key, details)
+        callback(details)
+
+    def _highlightable(self, entry, mime_type):
+        return not svnbrowse.is_binary(mime_type) and \
+            entry['size'] <= svnbrowse.HIGHLIGHT_MAX_BYTES
+
+    def _render_key(self, entry):
+        return rendercache.key(entry['uuid'], entry['fullpath'], entry['revision'])
+
+    @gen.engine
+    def _highlighted(self, page, url, entry, peg, callback):
+        """Returns the highlighted source of the file described by the
+        listing entry of a page shown as of peg, rendering it only if it
+        isn't cached yet. None if the file turns out to be binary.
+        """
+        cache = rendercache.get_cache()
+        key = self._render_key(entry)
+        source = cache.get(key)
+        if source is None:
+            source = yield page.call(svnbrowse.highlight_file,
+                url + entry['fullpath'], entry['revision'], peg)
+            # binary files are remembered as an empty render
+            cache.set(key, source or '')
+        callback(source or None)
+
+    @gen.engine
+    def _messages(self, page, mc, name, url, files, callback):
+        """Looks up the commit message of each entry's last changed revision.
+        Revisions never change, so their messages are cached without expiry.
+        """
+        prefix = 'repo_msg_%s_' % str(name)
+        revisions = set(f['revision'] for f in files)
+        # listings from the tree summary come with their messages
+        messages = dict((f['revision'], f['message']) for f in files if 'message' in f)
+        messages.update(revindex.get_index().messages(name, revisions - set(messages)))
+        missing = revisions - set(messages.keys())
+        if missing:
+            messages.update(mc.get_multi(list(missing), prefix))
+            missing -= set(messages.keys())
+        if missing:
+            fetched = yield page.call(svnbrowse.list_messages, url, sorted(missing))
+            mc.set_multi(fetched, key_prefix=prefix)
+            messages.update(fetched)
+        callback(messages)
+
+class ListingHandler(RepoHandler):
+    """The entries of a directory as JSON, a page at a time, for the listing
+    script to fetch more of them or another order
+    """
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self, name, path=""):
+        path, pinned = _pinned(path)
+        if self.not_modified(name, pinned):
+            return
+        url = settings.repositories[name]
+        mc = cache.get_cache()
+        page = pagedata.PageData(name, self.request.path)
+        sort, descending, offset = self._order()
+        limit = max(1, min(self._number('limit', DIR_PAGE_SIZE), DIR_PAGE_SIZE))
+        node, files, total = yield gen.Task(self._listing, page, mc, name, url,
+            path, sort, descending, offset, limit, pinned)
+        if node is None or node['kind'] != 'dir':
+            raise tornado.web.HTTPError(404)
+        messages = yield gen.Task(self._messages, page, mc, name, url, files)
+        entries = []
+        for f in files:
+            entry = f.json(name, pinned)
+            entry['message'] = messages.get(f.revision)
+            entries.append(entry)
+        self.finish({'total': total, 'offset': offset, 'entries': entries})
+
+class AnnotateHandler(RepoHandler):
+    """The highlighted source of a file next to the revision and author that
+    last changed each line
+    """
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self, name, path):
+        path, pinned = _pinned(path)
+        if self.not_modified(name, pinned):
+            return
+        pin = '@%d' % pinned if pinned else ''
+        parts = [name]
+        parts.extend(path.strip("/").split("/"))
+        parts = filter(lambda s: s.strip(), parts)
+        url = settings.repositories[name]
+        mc = cache.get_cache()
+        page = pagedata.PageData(name, self.request.path)
+        node, files, total = yield gen.Task(self._listing, page, mc, name, url,
+            path, 'name', False, 0, 0, pinned)
+        if node is None or node['kind'] != 'file':
+            raise tornado.web.HTTPError(404)
+        entry = copy.copy(node)
+        peg = self._peg(name, pinned)
+        entry['size'], mime_type = yield gen.Task(self._details, page, mc, url,
+            entry, peg)
+        source = None
+        if self._highlightable(entry, mime_type):
+            source, lines = yield [gen.Task(self._highlighted, page, url, entry, peg),
+                page.call(annotate.get_store().annotate, name, url,
+                    urllib.unquote(entry['fullpath']), entry['revision'], peg)]
+        if source is None:
+            # nothing to annotate, the file page says why
+            self.redirect('/%s/%s%s' % (name, path, pin))
+            return
+        self.render("templates/annotate.html",
+            file=entry, source=self._merge(name, source, lines), repo={"name": name},
+            breadcrumbs=parts[:-1], activecrumb=parts[-1] + pin,
+            svnurl=url + "/" + path + pin, currentpath=name + "/" + path, peg=peg)
+        page.log()
+
+    def _merge(self, name, source, lines):
+        """Adds a column with the annotation of each line, shown where it
+        differs from the line above, to the table of the highlighted source
+        """
+        column = []
+        previous = None
+        for revision, author in lines:
+            if revision is not None and revision != previous:
+                column.append('<a href="/changeset/%s/%d">r%d</a> %s' % (
+                    tornado.escape.url_escape(name), revision, revision,
+                    tornado.escape.xhtml_escape(author)))
+            else:
+                column.append('')
+            previous = revision
+        cell = '<td class="annotation"><div class="annotationdiv"><pre>%s</pre></div></td>' \
+            % '\n'.join(column)
+        return source.replace('<td class="code">', cell + '<td class="code">', 1)
+
+class RawHandler(RequestHandler):
+    """Sends the contents of a file as they come out of `svn cat`: the file
+    at path as of ?rev, looked up at ?peg, HEAD by default
+    """
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self, name, path):
+        url = settings.repositories[name] + "/" + path
+        revision = self.get_argument('rev', None)
+        peg = self.get_argument('peg', None) or (revision and 'HEAD')
+        for number in (revision, peg):
+            if number and not number.isdigit() and number != 'HEAD':
+                raise tornado.web.HTTPError(400)
+        try:
+            size, properties = yield [
+                svnexec.Call(name, svnbrowse.get_size, url, revision, peg),
+                svnexec.Call(name, svnbrowse.get_properties, url, revision, peg)]
+        except svnbrowse.SvnTimeout:
+            raise
+        except svnbrowse.CalledProcessError:
+            raise tornado.web.HTTPError(404)
+        if size is None:
+            raise tornado.web.HTTPError(404)
+        mime_type = properties.get('svn:mime-type')
+        if svnbrowse.is_binary(mime_type):
+            self.set_header('Content-Type', mime_type)
+            self.set_header('Content-Disposition',
+                'attachment; filename="%s"' % os.path.basename(path).replace('"', ''))
+        else:
+            self.set_header('Content-Type', mime_type or 'text/plain')
+        self.stream = svnexec.PipeStream(self, svnbrowse.cat_command(url, revision,
+            peg))
+
+    def on_connection_close(self):
+        stream = getattr(self, 'stream', None)
+        if stream is not None:
+            stream.close()
 
 class DiffHandler(RequestHandler):
+    """Streams the diff file by file, highlighting each one as svn gets to
+    it. Files with a diff larger than DIFF_COLLAPSE_BYTES are collapsed and
+    loaded on demand through ?section=<number>.
+    """
     @tornado.web.authenticated
+    @tornado.web.asynchronous
     def get(self, reponame):
         from_path = self.get_argument('fpath', '')
         from_rev = self.get_argument('frev', 'HEAD')
         to_path = self.get_argument('tpath', from_path)
         to_rev = self.get_argument('trev', 'HEAD')
+        # the changes of a single revision, see ChangesetHandler
+        change = self._number('c', None)
+        if change is not None and change < 1:
+            raise tornado.web.HTTPError(400)
+        section = self._number('section', None)
+        if section is not None and section < 0:
+            raise tornado.web.HTTPError(400)
+        # the diff between two numbered revisions never changes
+        pinned = None
+        if change or (from_rev.isdigit() and to_rev.isdigit()):
+            pinned = change or int(to_rev)
+        self.completed_key = None
+        if pinned and not cache.get_cache().get(self._completed_key(pinned)):
+            # the head of the page goes out before svn has run, so the diff
+            # is only declared immutable once it has come out whole, without
+            # errors; until then it goes out without validators
+            self.completed_key = self._completed_key(pinned)
+            self._cache_control('no-cache')
+        elif self.not_modified(reponame, pinned):
+            return
 
         url = settings.repositories[reponame]
+        if change:
+            from_rev, to_rev = change - 1, change
+            to_path = from_path
+            args = (svnbrowse.iter_change, url, from_path, to_rev,
+                self.get_argument('peg', None))
+        else:
+            args = (svnbrowse.iter_diff, url, from_path, from_rev, to_path, to_rev)
+        self.query = self.request.query
+        self.sections = 0
+        # no deadline for the whole diff, which goes at the pace of the
+        # client; svn itself is still killed after svnbrowse.SVN_TIMEOUT
+        if section is not None:
+            self.section = section
+            self.iteration = svnexec.Iteration(reponame, self._section, args,
+                on_item=self._write_section, callback=self._section_done,
+                timeout=0)
+            return
 
-        diffoutput = svnbrowse.list_diff(url, from_path, from_rev, to_path, to_rev)
-        diff = svnbrowse.highlight_diff(diffoutput)
-                
-        self.render("templates/diff.html", repo={"name": reponame},
-            diff=diff, breadcrumbs=[reponame], activecrumb='diff', 
+        page = self.render_string("templates/diff.html", repo={"name": reponame},
+            diff=DIFF_PLACEHOLDER, breadcrumbs=[reponame], activecrumb='diff', 
             currentpath=reponame, from_path=from_path, from_rev=from_rev,
             to_path=to_path, to_rev=to_rev, errors=[])
+        head, self.tail = page.split(DIFF_PLACEHOLDER, 1)
+        self.write(head)
+        self.flush()
+        self.iteration = svnexec.Iteration(reponame, self._sections, args,
+            on_item=self._write_section, callback=self._done, timeout=0)
+
+    def _sections(self, diffs, *args):
+        """Runs on a worker, yields (number, path, html, size) per file"""
+        diffs = diffs(*args, max_bytes=DIFF_COLLAPSE_BYTES)
+        for number, (path, diff, size) in enumerate(diffs):
+            yield number, path, diff and svnbrowse.highlight_diff(diff), size
+
+    def _section(self, diffs, *args):
+        for number, (path, diff, size) in enumerate(diffs(*args)):
+            if number == self.section:
+                yield number, path, svnbrowse.highlight_diff(diff), size
+                return
+
+    def _write_section(self, section, resume):
+        number, path, html, size = section
+        self.sections += 1
+        try:
+            self.write(self.render_string("templates/diffsection.html",
+                number=number, path=path, diff=html, size=size, query=self.query))
+            self.flush(callback=resume)
+        except Exception:
+            # don't leave the worker waiting for a section that never goes out
+            self.iteration.cancel()
+            raise
+
+    def _section_done(self, exc_info):
+        if exc_info or not self.sections:
+            self.send_error(404)
+        else:
+            self._completed()
+            self.finish()
+
+    def _done(self, exc_info):
+        if exc_info:
+            logging.error("diff failed", exc_info=exc_info)
+            self.write('<div class="alert-message error"><p>%s</p></div>' %
+                tornado.escape.xhtml_escape(str(exc_info[1])))
+        else:
+            self._completed()
+        self.finish(self.tail)
+
+    def _completed_key(self, pinned):
+        return 'diff_completed_%s' % self._etag(str(pinned)).strip('"')
+
+    def _completed(self):
+        """Remembers that the pinned diff came out whole, so that the next
+        requests for it get the validators of an immutable page
+        """
+        if self.completed_key and not self.iteration.cancelled:
+            cache.get_cache().set(self.completed_key, True)
+
+    def on_connection_close(self):
+        iteration = getattr(self, 'iteration', None)
+        if iteration is not None:
+            iteration.cancel()
+
+class ChangesetHandler(RequestHandler):
+    """What a revision changed: the paths with their added and removed line
+    counts, which are stored in the revision index once computed. The diff
+    of each file is fetched from DiffHandler when asked for.
+    """
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self, reponame, revision):
+        url = settings.repositories[reponame]
+        revision = int(revision)
+        if self.not_modified(reponame, revision):
+            return
+        index = revindex.get_index()
+        log = index.entry(reponame, revision)
+        try:
+            if log is None:
+                logs, changes = yield [
+                    svnexec.Call(reponame, svnbrowse.list_history, url, revision),
+                    svnexec.Call(reponame, index.diffstat, reponame, url, revision)]
+                log = logs[0]
+            else:
+                changes = yield svnexec.Call(reponame, index.diffstat, reponame,
+                    url, revision)
+        except svnbrowse.SvnTimeout:
+            raise
+        except svnbrowse.CalledProcessError:
+            raise tornado.web.HTTPError(404)
+        self.render("templates/changeset.html", repo={"name": reponame},
+            breadcrumbs=[reponame], activecrumb='r%d' % revision,
+            currentpath=reponame, log=log, changes=changes, revision=revision,
+            added=sum(change['added'] for change in changes),
+            removed=sum(change['removed'] for change in changes))
 
 class MainHandler(RequestHandler):
     @tornado.web.authenticated
     def get(self):
-        mc = memcache.Client(['127.0.0.1:11211'], debug=0)
-        names = settings.repositories.keys()
-        repos_list = mc.get_multi(names, 'repo_list_')
-        missing = set(names) - set(repos_list.keys())
-        if len(missing) > 0:
-            reload(settings)
-            for name in missing:
-                url = settings.repositories[name]
-                repos_list[name] = svnbrowse.get_root_info(url)
-                mc.set('repo_list_%s' % name, repos_list[name], time=36000)
-        self.render("templates/repolist.html", repos=repos_list.values(), 
+        # never waits on svn, repositories not refreshed yet are listed
+        # with just their name
+        repos_list = dashboard.get_dashboard().get_repos(settings.repositories)
+        self.render("templates/repolist.html", repos=repos_list, 
                 site_title=settings.SITE_TITLE)
 
+def check_login(username, password, callback):
+    """Passes whether the login is valid to callback: asks
+    settings.auth_async if there is one, without blocking, else
+    settings.auth
+    """
+    auth_async = getattr(settings, 'auth_async', None)
+    if auth_async is not None:
+        auth_async(username, password, callback)
+    else:
+        callback(settings.auth(username, password))
+
 class LoginHandler(RequestHandler):
     def get(self):
         self.render("templates/login.html", 
             redirect_to=self.get_argument("next"), errors=[])
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         username = self.get_argument("username")
         password = self.get_argument("password")
         redirect_to = self.get_argument("redirect_to")
-        if not settings.auth(username, password):
-            return self.render("templates/login.html", redirect_to=redirect_to, 
+        valid = yield gen.Task(check_login, username, password)
+        if not valid:
+            self.render("templates/login.html", redirect_to=redirect_to, 
                 errors=['Login failed - invalid credentials'])
+            return
 
-        sessid = ''.join(random.choice(string.letters) for i in xrange(32))
-        mc = memcache.Client(['127.0.0.1:11211'], debug=0)
-        if mc.get(sessid) is not None:
-            return self.render("templates/login.html", redirect_to=redirect_to, 
+        sessid = sessions.get_store().create(username)
+        if sessid is None:
+            self.render("templates/login.html", redirect_to=redirect_to, 
                 errors=['Login failed - failed to generate unique key'])
+            return
 
-        mc.set(sessid, {'username': username}, time=32400)
         self.set_secure_cookie('octopy_session_id', sessid, expires_days=1)
         self.redirect(redirect_to)
 
+class LogoutHandler(RequestHandler):
+    def get(self):
+        sessions.get_store().delete(self.get_secure_cookie('octopy_session_id'))
+        self.clear_cookie('octopy_session_id')
+        self.redirect("/")
+
+class SearchHandler(RequestHandler):
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self, reponame):
+        query = self.get_argument('q', '')
+        everywhere = bool(self.get_argument('all', ''))
+        results = []
+        errors = []
+        if len(query) < 3:
+            if query:
+                errors.append('Search for at least 3 characters')
+        else:
+            results = yield svnexec.Call('__search__', codesearch.get_index().search,
+                query, None if everywhere else [reponame])
+        self.render("templates/search.html", repo={"name": reponame},
+            query=query, everywhere=everywhere, results=results, errors=errors,
+            breadcrumbs=[reponame], activecrumb='search', currentpath=reponame)
+
 class DumpSettingsHandler(RequestHandler):
     @tornado.web.authenticated
     def get(self):
@@ -226,19 +872,80 @@ class DumpSettingsHandler(RequestHandler):
 
 class FlushCacheHandler(RequestHandler):
     def get(self, name):
-        mc = memcache.Client(['127.0.0.1:11211'], debug=0)
-        mc.delete('repo_list_%s' % str(name))
-        mc.delete('repo_log_%s' % str(name))
+        if name in settings.repositories:
+            repository_changed(name)
+
+class PostCommitHandler(RequestHandler):
+    """Called by hooks/post-commit with the repository name and the revision
+    just committed
+    """
+    def post(self):
+        if self.request.remote_ip not in watcher.HOOK_ADDRESSES:
+            raise tornado.web.HTTPError(403)
+        name = self.get_argument('repo')
+        revision = self._number('rev', None)
+        if revision is not None and revision < 0:
+            raise tornado.web.HTTPError(400)
+        if name not in settings.repositories:
+            reload(settings)
+        if name not in settings.repositories:
+            raise tornado.web.HTTPError(404)
+        if revision is None or watcher.get_watcher().seen(name, revision):
+            repository_changed(name)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """The request histograms of every worker process, for Prometheus"""
+    def get(self):
+        if self.request.remote_ip not in metrics.METRICS_ADDRESSES:
+            raise tornado.web.HTTPError(403)
+        registry = metrics.collect(cache.get_cache(), server.workers, _worker)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(registry.exposition())
+
+_profiling = []
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """Samples the stacks of the process answering for ?seconds (10 by
+    default, at most 300) and sends them in the collapsed format of flame graph tools.
+    Only allowed with metrics.PROFILING on.
+    """
+    @tornado.web.asynchronous
+    def get(self):
+        if not metrics.PROFILING or \
+                self.request.remote_ip not in metrics.METRICS_ADDRESSES:
+            raise tornado.web.HTTPError(403)
+        if _profiling:
+            raise tornado.web.HTTPError(409)
+        try:
+            seconds = float(self.get_argument('seconds', 10))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        # also turns away nan
+        if not seconds > 0:
+            raise tornado.web.HTTPError(400)
+        seconds = min(seconds, 300)
+        io_loop = tornado.ioloop.IOLoop.instance()
+        def sample():
+            samples = metrics.profile(seconds)
+            io_loop.add_callback(lambda: done(samples))
+        def done(samples):
+            _profiling.pop()
+            self.set_header('Content-Type', 'text/plain')
+            self.finish(samples)
+        _profiling.append(True)
+        thread = threading.Thread(target=sample, name='profiler')
+        thread.daemon = True
+        thread.start()
 
 class MemStatsHandler(tornado.web.RequestHandler):
     def get(self):
-        mc = memcache.Client(['127.0.0.1:11211'], debug=0)
+        mc = cache.get_cache()
         pprint(mc.get_stats(), self)
 
 class DumpSessionHandler(tornado.web.RequestHandler):
     def get(self):
-        mc = memcache.Client(['127.0.0.1:11211'], debug=0)
-        pprint(mc.get(self.get_secure_cookie('octopy_session_id')), self)
+        pprint(sessions.get_store().get(self.get_secure_cookie('octopy_session_id')),
+            self)
 
 appsettings = {
     "static_path": os.path.join(os.path.dirname(__file__), "static"),
@@ -247,10 +954,14 @@ appsettings = {
 application = tornado.web.Application([
     (r"/", MainHandler),
     (r"/login", LoginHandler),
+    (r"/logout", LogoutHandler),
     (r"/dump-settings", DumpSettingsHandler),
     (r"/dump-session", DumpSessionHandler),
     (r"/stats", MemStatsHandler),
+    (r"/metrics", MetricsHandler),
+    (r"/profile", ProfileHandler),
     (r"/refresh/(.*)", FlushCacheHandler),
+    (r"/hooks/post-commit", PostCommitHandler),
     (r"/newtag/(.*)", CreateTagHandler),
     (r"/newbranch/(.*)", CreateBranchHandler),
     (r"/newrepo", CreateRepoHandler),
@@ -266,14 +977,149 @@ application = tornado.web.Application([
     (r"/history/(.*)", RepoHistoryHandler),
     (r"/changes/(.*)", RepoHistoryHandler),
     (r"/diff/(.*)", DiffHandler),
+    (r"/changeset/([^/]*)/(\d+)", ChangesetHandler),
+    (r"/search/(.*)", SearchHandler),
+    (r"/raw/([^/]*)/(.*)", RawHandler),
+    (r"/annotate/([^/]*)/(.*)", AnnotateHandler),
+    (r"/list/([^/]*)/?(.*)", ListingHandler),
     (r"/([^/]*)/?(.*)", RepoHandler),
-], debug=True, login_url="/login", cookie_secret=settings.SECURE_COOKIE_KEY)
+], login_url="/login", cookie_secret=settings.SECURE_COOKIE_KEY)
+
+# whether this process runs the background jobs: indexing and refreshing the
+# dashboard. When several processes serve octopy only one of them does.
+_background = True
+
+# the number of this worker process
+_worker = 0
+
+_indexing = []
+
+# names of the repositories waiting for an index update
+_reindex = set()
+
+_SORT_KEYS = {
+    'name': lambda entry: entry.name,
+    'size': lambda entry: entry.size or 0,
+    'date': lambda entry: entry.orig_date,
+    'author': lambda entry: entry.author}
+
+def _page(entries, sort, descending, offset, limit):
+    """Turns a listing from svn, the node itself first, into what
+    treeindex.listing returns
+    """
+    if not entries:
+        return None, [], 0
+    key = _SORT_KEYS[sort]
+    children = sorted(entries[1:], key=lambda entry: (key(entry), entry.name),
+        reverse=descending)
+    return entries[0], children[offset:offset + limit], len(children)
+
+def _update_indexes(repositories):
+    revindex.get_index().update_all(repositories)
+    treeindex.get_index().update_all(repositories)
+    codesearch.get_index().update_all(repositories)
+
+def update_index(names=None):
+    """Brings the revision and search indexes and the tree summaries of the
+    named repositories (all of them by default) up to date in the background
+    """
+    if not _background:
+        return
+    _reindex.update(settings.repositories.keys() if names is None else names)
+    if _indexing or not _reindex:
+        return
+    repositories = dict((name, settings.repositories[name])
+        for name in _reindex if name in settings.repositories)
+    _reindex.clear()
+    _indexing.append(True)
+    def done(result):
+        _indexing.pop()
+        update_index([])
+    svnexec.get_pool().submit('__revindex__', _update_indexes,
+        (repositories,), timeout=0, callback=done)
+
+def repository_changed(name):
+    """Brings what is cached about a repository up to date after a commit.
+    Renders and commit messages are keyed by revision and stay valid.
+    """
+    cache.get_cache().delete('repo_recent_%s' % str(name))
+    dashboard.get_dashboard().refresh({name: settings.repositories[name]})
+    update_index([name])
+
+_polling = []
+
+def poll_repositories():
+    """Looks for repositories committed to since the last poll"""
+    if _polling:
+        return
+    _polling.append(True)
+    def done(changed):
+        _polling.pop()
+        for name in changed or ():
+            if name in settings.repositories:
+                repository_changed(name)
+    svnexec.get_pool().submit('__watcher__', watcher.get_watcher().poll,
+        (dict(settings.repositories),), timeout=0, callback=done)
+
+def refresh_dashboard():
+    """Refreshes the front page info of the repositories that are due, so
+    that it is never stale by the time someone asks for it
+    """
+    dashboard.get_dashboard().get_repos(settings.repositories)
 
-# with the `debug=True` flag we get autoreloading - whenever a module is changed
-# while the webserver is running, the whole thing is reloaded
+def start_jobs(worker=0):
+    """Starts the periodic jobs of a serving process and returns them. Every
+    process polls for commits, which is cheap and keeps the youngest
+    revisions its cache keys use current; only worker 0 indexes and
+    refreshes the dashboard, the others follow the dashboard through the
+    shared cache.
+    """
+    global _background, _worker
+    _worker = worker
+    _background = worker == 0
+    highlighter.start()
+    board = dashboard.get_dashboard()
+    board.refreshing = _background or not cache.get_cache().shared
+    if _background and not cache.get_cache().shared:
+        logging.warning("no memcached configured, each process has its own caches")
+    jobs = []
+    if watcher.POLL_INTERVAL:
+        # the first poll reports every repository as changed
+        poll_repositories()
+        jobs.append(tornado.ioloop.PeriodicCallback(poll_repositories,
+            watcher.POLL_INTERVAL * 1000))
+    elif _background:
+        update_index()
+        jobs.append(tornado.ioloop.PeriodicCallback(update_index,
+            revindex.INDEX_INTERVAL * 1000))
+    if board.refreshing:
+        refresh_dashboard()
+        jobs.append(tornado.ioloop.PeriodicCallback(refresh_dashboard,
+            dashboard.REFRESH_INTERVAL * 1000 / 10))
+    if server.workers > 1:
+        jobs.append(tornado.ioloop.PeriodicCallback(
+            lambda: metrics.publish(cache.get_cache(), worker),
+            metrics.PUBLISH_INTERVAL * 1000))
+    for job in jobs:
+        job.start()
+    return jobs
 
 if __name__ == "__main__":
 
     args = parser.parse_args()
-    application.listen(5000)
-    tornado.ioloop.IOLoop.instance().start()
+    if args.debug:
+        # templates are recompiled on every request and the whole thing is
+        # reloaded whenever a module changes
+        application.settings['debug'] = True
+        tornado.autoreload.start()
+        start_jobs()
+        application.listen(args.port, args.address)
+        tornado.ioloop.IOLoop.instance().start()
+    else:
+        if not watcher.POLL_INTERVAL and server.worker_count(args.processes) > 1:
+            # the hook reaches a single worker, the others would never hear
+            # of new commits
+            parser.error("watcher.POLL_INTERVAL = 0 relies on the post-commit "
+                "hook alone, which needs --processes 1")
+        server.serve(application, args.port, args.address, args.processes,
+            start_jobs)